@@ -0,0 +1,167 @@
+"""
+Streaming aggregation of client updates. Instead of decoding the weights of all clients before averaging them (as FedAvg
+does), the tensors of one client are decoded at a time, folded into preallocated accumulators and released right away,
+thus the memory needed for aggregation does not grow with the number of clients.
+Compressed uploads (quantized deltas, see codec.py) are dequantized while folding, the averaged delta is added to the
+weights sent to the clients at the end.
+Tensors omitted by a client (sparse uploads) are averaged over the clients which sent them, a tensor sent by no client
+keeps the value of the weights sent to the clients.
+The strategies fold the weights of each client as soon as its result arrives (FoldingRound), s.t. the server does not
+hold the uploads of all clients of a round at once.
+"""
+import threading
+import numpy as np
+from flwr.server.client_proxy import ClientProxy
+from codec import decode, decode_delta, is_delta, is_skipped, weights_to_parameters
+
+
+class StreamingAggregator:
+    """
+    Weighted average (by number of examples) of client weights. Floating point tensors are accumulated in float32,
+    all others (e.g. num_batches_tracked of BatchNorm) in float64 and rounded back to their dtype.
+    The weights are normalized per tensor, by the examples of the clients which sent it.
+    """
+
+    def __init__(self) -> None:
+        self.acc = None
+        self.dtypes = None
+        self.is_delta = None
+        self.totals = None
+
+    def _fold(self, i, layer, num_examples):
+        if self.acc[i] is None:
+            self.dtypes[i] = layer.dtype
+            acc_dtype = np.float32 if np.issubdtype(layer.dtype, np.floating) else np.float64
+            self.acc[i] = np.zeros(layer.shape, dtype=acc_dtype)
+        self.acc[i] += layer.astype(self.acc[i].dtype, copy=False) * num_examples
+        self.totals[i] += num_examples
+
+    def _init(self, n):
+        if self.acc is None:
+            self.acc, self.dtypes, self.is_delta, self.totals = [None] * n, [None] * n, [False] * n, [0] * n
+
+    def add(self, weights, num_examples):
+        """
+        Folds the weights (list of np.ndarray, None for omitted tensors) of one client into the accumulators.
+        """
+        self._init(len(weights))
+        for i, layer in enumerate(weights):
+            if layer is not None:
+                self._fold(i, layer, num_examples)
+
+    def add_parameters(self, parameters, num_examples):
+        """
+        Folds the serialized weights (or compressed deltas) of one client into the accumulators.
+        Each tensor is released from parameters as soon as it is folded.
+        """
+        tensors = parameters.tensors
+        self._init(len(tensors))
+        for i in range(len(tensors)):
+            if is_skipped(tensors[i]):
+                continue
+            if is_delta(tensors[i]):
+                layer, self.is_delta[i] = decode_delta(tensors[i])
+            else:
+                layer = decode(tensors[i])
+            tensors[i] = b''
+            self._fold(i, layer, num_examples)
+
+    def result(self, base=None):
+        """
+        Returns the averaged weights as list of np.ndarray. base (list of np.ndarray) are the weights the deltas
+        refer to, which are also kept for tensors sent by no client.
+        """
+        weights = []
+        for i, (acc, dtype) in enumerate(zip(self.acc, self.dtypes)):
+            if (acc is None or self.is_delta[i]) and base is None:
+                raise ValueError('Clients uploaded deltas or omitted tensors, but the weights they refer to are unknown')
+            if acc is None:
+                weights.append(base[i])
+                continue
+            acc /= self.totals[i]
+            if self.is_delta[i]:
+                acc += base[i]
+            weights.append(acc.astype(dtype, copy=False) if np.issubdtype(dtype, np.floating) else np.rint(acc).astype(dtype))
+        return weights
+
+
+class FoldingRound:
+    """
+    Aggregation of one round of fit. The ClientProxy-objects of the selected clients are wrapped (wrap), s.t. the weights
+    returned by a client are folded into the StreamingAggregator by the thread which received them.
+    """
+
+    def __init__(self, transport=None) -> None:
+        self.aggregator = StreamingAggregator()
+        self.transport = transport # resolves uploads placed in shared memory
+        self.folded = set()
+        self.lock = threading.Lock()
+
+    def wrap(self, instructions):
+        return [(FoldingClientProxy(client, self), ins) for client, ins in instructions]
+
+    def fold(self, fit_res):
+        with self.lock:
+            if id(fit_res) in self.folded:
+                return
+            if self.transport is not None:
+                self.transport.receive([fit_res.parameters], detach=False)
+            self.aggregator.add_parameters(fit_res.parameters, fit_res.num_examples)
+            self.folded.add(id(fit_res))
+
+
+class FoldingClientProxy(ClientProxy):
+    """
+    ClientProxy folding the result of fit into the FoldingRound before it is returned to the server.
+    """
+
+    def __init__(self, client, folding) -> None:
+        super().__init__(client.cid)
+        self.client = client
+        self.folding = folding
+
+    def get_properties(self, ins):
+        return self.client.get_properties(ins)
+
+    def get_parameters(self):
+        return self.client.get_parameters()
+
+    def fit(self, ins):
+        fit_res = self.client.fit(ins)
+        self.folding.fold(fit_res)
+        return fit_res
+
+    def evaluate(self, ins):
+        return self.client.evaluate(ins)
+
+    def reconnect(self, reconnect):
+        return self.client.reconnect(reconnect)
+
+
+def aggregate_fit_results(results, base=None, folding=None):
+    """
+    Weighted average of the weights sent by the clients, computed with a StreamingAggregator.
+    The tensors of the FitRes-objects are consumed, their metrics (e.g. before, after, hidx) are left untouched.
+
+    Args:
+        results (List[Tuple[ClientProxy, FitRes]]): Results sent by the clients
+        base (Parameters, optional): Parameters sent to the clients, needed if they upload deltas. Defaults to None.
+        folding (FoldingRound, optional): Aggregation the results have been folded into while arriving. Defaults to None.
+
+    Returns:
+        Parameters: Aggregated weights
+    """
+    folding = folding if folding is not None else FoldingRound()
+    for _, fit_res in results:
+        folding.fold(fit_res)
+    base_weights = _LazyWeights(base) if base is not None else None
+    return weights_to_parameters(folding.aggregator.result(base_weights))
+
+
+class _LazyWeights:
+    # decodes the tensors of parameters on access only
+    def __init__(self, parameters) -> None:
+        self.tensors = parameters.tensors
+
+    def __getitem__(self, i):
+        return decode(self.tensors[i])
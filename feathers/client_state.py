@@ -0,0 +1,150 @@
+"""
+Management of the states of many (mostly idle) virtual clients in a simulation worker. The states of the most recently
+used clients stay in memory, the least recently used ones are spilled to compressed blobs on disk once the number of
+resident states or their size exceeds the budget. Spilling and restoring run in a background thread, s.t. the state
+of the next client can be read while the current one is still training.
+"""
+import io
+import os
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def _to_cpu(state):
+    # copy, s.t. the stored state is not changed by the optimizer of a client which is still alive
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return state
+
+def _nbytes(state):
+    if isinstance(state, torch.Tensor):
+        return state.numel() * state.element_size()
+    elif isinstance(state, np.ndarray):
+        return state.nbytes
+    elif isinstance(state, dict):
+        return sum(_nbytes(v) for v in state.values())
+    elif isinstance(state, (list, tuple)):
+        return sum(_nbytes(v) for v in state)
+    return 0
+
+
+class ClientStateManager:
+
+    def __init__(self, path, max_resident=16, max_bytes=None, compress_level=1) -> None:
+        """
+        LRU-cache of client states backed by compressed blobs on disk.
+
+        Args:
+            path (str): Directory the spilled states are written to
+            max_resident (int, optional): Maximum number of states kept in memory. Defaults to 16.
+            max_bytes (int, optional): Maximum size of the states kept in memory. Defaults to None (no limit).
+            compress_level (int, optional): zlib compression level of the blobs. Defaults to 1.
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.max_resident = max_resident
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.resident = OrderedDict() # cid -> (state, size), least recently used first
+        self.size = 0
+        self.spilling = {} # states evicted but not yet written
+        self.loading = {} # futures of prefetched states
+        self.on_disk = set()
+        self.lock = threading.RLock()
+        self.io = ThreadPoolExecutor(1) # one thread keeps writes and reads of a blob in order
+
+    def _file(self, cid):
+        return os.path.join(self.path, 'client_{}.state'.format(cid))
+
+    def _write(self, cid, state):
+        buffer = io.BytesIO()
+        torch.save(state, buffer)
+        tmp_file = self._file(cid) + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(zlib.compress(buffer.getbuffer(), self.compress_level))
+        os.replace(tmp_file, self._file(cid))
+        with self.lock:
+            self.on_disk.add(cid)
+            if self.spilling.get(cid) is state:
+                del self.spilling[cid]
+
+    def _read(self, cid):
+        with open(self._file(cid), 'rb') as f:
+            return torch.load(io.BytesIO(zlib.decompress(f.read())))
+
+    def _evict(self, keep):
+        while len(self.resident) > 1 and (len(self.resident) > self.max_resident or
+                                          (self.max_bytes is not None and self.size > self.max_bytes)):
+            cid = next(iter(self.resident))
+            if cid == keep:
+                self.resident.move_to_end(cid)
+                cid = next(iter(self.resident))
+            state, size = self.resident.pop(cid)
+            self.size -= size
+            self.spilling[cid] = state
+            self.io.submit(self._write, cid, state)
+
+    def _insert(self, cid, state):
+        with self.lock:
+            if cid in self.resident:
+                self.size -= self.resident.pop(cid)[1]
+            self.spilling.pop(cid, None)
+            self.loading.pop(cid, None) # a prefetched state would be outdated
+            size = _nbytes(state)
+            self.resident[cid] = (state, size)
+            self.size += size
+            self._evict(keep=cid)
+
+    def put(self, cid, state):
+        """
+        Stores the state of client cid (copied to the cpu), evicting the least recently used states if necessary.
+        """
+        self._insert(cid, _to_cpu(state))
+
+    def prefetch(self, cid):
+        """
+        Starts reading the state of client cid in the background if it is on disk only.
+        """
+        with self.lock:
+            if cid in self.resident or cid in self.spilling or cid in self.loading or cid not in self.on_disk:
+                return
+            # never prefetch more states than may be resident
+            if len(self.loading) >= self.max_resident:
+                return
+            self.loading[cid] = self.io.submit(self._read, cid)
+
+    def get(self, cid):
+        """
+        Returns the state of client cid or None if the client has no state yet.
+        """
+        with self.lock:
+            if cid in self.resident:
+                self.resident.move_to_end(cid)
+                return self.resident[cid][0]
+            if cid in self.spilling:
+                state = self.spilling[cid]
+                self._insert(cid, state)
+                return state
+            future = self.loading.pop(cid, None)
+            if future is None and cid not in self.on_disk:
+                return None
+        state = future.result() if future is not None else self.io.submit(self._read, cid).result()
+        self._insert(cid, state)
+        return state
+
+    def close(self):
+        """
+        Waits for the pending reads and writes and removes the spilled states.
+        """
+        self.io.shutdown(wait=True)
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -2,20 +2,31 @@ from asyncio import subprocess
 from subprocess import Popen
 import config
 import argparse
+from utils import get_dataset_loder, SharedLoader
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--stage', default='search', type=str)
 
 args = parser.parse_args()
 
+# load the dataset once and share it with all clients on this host
+shared = []
+if config.SHARE_CLIENT_DATA:
+    shared = SharedLoader.export(get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW), config.DATASET)
+shared_args = ['--shared-data'] if config.SHARE_CLIENT_DATA else []
+
 processes = []
-for c in range(config.CLIENT_NR):
-    gpu_idx = c % len(config.GPUS)
-    if args.stage == 'search':
-        process = Popen(['python', 'hanf_client.py', '--gpu', str(config.GPUS[gpu_idx]), '--id', str(c)])
-    else:
-        process = Popen(['python', 'hanf_client_valid.py', '--gpu', str(config.GPUS[gpu_idx]), '--id', str(c)])
-    processes.append(process)
+try:
+    for c in range(config.CLIENT_NR):
+        gpu_idx = c % len(config.GPUS)
+        if args.stage == 'search':
+            process = Popen(['python', 'hanf_client.py', '--gpu', str(config.GPUS[gpu_idx]), '--id', str(c)] + shared_args)
+        else:
+            process = Popen(['python', 'hanf_client_valid.py', '--gpu', str(config.GPUS[gpu_idx]), '--id', str(c)] + shared_args)
+        processes.append(process)
 
-for p in processes:
-    p.wait()
\ No newline at end of file
+    for p in processes:
+        p.wait()
+finally:
+    for data in shared:
+        data.unlink()
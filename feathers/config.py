@@ -29,10 +29,34 @@ GPUS = [5, 6] # GPUs to use
 SERVER_GPU = 5
 
 DATA_SKEW = 0 # skew of labels. 0 = no skew, 1 only some clients hold some labels
+PARTITION_MODE = 'label' # iid, label (runner split with DATA_SKEW), dirichlet (label skew) or quantity (skewed partition sizes)
+DIRICHLET_ALPHA = 0.5 # concentration of the dirichlet distribution used by the dirichlet and quantity partition mode
+PARTITION_SEED = 42
 USE_WEIGHTED_SAMPLER = True # use a weighted random sampler to account for class imbalances 
+IN_MEMORY_DATA = False # materialize client partitions and server test-set as tensors on the device and serve batches by slicing
+UPLOAD_COMPRESSION = None # None uploads the full weights. fp32, fp16, bf16 or int8 upload the (quantized) difference to the received weights, with error feedback
+DOWNLINK_VERSIONS = 0 # number of versions of the global weights the server keeps to send clients only the steps from the version they hold (0 = always send the full weights)
+DOWNLINK_COMPRESSION = None # None sends the steps exactly, fp16, bf16 or int8 quantize them (the server continues from the weights the clients reconstruct, the quantization error is carried into the next step)
+SHM_TRANSPORT = False # clients run on the host of the server (clients.py): weights are exchanged through shared memory, the gRPC messages only carry references
+GRPC_MAX_MESSAGE_LENGTH = 536870912 # maximum size of a gRPC message (server and clients), flwr's default (512 MB). The weights and hyperparameters are sent as one message, raise it by hand (gRPC allows up to 2 GB) for larger supernets or use SHM_TRANSPORT on a single host
+ASYNC_EVAL = False # the server evaluates (and checkpoints) the global model in a background process, results are logged against their round once finished
+EVAL_SHARDS = 0 # number of cpu worker processes evaluating shards of the server's test-set in parallel, 0 evaluates on the server's device
+EVAL_CACHE_SIZE = 8 # number of evaluation results (server and clients) memoized by the digest of the weights, 0 disables the memoization
+SPARSE_UPLOAD_THRESHOLD = None # search stage: omit the weights of MixedOp-branches whose softmax-weight is below this threshold from uploads, the server keeps their global values (None = upload all)
+SAMPLED_OPS = 0 # search stage: number of ops each MixedOp samples and executes per step (Gumbel-softmax with straight-through estimator), 0 executes all primitives
+GUMBEL_TAU = 1.0 # temperature of the Gumbel-softmax if SAMPLED_OPS > 0
+PARTIAL_CHANNELS = 1 # search stage: only 1/K of the channels of each state pass through the MixedOps, the others bypass them (PC-DARTS, with edge normalization), 1 = all channels
+FUSED_CELLS = False # search stage: the cells run the MixedOps reading the same state together (grouped convolutions, parameter-free ops once per state)
+MIX_EPSILON = 0.0 # search stage: in eval mode the MixedOps of the server's net skip ops whose weight is below (0 executes all ops), the clients always execute all ops since their before/after losses drive the hyperparameter gains
+PRUNE_SCHEDULE = {} # search stage: round -> number of ops kept per edge from that round on (those with the highest weights, none is dropped first), the other ops are dropped from the supernet of server and clients
+SHARE_CLIENT_DATA = False # clients.py loads the dataset once into shared memory, clients on the same host attach to it
+SIM_WORKERS = 4 # number of worker processes hosting the clients when running simulation.py
+CLIENT_STATE_RESIDENT = 16 # number of client states (optimizer, architect) a simulation worker keeps in memory, the others are spilled to disk
+CLIENT_STATE_MAX_MB = None # memory budget of the resident client states per simulation worker (None = only limited by CLIENT_STATE_RESIDENT)
+CLIENT_STATE_DIR = './client-states/' # directory of the spilled client states
 
 # validation stage
 DROP_PATH_PROB = 0.2 # probability of dropping a path in cell, similar to dropout
 
 HYPERPARAM_FILE = f'./hyperparam-logs/search_DARTS_{DATASET}_{CLIENT_NR}_{DATA_SKEW}.csv'
-DATASET_INDS_FILE = './hyperparam-logs/indices.json'
\ No newline at end of file
+DATASET_INDS_FILE = './hyperparam-logs/partitions/' # directory of the binary partition store
\ No newline at end of file
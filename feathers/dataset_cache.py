@@ -0,0 +1,138 @@
+"""
+Cache of pre-decoded image datasets. Images are decoded once into uint8 shards (N x C x H x W) stored as .npy files
+together with a label array. The shards are memory-mapped when read, batches are gathered from the shards without
+decoding and converted to float at once (the pipeline of the loaders is ToTensor() + Normalize((0,), (1,)), i.e. x / 255).
+"""
+import os
+import json
+import argparse
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import DataLoader, Dataset
+
+class _DecodeImageFolder(Dataset):
+    """
+    Decodes the images of an ImageFolder into uint8 tensors (C x H x W) without any further transform
+    """
+
+    def __init__(self, image_folder) -> None:
+        super().__init__()
+        self.samples = image_folder.samples
+        self.loader = image_folder.loader
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        img = np.asarray(self.loader(path).convert('RGB'), dtype=np.uint8)
+        return torch.from_numpy(img.copy()).permute(2, 0, 1), target
+
+
+def _uint8_batches(dataset, batch_size, num_workers):
+    if isinstance(dataset, torchvision.datasets.CIFAR10):
+        for start in range(0, len(dataset), batch_size):
+            imgs = dataset.data[start:start+batch_size].transpose(0, 3, 1, 2)
+            yield imgs, np.asarray(dataset.targets[start:start+batch_size])
+    elif isinstance(dataset, torchvision.datasets.ImageFolder):
+        for imgs, labels in DataLoader(_DecodeImageFolder(dataset), batch_size, num_workers=num_workers):
+            yield imgs.numpy(), labels.numpy()
+    else:
+        # generic dataset yielding images scaled to [0, 1]
+        for imgs, labels in DataLoader(dataset, batch_size, num_workers=num_workers):
+            yield imgs.mul(255.).round_().clamp_(0, 255).to(torch.uint8).numpy(), labels.numpy()
+
+def is_cached(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+def build_cache(dataset, path, shard_size=10000, batch_size=256, num_workers=8):
+    """
+    Decodes dataset once and writes it as uint8 shards of shard_size images and a label array to path.
+
+    Args:
+        dataset (Dataset): CIFAR10, ImageFolder or any dataset yielding images scaled to [0, 1]
+        path (str): Directory of the cache
+        shard_size (int, optional): Number of images per shard. Defaults to 10000.
+        batch_size (int, optional): Number of images decoded at once. Defaults to 256.
+        num_workers (int, optional): Number of processes used for decoding. Defaults to 8.
+    """
+    if len(dataset) == 0:
+        raise ValueError('Can not build a cache of an empty dataset ({})'.format(path))
+    if not os.path.exists(path):
+        os.makedirs(path)
+    shard, shard_fill, shard_idx, shape = None, 0, 0, None
+    labels = np.zeros(len(dataset), dtype=np.int64)
+    pos = 0
+    for imgs, targets in _uint8_batches(dataset, batch_size, num_workers):
+        labels[pos:pos+len(targets)] = targets
+        pos += len(targets)
+        while len(imgs) > 0:
+            if shard is None:
+                shape = imgs.shape[1:]
+                n = min(shard_size, len(dataset) - shard_idx * shard_size)
+                shard = np.lib.format.open_memmap(os.path.join(path, f'images_{shard_idx:05d}.npy'), mode='w+', dtype=np.uint8, shape=(n,) + shape)
+            take = min(len(shard) - shard_fill, len(imgs))
+            shard[shard_fill:shard_fill+take] = imgs[:take]
+            imgs = imgs[take:]
+            shard_fill += take
+            if shard_fill == len(shard):
+                shard.flush()
+                shard, shard_fill, shard_idx = None, 0, shard_idx + 1
+    np.save(os.path.join(path, 'labels.npy'), labels)
+    # meta-data is written last, a cache without it is considered incomplete
+    with open(os.path.join(path, 'meta.json'), 'w+') as f:
+        json.dump({'n': len(dataset), 'shape': list(shape), 'shard_size': shard_size, 'n_shards': shard_idx}, f)
+
+
+class CachedImageDataset(Dataset):
+    """
+    Dataset reading from a cache built with build_cache. Supports per-sample access (float tensor in [0, 1])
+    as well as get_batch, which gathers a whole batch of indices from the memory-mapped shards.
+    """
+
+    def __init__(self, path) -> None:
+        super().__init__()
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.shard_size = self.meta['shard_size']
+        self.shape = tuple(self.meta['shape'])
+        self.shards = [np.load(os.path.join(path, f'images_{i:05d}.npy'), mmap_mode='r') for i in range(self.meta['n_shards'])]
+        self.targets = torch.from_numpy(np.load(os.path.join(path, 'labels.npy')))
+
+    def __len__(self):
+        return self.meta['n']
+
+    def __getitem__(self, index):
+        index = int(index)
+        img = self.shards[index // self.shard_size][index % self.shard_size]
+        return torch.from_numpy(np.array(img)).float().div_(255.), self.targets[index]
+
+    def get_batch(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long).cpu()
+        inds = indices.numpy()
+        shard_ids, offsets = inds // self.shard_size, inds % self.shard_size
+        out = np.empty((len(inds),) + self.shape, dtype=np.uint8)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            # read the shard in ascending order and restore the order of the batch afterwards
+            order = np.argsort(offsets[mask])
+            imgs = self.shards[shard_id][offsets[mask][order]]
+            out[mask] = imgs[np.argsort(order)]
+        return torch.from_numpy(out).float().div_(255.), self.targets[indices]
+
+
+if __name__ == '__main__':
+    from utils import get_dataset_loder
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='imagenet', type=str)
+    parser.add_argument('--shard-size', default=10000, type=int)
+    parser.add_argument('--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    loader = get_dataset_loder(args.dataset, 1, None, use_cache=False)
+    if loader.cache_dir is None:
+        raise ValueError('{} has no cache'.format(args.dataset))
+    for split, data in (('train', loader.train_data), ('val', loader.val_data)):
+        build_cache(data, os.path.join(loader.cache_dir, split), args.shard_size, num_workers=args.workers)
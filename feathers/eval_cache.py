@@ -0,0 +1,50 @@
+"""
+Memoization of evaluations. The results are keyed by a digest of the content of the weights, s.t. weights which were
+evaluated already (e.g. the global weights restored after an exploration phase) are not evaluated again.
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+def weights_digest(tensors):
+    """
+    Digest of the content of tensors (np.ndarray or encoded bytes).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for t in tensors:
+        if isinstance(t, np.ndarray):
+            h.update('{}{}'.format(t.dtype.str, t.shape).encode())
+            h.update(np.ascontiguousarray(t).reshape(-1).view(np.uint8))
+        else:
+            h.update(len(t).to_bytes(8, 'little'))
+            h.update(t)
+    return h.digest()
+
+
+class EvalCache:
+
+    def __init__(self, capacity=8) -> None:
+        """
+        LRU-cache of evaluation results.
+
+        Args:
+            capacity (int, optional): Number of results kept. Defaults to 8.
+        """
+        self.capacity = capacity
+        self.results = OrderedDict() # key -> result, least recently used first
+        self.hits = 0
+
+    def memoize(self, key, evaluate):
+        """
+        Returns the result stored for key, calls evaluate and stores its result if there is none.
+        """
+        if key in self.results:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return self.results[key]
+        result = evaluate()
+        self.results[key] = result
+        while len(self.results) > self.capacity:
+            self.results.popitem(last=False)
+        return result
@@ -0,0 +1,115 @@
+"""
+Evaluation of the global model in a background process. The worker holds a replica of the server's net and the loader
+of the server's test-set, the strategy submits the weights of a round and starts the next round right away. The worker
+logs the metrics and weight-histograms to tensorboard against the round the weights belong to and persists the model,
+the strategy is called back with the results (genotype logging, results per round).
+"""
+import multiprocessing as mp
+from collections import OrderedDict, deque
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from tensorboardX import SummaryWriter
+import config
+from codec import decode, to_torch
+from helpers import log_model_weights
+from sharded_eval import ShardedEvaluator
+from model_search import prune_ops
+from eval_cache import EvalCache, weights_digest
+from utils import get_dataset_loder, get_data_loader
+
+# state of the worker process
+_NET = None
+_TEST_LOADER = None
+_WRITER = None
+_STAGE = None
+_SHARDED = None
+_CACHE = None
+_LOADED = None # version of the weights held by _NET
+_CHECKPOINT = None # version and path of the last persisted model
+
+
+def _init_worker(net, stage, log_dir):
+    global _NET, _TEST_LOADER, _WRITER, _STAGE, _SHARDED, _CACHE
+    from hanf_strategy import DEVICE
+    _NET = net.to(DEVICE)
+    _STAGE = stage
+    # the strategy has partitioned the data already, the worker reads the partitions from the store
+    test_data = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW).load_server_data()
+    _TEST_LOADER = get_data_loader(test_data, config.BATCH_SIZE, in_memory=config.IN_MEMORY_DATA, device=DEVICE)
+    _WRITER = SummaryWriter(log_dir)
+    if config.EVAL_SHARDS > 0:
+        _SHARDED = ShardedEvaluator(deepcopy(net).cpu(), stage, config.EVAL_SHARDS)
+    if config.EVAL_CACHE_SIZE > 0:
+        _CACHE = EvalCache(config.EVAL_CACHE_SIZE)
+
+def _evaluate(rnd, version, tensors, drop_path_prob, prune_mask=None):
+    global _LOADED, _CHECKPOINT
+    from hanf_strategy import _test
+    if prune_mask is not None:
+        prune_ops(_NET, prune_mask)
+    if version is None or version != _LOADED:
+        params_dict = zip(_NET.state_dict().keys(), tensors)
+        _NET.load_state_dict(OrderedDict({k: to_torch(decode(v)) for k, v in params_dict}), strict=True)
+        _LOADED = version
+    if drop_path_prob is not None:
+        _NET.drop_path_prob = drop_path_prob
+
+    def test():
+        if _SHARDED is not None:
+            return _SHARDED.test(version, tensors, _WRITER, rnd, drop_path_prob, prune_mask)
+        return _test(_NET, _TEST_LOADER, _WRITER, rnd, _STAGE)
+
+    if _CACHE is not None:
+        loss, accuracy, f1_micro, f1_macro = _CACHE.memoize(weights_digest(tensors), test)
+    else:
+        loss, accuracy, f1_micro, f1_macro = test()
+
+    # log metrics to tensorboard
+    _WRITER.add_scalar('Test_Loss', loss, rnd)
+    _WRITER.add_scalar('Test_Accuracy', accuracy, rnd)
+    _WRITER.add_scalar('Test_F1_Micro', f1_micro)
+    _WRITER.add_scalar('Test_F1_Macro', f1_macro)
+    log_model_weights(_NET, rnd, _WRITER)
+
+    # persist model, unless this round's checkpoint holds the version already (exploration)
+    path = './models/net_round_{}'.format(rnd)
+    if version is None or _CHECKPOINT != (version, path):
+        torch.save(_NET, path)
+        _CHECKPOINT = (version, path) if version is not None else None
+    genotype = _NET.genotype() if _STAGE == 'search' else None
+    return rnd, float(loss), {"accuracy": float(accuracy), "f1_micro": f1_micro, "f1_macro": f1_macro}, genotype
+
+
+class EvalWorker:
+
+    def __init__(self, net, stage, log_dir, max_pending=2) -> None:
+        """
+        Background process evaluating the global model.
+
+        Args:
+            net (nn.Module): Replica of the server's net (on the cpu)
+            stage (str): search or valid
+            log_dir (str): Directory of the tensorboard-logs
+            max_pending (int, optional): Maximum number of evaluations queued, submit blocks until an evaluation has
+                                         finished if it is reached. Defaults to 2.
+        """
+        # CUDA can not be used in forked processes
+        self.executor = ProcessPoolExecutor(1, mp_context=mp.get_context('spawn'), initializer=_init_worker,
+                                            initargs=(net, stage, log_dir))
+        self.max_pending = max_pending
+        self.pending = deque()
+
+    def submit(self, rnd, version, tensors, drop_path_prob, callback, prune_mask=None):
+        """
+        Queues the evaluation of tensors (encoded weights of version, of the supernet pruned by prune_mask) for round rnd,
+        callback is called with the future of (rnd, loss, metrics, genotype) once it has finished.
+        """
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().exception()
+        future = self.executor.submit(_evaluate, rnd, version, list(tensors), drop_path_prob, prune_mask)
+        future.add_done_callback(callback)
+        self.pending.append(future)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
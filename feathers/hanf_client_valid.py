@@ -4,11 +4,15 @@ import warnings
 import flwr as fl
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, WeightedRandomSampler
+from torch.utils.data import WeightedRandomSampler
 from torch.autograd import Variable
 import numpy as np
-from utils import get_dataset_loder
+from utils import get_dataset_loder, get_data_loader, materialize
 from rtpt import RTPT
+from codec import CodecClient, to_torch
+from eval_cache import EvalCache, weights_digest
+from downlink import DownlinkDecoder
+from shm_transport import ShmTransport
 import config
 from hyperparameters import Hyperparameters
 from tensorboardX import SummaryWriter
@@ -75,108 +79,162 @@ def train(train_queue, model, criterion, optimizer, device):
 # 2. Federation of the pipeline with Flower
 # #############################################################################
 
-def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_channels=1, out_channels=16, node_nr=7):
+class HANFClient(fl.client.NumPyClient):
+
+    def __init__(self, client_id, data_loader, device, classes=10, cell_nr=4, input_channels=1, out_channels=16, rtpt=None, num_workers=2) -> None:
+        """
+        Flower client training the found architecture on the partition of client_id.
+
+        Args:
+            client_id (int): Id of the client, selects the data-partition
+            data_loader (Loader): Loader of the dataset
+            device (torch.device): Device the model is trained on
+            rtpt (RTPT, optional): Progress reporting, stepped once per epoch. Defaults to None.
+            num_workers (int, optional): Number of DataLoader-workers (0 when hosted in a simulation worker). Defaults to 2.
+        """
+        super().__init__()
+        self.data_loader = data_loader
+        self.device = device
+        self.rtpt = rtpt
+        self.num_workers = num_workers
+        self.hyperparameters = Hyperparameters(config.HYPERPARAM_CONFIG_NR)
+        self.hyperparameters.read_from_csv(config.HYPERPARAM_FILE)
+        self.criterion = torch.nn.BCELoss() if config.CLASSES == 2 else torch.nn.CrossEntropyLoss()
+        self.criterion = self.criterion.to(device)
+        if config.DATASET == 'cifar10' or config.DATASET == 'fmnist':
+            self.model = NetworkCIFAR(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device, in_channels=input_channels)
+        elif config.DATASET == 'imagenet':
+            self.model = NetworkImageNet(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device)
+        elif config.DATASET == 'fraud':
+            self.model = NetworkTabular(config.FRAUD_DETECTION_IN_DIM, classes, cell_nr, genotype=GENOTYPE, device=device)
+        self.model = self.model.to(device)
+        self.eval_cache = EvalCache(config.EVAL_CACHE_SIZE) if config.EVAL_CACHE_SIZE > 0 else None
+        self.hyperparam_config = None
+        self.set_state(None)
+        self.bind(client_id)
+
+    def bind(self, client_id):
+        """
+        (Re-)binds the client to the data-partition of client_id.
+        """
+        self.client_id = client_id
+        self.train_data, self.test_data = self.data_loader.load_client_data(client_id)
+        if config.IN_MEMORY_DATA:
+            self.train_data, self.test_data = materialize(self.train_data, self.device), materialize(self.test_data, self.device)
+        sampler = self._get_sampler(self.data_loader.load_client_labels(client_id)) if config.USE_WEIGHTED_SAMPLER else None
+        self.train_loader = get_data_loader(self.train_data, config.BATCH_SIZE, sampler=sampler, num_workers=self.num_workers)
+        self.val_loader = get_data_loader(self.test_data, config.BATCH_SIZE, num_workers=self.num_workers)
+
+    def get_state(self):
+        """
+        Returns the client-specific training state (optimizer, last hyperparameters and epoch), the model-weights are sent by the server.
+        """
+        return {'optimizer': self.optimizer.state_dict(), 'hyperparam_config': self.hyperparam_config, 'epoch': self.epoch}
+
+    def set_state(self, state):
+        """
+        Restores a state obtained by get_state, None resets the client to a fresh one.
+        """
+        self.optimizer = torch.optim.SGD(self.model.parameters(), 0.01, 0.9, 3e-4)
+        self.epoch = 0
+        self.hyperparam_config = None
+        if state is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+            self.hyperparam_config = state['hyperparam_config']
+            self.epoch = state['epoch']
+
+    def get_parameters(self):
+        return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
+
+    def set_parameters_train(self, parameters, config):
+        # obtain hyperparams and distribution
+        hidx = int(parameters[-1][0])
+        hyperparams = self.hyperparameters[hidx]
+        self.set_current_hyperparameter_config(hyperparams, hidx)
+        
+        # remove hyperparameter distribution from parameter list
+        parameters = parameters[:-1]
+        
+        params_dict = zip(self.model.state_dict().keys(), parameters)
+        state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
+        self.model.load_state_dict(state_dict, strict=True)
+
+    def set_parameters_evaluate(self, parameters):
+        params_dict = zip(self.model.state_dict().keys(), parameters)
+        state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
+        self.model.load_state_dict(state_dict, strict=True)
+
+    def _test_received(self, parameters):
+        """
+        Loss and accuracy of the weights received from the server (loaded into the model), memoized by their digest.
+        """
+        if self.eval_cache is None:
+            return _test(self.model, self.val_loader, self.device)
+        key = (self.client_id, weights_digest(parameters[:len(self.model.state_dict())]))
+        return self.eval_cache.memoize(key, lambda: _test(self.model, self.val_loader, self.device))
+
+    def fit(self, parameters, cfg):
+        self.set_parameters_train(parameters, cfg)
+        before_loss, _ = self._test_received(parameters)
+        for e in range(EPOCHS):
+            if self.rtpt is not None:
+                self.rtpt.step()
+            self.epoch += 1
+            self.model.drop_path_prob = self.hyperparam_config['dropout']
+            self.model = train(self.train_loader, self.model, self.criterion, self.optimizer, self.device)
+        after_loss, _ = _test(self.model, self.val_loader, self.device)
+        model_params = self.get_parameters()
+        return model_params, len(self.train_data), {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss)}
+
+    def evaluate(self, parameters, config):
+        if self.hyperparam_config is not None:
+            self.model.drop_path_prob = self.hyperparam_config['dropout']
+        else:
+            self.model.drop_path_prob = 0.2 # just to ensure that in initial evaluation there's a value set
+        self.set_parameters_evaluate(parameters)
+        loss, accuracy = self._test_received(parameters)
+        return float(loss), len(self.test_data), {"accuracy": float(accuracy)}
+
+    def set_current_hyperparameter_config(self, hyperparam, idx):
+        self.hyperparam_config = hyperparam
+        self.hidx = idx
+        for g in self.optimizer.param_groups:
+            g['lr'] = self.hyperparam_config['learning_rate']
+            g['momentum'] = self.hyperparam_config['momentum']
+            g['weight_decay'] = self.hyperparam_config['weight_decay']
+
+    def _get_sampler(self, targets):
+        class_count = torch.from_numpy(self.data_loader.label_histogram(self.client_id))
+        weight = 1 / class_count
+        samples_weight = weight[targets].double()
+        sampler = WeightedRandomSampler(samples_weight, len(samples_weight))
+        return sampler
+
+
+def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_channels=1, out_channels=16, node_nr=7, shared_data=False):
     """Create model, load data, define Flower client, start Flower client."""
 
     # Load data
-    data_loader = get_dataset_loder(dataset, num_clients, config.DATASET_INDS_FILE, skew=config.DATA_SKEW)
-    train_data, test_data = data_loader.load_client_data(client_id)
+    data_loader = get_dataset_loder(dataset, num_clients, config.DATASET_INDS_FILE, skew=config.DATA_SKEW, shared=shared_data)
     date = dt.strftime(dt.now(), '%Y:%m:%d:%H:%M:%S')
     writer = SummaryWriter("./runs/Client_val_{}".format(date))
     rtpt = RTPT('JS', 'HANF_Client', EPOCHS)
     rtpt.start()
 
-    # Flower client
-    class HANFClient(fl.client.NumPyClient):
-
-        def __init__(self, *args, **kwargs) -> None:
-            super().__init__(*args, **kwargs)
-            self.epoch = 0
-            self.hyperparameters = Hyperparameters(config.HYPERPARAM_CONFIG_NR)
-            self.hyperparameters.read_from_csv(config.HYPERPARAM_FILE)
-            self.criterion = torch.nn.BCELoss() if config.CLASSES == 2 else torch.nn.CrossEntropyLoss()
-            self.criterion = self.criterion.to(device)
-            if config.DATASET == 'cifar10' or config.DATASET == 'fmnist':
-                self.model = NetworkCIFAR(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device, in_channels=input_channels)
-            elif config.DATASET == 'imagenet':
-                self.model = NetworkImageNet(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device)
-            elif config.DATASET == 'fraud':
-                self.model = NetworkTabular(config.FRAUD_DETECTION_IN_DIM, classes, cell_nr, genotype=GENOTYPE, device=device)
-            self.model = self.model.to(device)
-            self.optimizer = torch.optim.SGD(self.model.parameters(), 0.01, 0.9, 3e-4)
-            sampler = self._get_sampler(train_data) if config.USE_WEIGHTED_SAMPLER else None
-            self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, sampler=sampler)
-            self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2)
-            self.hyperparam_config = None
-
-        def get_parameters(self):
-            return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
-
-        def set_parameters_train(self, parameters, config):
-            # obtain hyperparams and distribution
-            hidx = int(parameters[-1][0])
-            hyperparams = self.hyperparameters[hidx]
-            self.set_current_hyperparameter_config(hyperparams, hidx)
-            
-            # remove hyperparameter distribution from parameter list
-            parameters = parameters[:-1]
-            
-            params_dict = zip(self.model.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
-            self.model.load_state_dict(state_dict, strict=True)
-
-        def set_parameters_evaluate(self, parameters):
-            params_dict = zip(self.model.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
-            self.model.load_state_dict(state_dict, strict=True)
-
-        def fit(self, parameters, cfg):
-            self.set_parameters_train(parameters, cfg)
-            before_loss, _ = _test(self.model, self.val_loader, device)
-            for e in range(EPOCHS):
-                rtpt.step()
-                self.epoch += 1
-                self.model.drop_path_prob = self.hyperparam_config['dropout']
-                self.model = train(self.train_loader, self.model, self.criterion, self.optimizer, device)
-            after_loss, _ = _test(self.model, self.val_loader, device)
-            model_params = self.get_parameters()
-            return model_params, len(train_data), {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss)}
-
-        def evaluate(self, parameters, config):
-            if self.hyperparam_config is not None:
-                self.model.drop_path_prob = self.hyperparam_config['dropout']
-            else:
-                self.model.drop_path_prob = 0.2 # just to ensure that in initial evaluation there's a value set
-            self.set_parameters_evaluate(parameters)
-            loss, accuracy = _test(self.model, self.val_loader, device)
-            return float(loss), len(test_data), {"accuracy": float(accuracy)}
-
-        def set_current_hyperparameter_config(self, hyperparam, idx):
-            self.hyperparam_config = hyperparam
-            self.hidx = idx
-            for g in self.optimizer.param_groups:
-                g['lr'] = self.hyperparam_config['learning_rate']
-                g['momentum'] = self.hyperparam_config['momentum']
-                g['weight_decay'] = self.hyperparam_config['weight_decay']
-
-        def _get_sampler(self, training_data):
-            targets = training_data.dataset.y[training_data.indices]
-            class_count = torch.tensor([len(targets[targets == t]) for t in torch.unique(targets)])
-            weight = 1 / class_count
-            samples_weight = torch.tensor([weight[t] for t in targets]).double()
-            sampler = WeightedRandomSampler(samples_weight, len(samples_weight))
-            return sampler
-            
     # Start client
-    fl.client.start_numpy_client("[::]:{}".format(config.PORT), client=HANFClient())
+    client = HANFClient(client_id, data_loader, device, classes, cell_nr, input_channels, out_channels, rtpt=rtpt)
+    transport = ShmTransport('feathers_up', reuse=True) if config.SHM_TRANSPORT else None
+    fl.client.start_client("[::]:{}".format(config.PORT), client=CodecClient(client, upload_mode=config.UPLOAD_COMPRESSION, downlink=DownlinkDecoder(), transport=transport),
+        grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', default='0', type=str)
     parser.add_argument('--id', type=int)
+    parser.add_argument('--shared-data', action='store_true') # attach to the dataset shared by clients.py
 
     args = parser.parse_args()
     device = torch.device('cuda:{}'.format(args.gpu))
     main(config.DATASET, config.CLIENT_NR, device, args.id, config.CLASSES, config.CELL_NR, 
-        config.IN_CHANNELS, config.OUT_CHANNELS, config.NODE_NR)
\ No newline at end of file
+        config.IN_CHANNELS, config.OUT_CHANNELS, config.NODE_NR, args.shared_data)
\ No newline at end of file
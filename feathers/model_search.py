@@ -6,26 +6,99 @@ from genotypes import PRIMITIVES, TABULAR_PRIMITIVES
 from genotypes import Genotype
 
 
+def sample_ops(alphas, k, tau, sample=True):
+  """
+  Gumbel-softmax with straight-through estimator (GDAS). Selects k ops per edge (rows of alphas), the top-k of the
+  alphas perturbed by Gumbel noise (of the alphas if not sample). Returns the weights, which are renormalized over the
+  selected ops (zero for the others) in the forward pass and those of the soft sample in the backward pass, and the
+  indices of the selected ops per edge.
+  """
+  logits = alphas
+  if sample:
+    logits = alphas - torch.empty_like(alphas).exponential_().log()
+  y = F.softmax(logits / tau, dim=-1)
+  selected = y.topk(k, dim=-1).indices
+  hard = torch.zeros_like(y).scatter_(-1, selected, y.detach().gather(-1, selected))
+  hard = hard / hard.sum(dim=-1, keepdim=True)
+  return hard - y.detach() + y, selected.tolist()
+
+
+def significant_ops(weights, epsilon, skip):
+  """
+  Indices of the ops per edge (rows of weights) whose weight is at least epsilon, except skip (none), at least the one
+  with the highest weight.
+  """
+  selected = []
+  for w in weights.tolist():
+    ops = [k for k, v in enumerate(w) if v >= epsilon and k != skip]
+    selected.append(ops or [max((k for k in range(len(w)) if k != skip), key=w.__getitem__)])
+  return selected
+
+
+def mix(ops, x, weights, indices):
+  """
+  Weighted sum of the outputs of ops[k] for k in indices, accumulated in place into the first one. Zero ops (none) are
+  skipped.
+  """
+  out = None
+  for k in indices:
+    op = ops[k]
+    if isinstance(op, (Zero, TabZero)):
+      continue
+    if out is None:
+      out = weights[k] * op(x)
+    else:
+      out.addcmul_(op(x), weights[k])
+  if out is None:
+    # none only
+    return weights[indices[0]] * ops[indices[0]](x)
+  return out
+
+
+def channel_shuffle(x, groups):
+  batch, channels, height, width = x.size()
+  x = x.view(batch, groups, channels // groups, height, width)
+  return x.transpose(1, 2).contiguous().view(batch, channels, height, width)
+
+
 class MixedOp(nn.Module):
 
-  def __init__(self, C, stride):
+  def __init__(self, C, stride, partial_channels=1):
     super(MixedOp, self).__init__()
     self._ops = nn.ModuleList()
+    self._k = partial_channels
+    if partial_channels > 1:
+      # downsamples the channels bypassing the ops on reduction edges
+      self.mp = nn.MaxPool2d(2, 2, ceil_mode=True)
     for primitive in PRIMITIVES:
-      op = OPS[primitive](C, stride, False)
+      op = OPS[primitive](C // partial_channels, stride, False)
       if 'pool' in primitive:
-        op = nn.Sequential(op, nn.BatchNorm2d(C, affine=False))
+        op = nn.Sequential(op, nn.BatchNorm2d(C // partial_channels, affine=False))
       self._ops.append(op)
+    self._active = list(range(len(self._ops))) # ops not pruned (see prune_ops)
+
+  def _mix(self, x, weights, selected):
+    # single-path mode or eval mode with an epsilon, only the selected ops are executed
+    return mix(self._ops, x, weights, self._active if selected is None else selected)
 
-  def forward(self, x, weights):
-    return sum(w * op(x) for w, op in zip(weights, self._ops))
+  def forward(self, x, weights, selected=None):
+    if self._k == 1:
+      return self._mix(x, weights, selected)
+    # partial channels (PC-DARTS), 1/k of the channels pass through the ops, the others bypass them
+    C = x.shape[1] // self._k
+    out = self._mix(x[:, :C], weights, selected)
+    bypass = x[:, C:]
+    if out.shape[2] != x.shape[2]:
+      bypass = self.mp(bypass)
+    return channel_shuffle(torch.cat([out, bypass], dim=1), self._k)
 
 
 class Cell(nn.Module):
 
-  def __init__(self, steps, multiplier, C_prev_prev, C_prev, C, reduction, reduction_prev):
+  def __init__(self, steps, multiplier, C_prev_prev, C_prev, C, reduction, reduction_prev, partial_channels=1, fused=False):
     super(Cell, self).__init__()
     self.reduction = reduction
+    self.fused = fused # run the MixedOps reading the same state together (see _forward_fused)
 
     if reduction_prev:
       self.preprocess0 = FactorizedReduce(C_prev_prev, C, affine=False)
@@ -40,26 +113,83 @@ class Cell(nn.Module):
     for i in range(self._steps):
       for j in range(2+i):
         stride = 2 if reduction and j < 2 else 1
-        op = MixedOp(C, stride)
+        op = MixedOp(C, stride, partial_channels)
         self._ops.append(op)
 
-  def forward(self, s0, s1, weights):
+  def forward(self, s0, s1, weights, selected=None, edge_weights=None):
     s0 = self.preprocess0(s0)
     s1 = self.preprocess1(s1)
+    if self.fused:
+      return self._forward_fused(s0, s1, weights, selected, edge_weights)
 
     states = [s0, s1]
     offset = 0
     for i in range(self._steps):
-      s = sum(self._ops[offset+j](h, weights[offset+j]) for j, h in enumerate(states))
+      s = sum(self._ops[offset+j](h, weights[offset+j], None if selected is None else selected[offset+j])
+              * (1 if edge_weights is None else edge_weights[offset+j]) for j, h in enumerate(states))
       offset += len(states)
       states.append(s)
 
     return torch.cat(states[-self._multiplier:], dim=1)
 
+  def _forward_fused(self, s0, s1, weights, selected, edge_weights):
+    # state-major: once a state is computed all edges reading it run as one batch, node i is complete after state i+1
+    states = [s0, s1]
+    nodes = [0] * self._steps
+    for j in range(self._steps + 1):
+      edges = [(i, 2 * i + i * (i - 1) // 2 + j) for i in range(max(0, j - 1), self._steps)]
+      outs = self._edge_batch(states[j], [e for _, e in edges], weights, selected)
+      for (i, e), out in zip(edges, outs):
+        nodes[i] = nodes[i] + out * (1 if edge_weights is None else edge_weights[e])
+      if j > 0:
+        states.append(nodes[j - 1])
+
+    return torch.cat(states[-self._multiplier:], dim=1)
+
+  def _edge_batch(self, x, edges, weights, selected):
+    """
+    Equivalent of the MixedOps of edges on their shared input x, each primitive is run for all edges at once (see
+    run_stacked), the parameter-free ops once per state. Returns the output of each edge.
+    """
+    mixed_ops = [self._ops[e] for e in edges]
+    k = mixed_ops[0]._k
+    inp = x if k == 1 else x[:, :x.shape[1] // k]
+    executed = [mixed_op._active if selected is None else selected[e] for mixed_op, e in zip(mixed_ops, edges)]
+    shared, acc = {}, None
+    for p in range(len(PRIMITIVES)):
+      members = [n for n, ops in enumerate(executed) if p in ops]
+      if not members:
+        continue
+      out = run_stacked(inp, [mixed_ops[n]._ops[p] for n in members], shared)
+      if out is None:
+        continue
+      out = out * weights[[edges[n] for n in members], p].view(1, -1, 1, 1, 1)
+      if len(members) < len(edges):
+        index = torch.tensor(members, device=out.device)
+        if acc is None:
+          acc = out.new_zeros(out.shape[0], len(edges), *out.shape[2:])
+        acc = acc.index_add(1, index, out)
+      else:
+        acc = out if acc is None else acc + out
+    if acc is None:
+      # all edges executed none only
+      acc = mixed_ops[0]._ops[executed[0][0]](inp).unsqueeze(1).expand(-1, len(edges), -1, -1, -1)
+    outs = acc.unbind(1)
+    if k == 1:
+      return outs
+    # partial channels, the bypassed channels are shared by the edges
+    bypass = x[:, inp.shape[1]:]
+    if outs[0].shape[2] != x.shape[2]:
+      bypass = mixed_ops[0].mp(bypass)
+    return [channel_shuffle(torch.cat([out, bypass], dim=1), k) for out in outs]
+
 
 class Network(nn.Module):
 
-  def __init__(self, C, num_classes, layers, criterion, device, in_channels=3, steps=4, multiplier=4, stem_multiplier=3):
+  _primitives = PRIMITIVES
+
+  def __init__(self, C, num_classes, layers, criterion, device, in_channels=3, steps=4, multiplier=4, stem_multiplier=3, sampled_ops=0, tau=1.0,
+               partial_channels=1, fused_cells=False, eval_epsilon=0.0):
     super(Network, self).__init__()
     self._C = C
     self._num_classes = num_classes
@@ -67,6 +197,11 @@ class Network(nn.Module):
     self._criterion = criterion
     self._steps = steps
     self._multiplier = multiplier
+    self._sampled_ops = sampled_ops # ops executed per edge (see sample_ops), 0 executes all of them (DARTS)
+    self.tau = tau
+    self._partial_channels = partial_channels # 1/partial_channels of the channels pass through the MixedOps, the edges are normalized
+    self._fused_cells = fused_cells # the cells run the MixedOps reading the same state together
+    self._eval_epsilon = eval_epsilon # in eval mode ops with a lower weight are not executed
     self.device = device
 
     C_curr = stem_multiplier*C
@@ -84,7 +219,11 @@ class Network(nn.Module):
         reduction = True
       else:
         reduction = False
-      cell = Cell(steps, multiplier, C_prev_prev, C_prev, C_curr, reduction, reduction_prev)
+      if C_curr % partial_channels != 0 or (reduction and C_curr // partial_channels % 2 != 0):
+        # the ops of a MixedOp get C_curr / partial_channels channels, those of reduction cells must be even (FactorizedReduce)
+        raise ValueError('PARTIAL_CHANNELS = {} does not divide the {} channels of cell {}{}'.format(
+          partial_channels, C_curr, i, ' into an even number' if C_curr % partial_channels == 0 else ''))
+      cell = Cell(steps, multiplier, C_prev_prev, C_prev, C_curr, reduction, reduction_prev, partial_channels, fused_cells)
       reduction_prev = reduction
       self.cells += [cell]
       C_prev_prev, C_prev = C_prev, multiplier*C_curr
@@ -95,19 +234,44 @@ class Network(nn.Module):
     self._initialize_alphas()
 
   def new(self):
-    model_new = Network(self._C, self._num_classes, self._layers, self._criterion, self.device).to(self.device)
+    model_new = Network(self._C, self._num_classes, self._layers, self._criterion, self.device,
+                        sampled_ops=self._sampled_ops, tau=self.tau, partial_channels=self._partial_channels,
+                        fused_cells=self._fused_cells, eval_epsilon=self._eval_epsilon).to(self.device)
+    prune_ops(model_new, pruned_ops(self))
     for x, y in zip(model_new.arch_parameters(), self.arch_parameters()):
         x.data.copy_(y.data)
     return model_new
 
+  def _mixing_weights(self, alphas, pruned):
+    if self._pruning:
+      alphas = alphas.masked_fill(pruned, float('-inf'))
+    if self._sampled_ops == 0:
+      weights = F.softmax(alphas, dim=-1)
+      if self.training or self._eval_epsilon == 0:
+        return weights, None
+      # the insignificant ops are skipped, selected once per forward pass
+      return weights, significant_ops(weights, self._eval_epsilon, self._primitives.index('none'))
+    # sampled once per forward pass and shared by all cells of a type, the ops with the highest alphas in eval mode
+    return sample_ops(alphas, self._sampled_ops, self.tau, sample=self.training)
+
+  def _edge_weights(self, betas):
+    # edge normalization (PC-DARTS), softmax over the edges into each node
+    weights, start = [], 0
+    for i in range(self._steps):
+      end = start + 2 + i
+      weights.append(F.softmax(betas[start:end], dim=-1))
+      start = end
+    return torch.cat(weights)
+
   def forward(self, input):
     s0 = s1 = self.stem(input)
+    normal, reduce = self._mixing_weights(self.alphas_normal, self._pruned[0]), self._mixing_weights(self.alphas_reduce, self._pruned[1])
+    edges_normal = edges_reduce = None
+    if self._partial_channels > 1:
+      edges_normal, edges_reduce = self._edge_weights(self.betas_normal), self._edge_weights(self.betas_reduce)
     for i, cell in enumerate(self.cells):
-      if cell.reduction:
-        weights = F.softmax(self.alphas_reduce, dim=-1)
-      else:
-        weights = F.softmax(self.alphas_normal, dim=-1)
-      s0, s1 = s1, cell(s0, s1, weights)
+      weights, selected = reduce if cell.reduction else normal
+      s0, s1 = s1, cell(s0, s1, weights, selected, edges_reduce if cell.reduction else edges_normal)
     out = self.global_pooling(s1)
     logits = self.classifier(out.view(out.size(0),-1))
     return logits
@@ -126,6 +290,14 @@ class Network(nn.Module):
       self.alphas_normal,
       self.alphas_reduce,
     ]
+    # ops of the normal and reduce edges dropped by progressive pruning, not part of the state_dict
+    self.register_buffer('_pruned', torch.zeros(2, k, num_ops, dtype=torch.bool, device=self.device), persistent=False)
+    self._pruning = False
+    if self._partial_channels > 1:
+      # part of the state_dict, aggregated by the server like the alphas
+      self.betas_normal = nn.Parameter(1e-3*torch.randn(k).to(self.device), requires_grad=True)
+      self.betas_reduce = nn.Parameter(1e-3*torch.randn(k).to(self.device), requires_grad=True)
+      self._arch_parameters += [self.betas_normal, self.betas_reduce]
 
   def arch_parameters(self):
     return self._arch_parameters
@@ -151,8 +323,14 @@ class Network(nn.Module):
         n += 1
       return gene
 
-    gene_normal = _parse(F.softmax(self.alphas_normal, dim=-1).data.cpu().numpy())
-    gene_reduce = _parse(F.softmax(self.alphas_reduce, dim=-1).data.cpu().numpy())
+    normal = F.softmax(self.alphas_normal.masked_fill(self._pruned[0], float('-inf')), dim=-1)
+    reduce = F.softmax(self.alphas_reduce.masked_fill(self._pruned[1], float('-inf')), dim=-1)
+    if self._partial_channels > 1:
+      # edges are selected by their op-weights scaled by the edge-weights
+      normal = normal * self._edge_weights(self.betas_normal).unsqueeze(-1)
+      reduce = reduce * self._edge_weights(self.betas_reduce).unsqueeze(-1)
+    gene_normal = _parse(normal.data.cpu().numpy())
+    gene_reduce = _parse(reduce.data.cpu().numpy())
 
     concat = range(2+self._steps-self._multiplier, self._steps+2)
     genotype = Genotype(
@@ -169,9 +347,10 @@ class TabularMixedOp(nn.Module):
     for primitive in TABULAR_PRIMITIVES:
       op = TABOPS[primitive](dim, dim)
       self._ops.append(op)
+    self._active = list(range(len(self._ops)))
 
-  def forward(self, x, weights):
-    return sum(w * op(x) for w, op in zip(weights, self._ops))
+  def forward(self, x, weights, selected=None):
+    return mix(self._ops, x, weights, self._active if selected is None else selected)
 
 class TabularCell(nn.Module):
   def __init__(self, steps, out_prev_prev, out_prev, out_curr, reduction, reduction_prev):
@@ -200,13 +379,13 @@ class TabularCell(nn.Module):
         op = TabularMixedOp(out_curr)
         self._ops.append(op)
 
-  def forward(self, s0, s1, weights):
+  def forward(self, s0, s1, weights, selected=None):
     s0 = self.preprocess(s0)
 
     states = [self.reduction(s0), self.reduction(s1)]
     offset = 0
     for i in range(self._steps):
-      s = sum(self._ops[offset+j](h, weights[offset+j]) for j, h in enumerate(states))
+      s = sum(self._ops[offset+j](h, weights[offset+j], None if selected is None else selected[offset+j]) for j, h in enumerate(states))
       offset += len(states)
       states.append(s)
 
@@ -214,7 +393,10 @@ class TabularCell(nn.Module):
 
 
 class TabularNetwork(nn.Module):
-  def __init__(self, steps, in_dim, num_classes, layers, criterion, device):
+
+  _primitives = TABULAR_PRIMITIVES
+
+  def __init__(self, steps, in_dim, num_classes, layers, criterion, device, sampled_ops=0, tau=1.0, eval_epsilon=0.0):
     super(TabularNetwork, self).__init__()
     self.in_dime = in_dim
     self._num_classes = num_classes
@@ -222,6 +404,9 @@ class TabularNetwork(nn.Module):
     self._criterion = criterion
     self.device = device
     self._steps = steps
+    self._sampled_ops = sampled_ops
+    self.tau = tau
+    self._eval_epsilon = eval_epsilon
  
     dim_prev_prev, dim_prev, dim_curr = in_dim, in_dim, in_dim
     self.cells = nn.ModuleList()
@@ -245,14 +430,23 @@ class TabularNetwork(nn.Module):
 
     self._initialize_alphas()
 
+  def _mixing_weights(self, alphas, pruned):
+    if self._pruning:
+      alphas = alphas.masked_fill(pruned, float('-inf'))
+    if self._sampled_ops == 0:
+      weights = F.softmax(alphas, dim=-1)
+      if self.training or self._eval_epsilon == 0:
+        return weights, None
+      # the insignificant ops are skipped, selected once per forward pass
+      return weights, significant_ops(weights, self._eval_epsilon, self._primitives.index('none'))
+    return sample_ops(alphas, self._sampled_ops, self.tau, sample=self.training)
+
   def forward(self, input):
     s0 = s1 = input
+    normal, reduce = self._mixing_weights(self.alphas_normal, self._pruned[0]), self._mixing_weights(self.alphas_reduce, self._pruned[1])
     for i, cell in enumerate(self.cells):
-      if cell.reduction:
-        weights = F.softmax(self.alphas_reduce, dim=-1)
-      else:
-        weights = F.softmax(self.alphas_normal, dim=-1)
-      s0, s1 = s1, cell(s0, s1, weights)
+      weights, selected = reduce if cell.reduction else normal
+      s0, s1 = s1, cell(s0, s1, weights, selected)
     logits = self.classifier(s1)
     if self._num_classes == 2:
       return torch.sigmoid(torch.squeeze(logits))
@@ -273,6 +467,8 @@ class TabularNetwork(nn.Module):
       self.alphas_normal,
       self.alphas_reduce,
     ]
+    self.register_buffer('_pruned', torch.zeros(2, k, num_ops, dtype=torch.bool, device=self.device), persistent=False)
+    self._pruning = False
 
   def arch_parameters(self):
     return self._arch_parameters
@@ -298,12 +494,79 @@ class TabularNetwork(nn.Module):
         n += 1
       return gene
 
-    gene_normal = _parse(F.softmax(self.alphas_normal, dim=-1).data.cpu().numpy())
-    gene_reduce = _parse(F.softmax(self.alphas_reduce, dim=-1).data.cpu().numpy())
+    gene_normal = _parse(F.softmax(self.alphas_normal.masked_fill(self._pruned[0], float('-inf')), dim=-1).data.cpu().numpy())
+    gene_reduce = _parse(F.softmax(self.alphas_reduce.masked_fill(self._pruned[1], float('-inf')), dim=-1).data.cpu().numpy())
 
     concat = range(2+self._steps, self._steps+2)
     genotype = Genotype(
       normal=gene_normal, normal_concat=concat,
       reduce=gene_reduce, reduce_concat=concat
     )
-    return genotype
\ No newline at end of file
+    return genotype
+
+
+def branch_mask(net, threshold):
+  """
+  Returns for each entry of the state_dict of the supernet net (Network or TabularNetwork) whether it is uploaded
+  in a sparse upload, i.e. it does not belong to a branch of a MixedOp whose softmax-weight is below threshold.
+  """
+  normal = F.softmax(net.alphas_normal, dim=-1).detach().cpu().numpy()
+  reduce = F.softmax(net.alphas_reduce, dim=-1).detach().cpu().numpy()
+  weights = {}
+  for i, cell in enumerate(net.cells):
+    alphas = reduce if cell.reduction else normal # as chosen by forward
+    for e, mixed_op in enumerate(cell._ops):
+      for k in range(len(mixed_op._ops)):
+        weights['cells.{}._ops.{}._ops.{}'.format(i, e, k)] = alphas[e][k]
+  return [weights.get('.'.join(key.split('.')[:6]), threshold) >= threshold for key in net.state_dict().keys()]
+
+
+class PrunedOp(nn.Module):
+  """
+  Placeholder of an op dropped from a MixedOp, keeps the indices of the remaining ops (and their keys in the state_dict).
+  """
+
+  def forward(self, x):
+    raise RuntimeError('pruned op executed')
+
+
+def pruned_ops(net):
+  """
+  Returns the ops pruned from the supernet net (Network or TabularNetwork) as string of 0/1 per op of each edge, normal
+  edges followed by reduce edges (sent to the clients in the config of the instructions).
+  """
+  return ''.join('1' if p else '0' for p in net._pruned.flatten().tolist())
+
+def prune_mask(net, keep):
+  """
+  Returns the ops pruned (see pruned_ops) if only the keep ops with the highest weights per edge remain in net, none is
+  pruned first. Ops pruned already stay pruned.
+  """
+  keep = max(keep, net._sampled_ops, 1)
+  none = net._primitives.index('none')
+  pruned = net._pruned.clone()
+  for i, alphas in enumerate([net.alphas_normal, net.alphas_reduce]):
+    scores = alphas.detach().masked_fill(pruned[i], float('-inf'))
+    scores[:, none] = float('-inf')
+    order = scores.argsort(dim=-1, descending=True)
+    pruned[i].scatter_(-1, order[:, keep:], True)
+  return ''.join('1' if p else '0' for p in pruned.flatten().tolist())
+
+def prune_ops(net, mask):
+  """
+  Drops the ops pruned by mask (see pruned_ops) from the MixedOps of net, their weights are removed from the state_dict.
+  Returns whether ops were dropped.
+  """
+  if mask is None or mask == pruned_ops(net):
+    return False
+  pruned = torch.tensor([c == '1' for c in mask], dtype=torch.bool, device=net._pruned.device).view_as(net._pruned)
+  for cell in net.cells:
+    edges = pruned[1] if cell.reduction else pruned[0] # as chosen by forward
+    for e, mixed_op in enumerate(cell._ops):
+      for k in range(len(mixed_op._ops)):
+        if edges[e][k] and not isinstance(mixed_op._ops[k], PrunedOp):
+          mixed_op._ops[k] = PrunedOp()
+      mixed_op._active = [k for k in range(len(mixed_op._ops)) if not edges[e][k]]
+  net._pruned.copy_(pruned)
+  net._pruning = True
+  return True
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 OPS = {
   'none' : lambda C, stride, affine: Zero(stride),
@@ -213,4 +214,96 @@ class TanhLNRedDim(nn.Module):
   def forward(self, x):
     x = self.linear1(x)
     x = torch.tanh(x)
-    return torch.tanh(self.linear2(x))
\ No newline at end of file
+    return torch.tanh(self.linear2(x))
+
+
+def _stacked_conv(x, convs, groups):
+  """
+  Runs the convs (of the same shape) as one convolution on x, which holds groups inputs stacked along the channels (one
+  shared input if groups == 1). The outputs are stacked along the channels in the order of convs.
+  """
+  conv = convs[0]
+  weight = torch.cat([c.weight for c in convs]) if len(convs) > 1 else conv.weight
+  bias = None if conv.bias is None else torch.cat([c.bias for c in convs])
+  return F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups * groups)
+
+
+def _stacked_batch_norm(x, bns):
+  """
+  Runs the batch norms as one on x, which holds their inputs stacked along the channels. The running statistics of the
+  batch norms are updated as by their forward.
+  """
+  bn = bns[0]
+  cat = lambda tensors: None if tensors[0] is None else torch.cat(tensors)
+  update = bn.training and bn.track_running_stats
+  momentum = 0.0 if bn.momentum is None else bn.momentum
+  if update:
+    for b in bns:
+      b.num_batches_tracked.add_(1)
+    if bn.momentum is None:
+      momentum = 1.0 / float(bn.num_batches_tracked)
+  running_mean, running_var = cat([b.running_mean for b in bns]), cat([b.running_var for b in bns])
+  out = F.batch_norm(x, running_mean, running_var, cat([b.weight for b in bns]), cat([b.bias for b in bns]),
+                     bn.training or running_mean is None, momentum, bn.eps)
+  if update:
+    for b, mean, var in zip(bns, running_mean.chunk(len(bns)), running_var.chunk(len(bns))):
+      b.running_mean.copy_(mean)
+      b.running_var.copy_(var)
+  return out
+
+
+_PARAMETER_FREE = (nn.ReLU, nn.MaxPool2d, nn.AvgPool2d)
+
+
+def _layers(op):
+  """
+  Layers of op if it can be run stacked with the same op of other edges, None otherwise.
+  """
+  if isinstance(op, (SepConv, DilConv)):
+    return list(op.op)
+  if isinstance(op, Identity):
+    return []
+  if isinstance(op, nn.Sequential) and all(isinstance(l, _PARAMETER_FREE + (nn.Conv2d, nn.BatchNorm2d)) for l in op):
+    return list(op)
+  return None
+
+
+def run_stacked(x, ops, shared):
+  """
+  Runs ops (the same primitive on different edges) on their shared input x with as few kernels as possible. Leading
+  parameter-free layers are run once and memoized in shared (a dict per input, s.t. the primitives of the edges share
+  them too), layers with parameters once for all ops (convolutions grouped, batch norms on the stacked channels).
+
+  Returns the outputs of the ops stacked along dim 1, of size 1 if they are identical, or None if they are zero.
+  """
+  if isinstance(ops[0], Zero):
+    return None
+  layers = [_layers(op) for op in ops]
+  if layers[0] is None:
+    return torch.stack([op(x) for op in ops], dim=1)
+  n, stacked, prefix = len(ops), False, ()
+  for l, layer in enumerate(layers[0]):
+    if not stacked:
+      if isinstance(layer, _PARAMETER_FREE):
+        prefix += (repr(layer),)
+        if prefix not in shared:
+          shared[prefix] = layer(x)
+        x = shared[prefix]
+        continue
+      stacked = True
+      if isinstance(layer, nn.Conv2d) and layer.groups == 1:
+        # reads all channels of the shared input, the outputs of the ops are stacked
+        x = _stacked_conv(x, [layers_op[l] for layers_op in layers], 1)
+        continue
+      if prefix + ('repeat', n) not in shared:
+        shared[prefix + ('repeat', n)] = x.repeat(1, n, 1, 1)
+      x = shared[prefix + ('repeat', n)]
+    if isinstance(layer, nn.Conv2d):
+      x = _stacked_conv(x, [layers_op[l] for layers_op in layers], n)
+    elif isinstance(layer, nn.BatchNorm2d):
+      x = _stacked_batch_norm(x, [layers_op[l] for layers_op in layers])
+    else:
+      x = layer(x)
+  if not stacked:
+    return x.unsqueeze(1)
+  return x.view(x.shape[0], n, -1, *x.shape[2:])
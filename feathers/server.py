@@ -9,13 +9,16 @@ from helpers import prepare_log_dirs
 import argparse
 from genotypes import GENOTYPE
 
-def start_server_search(rounds):
-    device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) 
+def get_strategy_search():
+    device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) if torch.cuda.is_available() else torch.device('cpu')
     criterion = nn.CrossEntropyLoss()
     if config.DATASET == 'fraud':
-        net = TabularNetwork(config.NODE_NR, config.FRAUD_DETECTION_IN_DIM, config.CLASSES, config.CELL_NR, criterion, device=device)
+        net = TabularNetwork(config.NODE_NR, config.FRAUD_DETECTION_IN_DIM, config.CLASSES, config.CELL_NR, criterion, device=device,
+                             sampled_ops=config.SAMPLED_OPS, tau=config.GUMBEL_TAU, eval_epsilon=config.MIX_EPSILON)
     else:        
-        net = Network(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, criterion, device, in_channels=config.IN_CHANNELS, steps=config.NODE_NR)
+        net = Network(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, criterion, device, in_channels=config.IN_CHANNELS, steps=config.NODE_NR,
+                      sampled_ops=config.SAMPLED_OPS, tau=config.GUMBEL_TAU, partial_channels=config.PARTIAL_CHANNELS,
+                      fused_cells=config.FUSED_CELLS, eval_epsilon=config.MIX_EPSILON)
 
     # prepare log-directories
     prepare_log_dirs()
@@ -32,16 +35,35 @@ def start_server_search(rounds):
         stage='search',
         gamma=config.GAMMA,
     )
+    return strategy
+
+def shutdown_strategy(strategy):
+    """
+    Releases the worker processes and the shared memory of the strategy once the federation has ended.
+    """
+    if strategy.eval_worker is not None:
+        strategy.eval_worker.shutdown() # wait for the evaluation of the last rounds
+    if strategy.sharded_eval is not None:
+        strategy.sharded_eval.shutdown()
+    if strategy.transport is not None:
+        strategy.transport.close()
+
+def start_server_search(rounds):
+    strategy = get_strategy_search()
 
     # Start server
-    fl.server.start_server(
-        server_address="[::]:{}".format(config.PORT),
-        config={"num_rounds": rounds},
-        strategy=strategy,
-    )
+    try:
+        fl.server.start_server(
+            server_address="[::]:{}".format(config.PORT),
+            config={"num_rounds": rounds},
+            strategy=strategy,
+            grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH,
+        )
+    finally:
+        shutdown_strategy(strategy)
 
-def start_server_valid(rounds):
-    device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) 
+def get_strategy_valid():
+    device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) if torch.cuda.is_available() else torch.device('cpu')
     if config.DATASET == 'cifar10' or config.DATASET == 'fmnist':
         net = NetworkCIFAR(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, False, GENOTYPE, device=device, in_channels=config.IN_CHANNELS)
     elif config.DATASET == 'imagenet':
@@ -64,13 +86,21 @@ def start_server_valid(rounds):
         stage='valid',
         gamma=config.GAMMA
     )
+    return strategy
+
+def start_server_valid(rounds):
+    strategy = get_strategy_valid()
 
     # Start server
-    fl.server.start_server(
-        server_address="[::]:{}".format(config.PORT),
-        config={"num_rounds": rounds},
-        strategy=strategy,
-    )
+    try:
+        fl.server.start_server(
+            server_address="[::]:{}".format(config.PORT),
+            config={"num_rounds": rounds},
+            strategy=strategy,
+            grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH,
+        )
+    finally:
+        shutdown_strategy(strategy)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
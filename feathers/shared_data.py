@@ -0,0 +1,134 @@
+"""
+Shared-memory backing of datasets for clients running on the same host. The launcher (clients.py) loads each split once
+and copies it into named shared-memory segments (images as uint8, tabular data as float32), the client processes attach
+to these segments read-only by name instead of constructing the dataset themselves.
+"""
+import json
+import numpy as np
+import torch
+import torchvision
+from multiprocessing import shared_memory, resource_tracker
+from torch.utils.data import DataLoader, Dataset
+from dataset_cache import CachedImageDataset, _uint8_batches
+from fraud_detection import FraudDetectionData
+
+META_SIZE = 4096
+
+
+def shared_name(dataset, split, part):
+    return 'feathers_{}_{}_{}'.format(dataset, split, part)
+
+def _batches(data, batch_size=1024):
+    """
+    Yields the samples of data in batches in their compact representation (uint8 images or float32 features)
+    """
+    if isinstance(data, CachedImageDataset):
+        pos = 0
+        for shard in data.shards:
+            for start in range(0, len(shard), batch_size):
+                X = np.asarray(shard[start:start+batch_size])
+                yield X, data.targets[pos:pos+len(X)].numpy()
+                pos += len(X)
+    elif isinstance(data, FraudDetectionData):
+        for start in range(0, len(data), batch_size):
+            X, y = data.get_batch(torch.arange(start, min(start + batch_size, len(data))))
+            yield X.numpy(), y.numpy()
+    elif isinstance(data, torchvision.datasets.FashionMNIST):
+        for start in range(0, len(data), batch_size):
+            yield data.data[start:start+batch_size].unsqueeze(1).numpy(), data.targets[start:start+batch_size].numpy()
+    elif isinstance(data, (torchvision.datasets.CIFAR10, torchvision.datasets.ImageFolder)):
+        yield from _uint8_batches(data, batch_size, num_workers=8)
+    else:
+        for X, y in DataLoader(data, batch_size, num_workers=2):
+            yield X.numpy().astype(np.float32), y.numpy()
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # attaching processes must not unlink the segment when they exit, this is up to the launcher
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedArrayDataset(Dataset):
+    """
+    Dataset backed by shared-memory segments. Samples stored as uint8 are converted to float in [0, 1] on access,
+    which corresponds to the ToTensor() + Normalize((0,), (1,)) pipeline of the loaders.
+    """
+
+    def __init__(self, dataset, split, segments, X, y) -> None:
+        super().__init__()
+        self.dataset = dataset
+        self.split = split
+        self.segments = segments
+        self.X = X
+        self.targets = torch.from_numpy(y)
+        self.y = self.targets
+
+    @staticmethod
+    def export(data, dataset, split):
+        """
+        Copies data into new shared-memory segments. Returns the dataset holding the segments, the segments
+        must be released with unlink() by the exporting process once all clients are done.
+        """
+        segments, X, y, pos = [], None, None, 0
+        n = len(data)
+        try:
+            for X_batch, y_batch in _batches(data):
+                if X is None:
+                    shape, dtype = (n,) + X_batch.shape[1:], X_batch.dtype
+                    meta = json.dumps({'shape': list(shape), 'dtype': np.dtype(dtype).str}).encode()
+                    segments.append(shared_memory.SharedMemory(name=shared_name(dataset, split, 'meta'), create=True, size=META_SIZE))
+                    segments[0].buf[:len(meta)] = meta
+                    segments.append(shared_memory.SharedMemory(name=shared_name(dataset, split, 'X'), create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)))
+                    segments.append(shared_memory.SharedMemory(name=shared_name(dataset, split, 'y'), create=True, size=max(1, n * 8)))
+                    X = np.ndarray(shape, dtype=dtype, buffer=segments[1].buf)
+                    y = np.ndarray((n,), dtype=np.int64, buffer=segments[2].buf)
+                X[pos:pos+len(X_batch)] = X_batch
+                y[pos:pos+len(y_batch)] = y_batch
+                pos += len(X_batch)
+        except BaseException:
+            # release the segments created so far, the caller only unlinks exported datasets
+            X = y = None
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+            raise
+        return SharedArrayDataset(dataset, split, segments, X, y)
+
+    @staticmethod
+    def attach(dataset, split):
+        """
+        Attaches read-only to the segments exported for dataset and split.
+        """
+        shm_meta = _attach(shared_name(dataset, split, 'meta'))
+        meta = json.loads(bytes(shm_meta.buf).rstrip(b'\x00').decode())
+        shm_X = _attach(shared_name(dataset, split, 'X'))
+        shm_y = _attach(shared_name(dataset, split, 'y'))
+        shape = tuple(meta['shape'])
+        X = np.ndarray(shape, dtype=np.dtype(meta['dtype']), buffer=shm_X.buf)
+        y = np.ndarray((shape[0],), dtype=np.int64, buffer=shm_y.buf)
+        X.flags.writeable = False
+        return SharedArrayDataset(dataset, split, [shm_meta, shm_X, shm_y], X, y.copy())
+
+    def __reduce__(self):
+        # e.g. DataLoader-workers attach to the segments by name instead of receiving a copy
+        return SharedArrayDataset.attach, (self.dataset, self.split)
+
+    def unlink(self):
+        for shm in self.segments:
+            shm.close()
+            shm.unlink()
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def _to_float(self, X):
+        X = torch.from_numpy(np.array(X))
+        return X.float().div_(255.) if X.dtype == torch.uint8 else X
+
+    def __getitem__(self, index):
+        return self._to_float(self.X[int(index)]), self.targets[int(index)]
+
+    def get_batch(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long).cpu()
+        return self._to_float(self.X[indices.numpy()]), self.targets[indices]
@@ -0,0 +1,210 @@
+"""
+In-process simulation of a federation. Instead of one OS-process and gRPC-connection per client, the clients are hosted
+by a small pool of worker processes. Each worker holds one client-object (model, data) and swaps in the optimizer- and
+architect-state of the client it runs a task for (kept by a ClientStateManager, which spills the states of idle clients
+to disk), the dataset is loaded once per worker (or attached from shared memory).
+The server talks to the clients through ClientProxy-objects which pass the instructions to the workers as python objects,
+the strategies (HANFStrategy) are used unchanged.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import flwr as fl
+from flwr.server.client_manager import SimpleClientManager
+from flwr.server.client_proxy import ClientProxy
+from flwr.server.server import Server
+import torch
+import config
+from codec import DeltaEncoder, parameters_to_weights, weights_to_parameters
+from server import get_strategy_search, get_strategy_valid, shutdown_strategy
+from utils import get_dataset_loder, SharedLoader
+from client_state import ClientStateManager
+
+# state of a worker process
+_CLIENT = None
+_STATES = None
+_ENCODER = None # encodes the uploads of the bound client if UPLOAD_COMPRESSION is set
+_STATE_OWNER = None
+_PREFETCH = None # thread reading the states of announced clients
+_WORKER_ARGS = {}
+
+
+def _init_worker(stage, device, shared_data, threads, state_dir, hints):
+    global _STATES, _ENCODER, _PREFETCH
+    torch.set_num_threads(threads)
+    _WORKER_ARGS.update({'stage': stage, 'device': torch.device(device), 'shared_data': shared_data})
+    max_bytes = config.CLIENT_STATE_MAX_MB * 2**20 if config.CLIENT_STATE_MAX_MB is not None else None
+    _STATES = ClientStateManager(state_dir, config.CLIENT_STATE_RESIDENT, max_bytes)
+    if config.UPLOAD_COMPRESSION is not None:
+        _ENCODER = DeltaEncoder(config.UPLOAD_COMPRESSION)
+    _PREFETCH = threading.Thread(target=_prefetch_states, args=(hints,), daemon=True)
+    _PREFETCH.start()
+
+def _close_worker():
+    # the pool has announced the end (None), the prefetching thread must not use the closed state manager
+    _PREFETCH.join()
+    _STATES.close()
+
+def _prefetch_states(hints):
+    # the pool announces every task when it is queued, thus the state of a client is read while the worker is still busy
+    for cid in iter(hints.get, None):
+        _STATES.prefetch(cid)
+
+def _bind(cid):
+    """
+    Returns the client-object of this worker bound to the data-partition of cid (created on first use).
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        data_loader = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW, shared=_WORKER_ARGS['shared_data'])
+        if _WORKER_ARGS['stage'] == 'search':
+            from hanf_client import HANFClient
+        else:
+            from hanf_client_valid import HANFClient
+        _CLIENT = HANFClient(cid, data_loader, _WORKER_ARGS['device'], config.CLASSES, config.CELL_NR,
+                            config.IN_CHANNELS, config.OUT_CHANNELS, num_workers=0)
+    elif _CLIENT.client_id != cid:
+        _CLIENT.bind(cid)
+    return _CLIENT
+
+def _swap_state(client, cid):
+    global _STATE_OWNER
+    if _STATE_OWNER != cid:
+        state = _STATES.get(cid)
+        client.set_state(state)
+        if _ENCODER is not None:
+            # the residuals of the error feedback belong to the client
+            _ENCODER.residuals = state.get('residuals') if state is not None else None
+        _STATE_OWNER = cid
+
+def _get_parameters(cid):
+    client = _bind(cid)
+    return weights_to_parameters(client.get_parameters())
+
+def _fit(cid, parameters, cfg):
+    client = _bind(cid)
+    _swap_state(client, cid)
+    received = parameters_to_weights(parameters)
+    weights, num_examples, metrics = client.fit(received, cfg)
+    state = client.get_state()
+    if _ENCODER is not None:
+        parameters = _ENCODER.encode_parameters(weights, received[:len(weights)])
+        state['residuals'] = _ENCODER.residuals
+    else:
+        parameters = weights_to_parameters(weights)
+    _STATES.put(cid, state)
+    return parameters, num_examples, metrics
+
+def _evaluate(cid, parameters, cfg):
+    client = _bind(cid)
+    _swap_state(client, cid)
+    return client.evaluate(parameters_to_weights(parameters), cfg)
+
+
+class WorkerPool:
+    """
+    Pool of worker processes hosting the clients. Client cid is always served by worker cid % n_workers,
+    s.t. its state never has to leave the worker.
+    """
+
+    def __init__(self, n_workers, stage, devices, state_dir, shared_data=False) -> None:
+        # CUDA can not be used in forked processes
+        ctx = mp.get_context('spawn')
+        threads = max(1, (os.cpu_count() or 1) // n_workers)
+        self.hints = [ctx.Queue() for _ in range(n_workers)]
+        self.executors = [ProcessPoolExecutor(1, mp_context=ctx, initializer=_init_worker,
+                                              initargs=(stage, devices[i % len(devices)], shared_data, threads,
+                                                        os.path.join(state_dir, 'worker_{}'.format(i)), self.hints[i]))
+                          for i in range(n_workers)]
+
+    def submit(self, cid, fn, *args):
+        worker = int(cid) % len(self.executors)
+        self.hints[worker].put(int(cid))
+        return self.executors[worker].submit(fn, int(cid), *args)
+
+    def shutdown(self):
+        for hints in self.hints:
+            hints.put(None)
+        closing = [executor.submit(_close_worker) for executor in self.executors]
+        for future, executor in zip(closing, self.executors):
+            future.exception() # waits, the states of a failed worker are removed with the state_dir
+            executor.shutdown()
+
+
+class SimulatedClientProxy(ClientProxy):
+    """
+    Proxy of a client hosted by the WorkerPool, blocks until the worker has finished the task.
+    """
+
+    def __init__(self, cid, pool) -> None:
+        super().__init__(cid)
+        self.pool = pool
+
+    def get_properties(self, ins):
+        return fl.common.PropertiesRes(properties={})
+
+    def get_parameters(self):
+        parameters = self.pool.submit(self.cid, _get_parameters).result()
+        return fl.common.ParametersRes(parameters=parameters)
+
+    def fit(self, ins):
+        parameters, num_examples, metrics = self.pool.submit(self.cid, _fit, ins.parameters, ins.config).result()
+        return fl.common.FitRes(parameters=parameters, num_examples=num_examples, metrics=metrics)
+
+    def evaluate(self, ins):
+        loss, num_examples, metrics = self.pool.submit(self.cid, _evaluate, ins.parameters, ins.config).result()
+        return fl.common.EvaluateRes(loss=loss, num_examples=num_examples, metrics=metrics)
+
+    def reconnect(self, reconnect):
+        return fl.common.Disconnect(reason='')
+
+
+def run_simulation(stage, rounds, n_workers):
+    """
+    Runs the federation of config.CLIENT_NR clients on n_workers worker processes.
+
+    Args:
+        stage (str): search or valid
+        rounds (int): Number of communication rounds
+        n_workers (int): Number of worker processes
+
+    Returns:
+        History: History of losses and metrics as returned by flwr's Server
+    """
+    # the strategy distributes the data, thus it has to be created before the workers load their partitions
+    strategy = get_strategy_search() if stage == 'search' else get_strategy_valid()
+    # the workers receive the parameters as python objects, versioned downlinks and shared memory would only cost memory
+    strategy.downlink = None
+    strategy.transport = None
+    shared = []
+    if config.SHARE_CLIENT_DATA:
+        shared = SharedLoader.export(get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW), config.DATASET)
+    devices = ['cuda:{}'.format(gpu) for gpu in config.GPUS] if torch.cuda.is_available() else ['cpu']
+    state_dir = os.path.join(config.CLIENT_STATE_DIR, 'run_{}'.format(os.getpid()))
+    pool = WorkerPool(n_workers, stage, devices, state_dir, config.SHARE_CLIENT_DATA)
+    client_manager = SimpleClientManager()
+    for c in range(config.CLIENT_NR):
+        client_manager.register(SimulatedClientProxy(str(c), pool))
+    server = Server(client_manager=client_manager, strategy=strategy)
+    try:
+        return server.fit(num_rounds=rounds)
+    finally:
+        pool.shutdown()
+        shutdown_strategy(strategy)
+        shutil.rmtree(state_dir, ignore_errors=True)
+        for data in shared:
+            data.unlink()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stage', default='search', type=str)
+    parser.add_argument('--workers', default=config.SIM_WORKERS, type=int)
+
+    args = parser.parse_args()
+    if args.stage not in ('search', 'valid'):
+        raise ValueError('Unknown stage: {}'.format(args.stage))
+    run_simulation(args.stage, config.ROUNDS, args.workers)
@@ -4,11 +4,14 @@ import torch
 import shutil
 import torchvision.transforms as transforms
 from torch.autograd import Variable
-from torch.utils.data import random_split, Subset
+from torch.utils.data import random_split, Subset, DataLoader, RandomSampler, SequentialSampler
 import torchvision
 import math
-import json
 from fraud_detection import FraudDetectionData
+from partition_store import PartitionStore
+from partitioning import partition, split_val_test
+from dataset_cache import CachedImageDataset, is_cached
+from shared_data import SharedArrayDataset
 
 class Loader:
 
@@ -18,47 +21,86 @@ class Loader:
         self.indspath = indspath
         self.train_data = None
         self.val_data = None
+        self.store = None
+        self.cache_dir = None # directory of the pre-decoded dataset (see dataset_cache.py)
 
-    def partition(self):
+    def _load_cached(self, use_cache):
         """
-        Loads the Fashion-MNIST dataset
+        Replaces train- and val-data by their pre-decoded version if a cache exists
         """
-        self.train_partitions, self.val_partitions, self.test_set, train_inds, val_inds, test_inds = partition_skewed(self.train_data, self.val_data, self.n_clients, skew=self.skew)
-        train_dict, val_dict = {}, {}
-        for i, inds in enumerate(train_inds):
-            train_dict[i] = inds.tolist()
-        for i, inds in enumerate(val_inds):
-            val_dict[i] = inds.tolist()
-        json_dict = {
-            'train': train_dict,
-            'val': val_dict,
-            'test': test_inds.tolist()
+        if use_cache and is_cached(os.path.join(self.cache_dir, 'train')) and is_cached(os.path.join(self.cache_dir, 'val')):
+            self.train_data = CachedImageDataset(os.path.join(self.cache_dir, 'train'))
+            self.val_data = CachedImageDataset(os.path.join(self.cache_dir, 'val'))
+            return True
+        return False
+
+    def partition(self, mode='label', alpha=0.5, seed=42):
+        """
+        Partitions the dataset among the clients and persists the partitions in a PartitionStore.
+        If the store already holds partitions obtained with the same parameters, these are reused.
+
+        Args:
+            mode (str, optional): Partitioning mode, one of iid, label, dirichlet, quantity. Defaults to 'label'.
+            alpha (float, optional): Concentration parameter of dirichlet and quantity mode. Defaults to 0.5.
+            seed (int, optional): Seed of the partitioning. Defaults to 42.
+        """
+        train_targets = get_targets(self.train_data).numpy()
+        val_targets = get_targets(self.val_data).numpy()
+        meta = {'mode': mode, 'skew': self.skew, 'alpha': alpha, 'seed': seed,
+                'n_train': len(train_targets), 'n_val': len(val_targets)}
+        if PartitionStore.exists(self.indspath):
+            store = PartitionStore(self.indspath)
+            if store.n_clients == self.n_clients and all(store.meta.get(k) == v for k, v in meta.items()):
+                self.store = store
+                return
+        rng = np.random.default_rng(seed)
+        n_classes = int(max(train_targets.max(), val_targets.max())) + 1
+        val_inds, test_inds = split_val_test(len(val_targets), rng)
+        train_flat, train_offsets = partition(train_targets, self.n_clients, mode, rng, self.skew, alpha)
+        val_flat, val_offsets = partition(val_targets, self.n_clients, mode, rng, self.skew, alpha, inds=val_inds)
+        splits = {
+            'train': (train_flat, train_offsets, train_targets[train_flat]),
+            'val': (val_flat, val_offsets, val_targets[val_flat])
         }
-        with open(self.indspath, 'w+') as f:
-            json.dump(json_dict, f)
+        PartitionStore.write(self.indspath, splits, test_inds, n_classes, meta)
+        self.store = None
+
+    def _store(self):
+        if self.store is None:
+            self.store = PartitionStore(self.indspath)
+        return self.store
 
     def load_client_data(self, client_id):
-        with open(self.indspath, 'r') as f:
-            inds_dict = json.load(f)
-        train_inds = np.array(inds_dict['train'][str(client_id)])
-        val_inds = np.array(inds_dict['val'][str(client_id)])
+        store = self._store()
+        train_inds = store.client_indices('train', client_id)
+        val_inds = store.client_indices('val', client_id)
         trainset = Subset(self.train_data, train_inds)
         valset = Subset(self.val_data, val_inds)
         return trainset, valset
 
+    def load_client_labels(self, client_id, split='train'):
+        """
+        Labels of the samples of a client (in the order of its indices), read from the store without touching the data
+        """
+        return torch.from_numpy(self._store().client_labels(split, client_id).astype(np.int64))
+
+    def label_histogram(self, client_id=None, split='train'):
+        """
+        Label histogram of a client, or of each client (n_clients x n_classes) if client_id is None
+        """
+        return self._store().label_histogram(split, client_id)
+
     def load_server_data(self):
-        with open(self.indspath, 'r') as f:
-            inds_dict = json.load(f)
-        test_inds = np.array(inds_dict['test'])
+        test_inds = self._store().test_indices()
         testset = Subset(self.val_data, test_inds)
         return testset
          
     def get_client_data(self):
-        for train, val in zip(self.train_partitions, self.val_partitions):
-            yield train, val
+        for client_id in range(self._store().n_clients):
+            yield self.load_client_data(client_id)
 
     def get_test(self):
-        return self.test_set
+        return self.load_server_data()
 
 class FashionMNISTLoader(Loader):
 
@@ -70,16 +112,22 @@ class FashionMNISTLoader(Loader):
 
 class CIFAR10Loader(Loader):
 
-    def __init__(self, n_clients, indspath, skew=0) -> None:
+    def __init__(self, n_clients, indspath, skew=0, use_cache=True) -> None:
         super().__init__(n_clients, indspath, skew)
+        self.cache_dir = '../../../datasets/cifar10/cache/'
+        if self._load_cached(use_cache):
+            return
         transform = torchvision.transforms.Compose([torchvision.transforms.ToTensor(), torchvision.transforms.Normalize((0,), (1,))])
         self.train_data = torchvision.datasets.CIFAR10('../../../datasets/cifar10/', download=True, train=True, transform=transform)
         self.val_data = torchvision.datasets.CIFAR10('../../../datasets/cifar10/', download=True, train=False, transform=transform)
 
 class ImageNet(Loader):
 
-    def __init__(self, n_clients, indspath, skew=0) -> None:
+    def __init__(self, n_clients, indspath, skew=0, use_cache=True) -> None:
         super().__init__(n_clients, indspath, skew)
+        self.cache_dir = '../../../datasets/tiny-imagenet/cache/'
+        if self._load_cached(use_cache):
+            return
         transform = torchvision.transforms.Compose([torchvision.transforms.ToTensor(), torchvision.transforms.Normalize((0,), (1,))])
         self.train_data = torchvision.datasets.ImageFolder('../../../datasets/tiny-imagenet/train', transform=transform)
         self.val_data = torchvision.datasets.ImageFolder('../../../datasets/tiny-imagenet/val', transform=transform)
@@ -92,13 +140,222 @@ class FraudDetection(Loader):
        self.val_data = FraudDetectionData('../datasets/ccFraud/', train=False)
 
 
-def get_dataset_loder(dataset, num_clients, indspath, skew=0):
+class SearchBatchStream:
+    """
+    Endless stream of minibatches drawn from the search-split which is used for the architecture-step.
+    The iterator of the wrapped loader is created once and kept alive across steps (and fit-calls), whenever
+    it is exhausted a new pass over the data is started transparently.
+    """
+
+    def __init__(self, loader) -> None:
+        self.loader = loader
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.loader)
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            # current pass is exhausted, start a new one (reshuffles the sampler)
+            self._iterator = iter(self.loader)
+            return next(self._iterator)
+
+def get_search_loader(data, batch_size, num_workers=2, pin_memory=True):
+    """
+    Loader for the search-split sampling with replacement. Workers are persistent s.t. they are not
+    spawned again for every new pass and keep prefetching batches in the background.
+    """
+    sampler = RandomSampler(data, replacement=True, num_samples=len(data))
+    if supports_batches(data):
+        return TensorLoader(as_batch_data(data), batch_size, sampler=sampler)
+    return DataLoader(data, batch_size, sampler=sampler, pin_memory=pin_memory, 
+                      num_workers=num_workers, persistent_workers=num_workers > 0)
+
+class TensorData:
+    """
+    Dataset (partition) materialized into contiguous tensors. Batches are fetched by indexing
+    the tensors with a whole batch of indices at once instead of per sample.
+    """
+
+    def __init__(self, X, y) -> None:
+        self.X = X
+        self.y = y
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getitem__(self, index):
+        return self.X[index], self.y[index]
+
+    def get_batch(self, indices):
+        return self.X.index_select(0, indices), self.y.index_select(0, indices)
+
+    @property
+    def device(self):
+        return self.X.device
+
+class BatchSubset:
+    """
+    Subset of a dataset supporting get_batch (e.g. CachedImageDataset), a batch is fetched by one call into the dataset.
+    """
+
+    def __init__(self, dataset, indices) -> None:
+        self.dataset = dataset
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.dataset[int(self.indices[index])]
+
+    def get_batch(self, indices):
+        return self.dataset.get_batch(self.indices[indices.cpu()])
+
+    @property
+    def device(self):
+        return torch.device('cpu')
+
+def supports_batches(data):
+    if isinstance(data, Subset):
+        data = data.dataset
+    return hasattr(data, 'get_batch')
+
+def as_batch_data(data):
+    if isinstance(data, Subset):
+        return BatchSubset(data.dataset, data.indices)
+    return data
+
+class TensorLoader:
+    """
+    Drop-in replacement for DataLoader over datasets supporting get_batch (TensorData, BatchSubset, CachedImageDataset).
+    Sequential passes over TensorData are served by slicing, otherwise the order of the sampler is drawn once per pass
+    and split into index-batches.
+    """
+
+    def __init__(self, dataset, batch_size, sampler=None, shuffle=False, drop_last=False) -> None:
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.drop_last = drop_last
+
+    def __len__(self):
+        n = len(self.sampler)
+        if self.drop_last:
+            return n // self.batch_size
+        return math.ceil(n / self.batch_size)
+
+    def __iter__(self):
+        n = len(self.sampler)
+        stop = n - n % self.batch_size if self.drop_last else n
+        if isinstance(self.sampler, SequentialSampler) and isinstance(self.dataset, TensorData):
+            for start in range(0, stop, self.batch_size):
+                end = min(start + self.batch_size, stop)
+                yield self.dataset.X[start:end], self.dataset.y[start:end]
+        else:
+            order = torch.as_tensor(list(iter(self.sampler)), dtype=torch.long, device=getattr(self.dataset, 'device', None))
+            for start in range(0, stop, self.batch_size):
+                yield self.dataset.get_batch(order[start:start + self.batch_size])
+
+def get_targets(data):
+    """
+    Returns the labels of data (dataset or Subset) as LongTensor without loading the samples.
+    """
+    if isinstance(data, TensorData):
+        return data.y
+    if isinstance(data, Subset):
+        return get_targets(data.dataset)[torch.as_tensor(data.indices, dtype=torch.long)]
+    if isinstance(data, FraudDetectionData):
+        return data.y
+    return torch.as_tensor(data.targets, dtype=torch.long)
+
+def _raw_image_tensors(data, indices):
+    # the datasets below are loaded with ToTensor() + Normalize((0,), (1,)), i.e. pixels are only scaled to [0, 1].
+    # Thus, we can skip the per-sample PIL-conversion and transform the raw uint8 buffer at once.
+    if isinstance(data, torchvision.datasets.FashionMNIST):
+        X = torch.as_tensor(data.data)[indices].unsqueeze(1)
+    elif isinstance(data, torchvision.datasets.CIFAR10):
+        X = torch.from_numpy(data.data[indices.numpy()]).permute(0, 3, 1, 2)
+    else:
+        return None
+    return X.float().div_(255.).contiguous()
+
+def materialize(data, device=None, batch_size=1024):
+    """
+    Materializes a dataset or Subset once into a TensorData (optionally resident on device).
+    """
+    if isinstance(data, TensorData):
+        X, y = data.X, data.y
+    else:
+        dataset, indices = (data.dataset, data.indices) if isinstance(data, Subset) else (data, np.arange(len(data)))
+        indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        if isinstance(dataset, TensorData):
+            X, y = dataset.X[indices], dataset.y[indices]
+        elif hasattr(dataset, 'get_batch'):
+            X, y = dataset.get_batch(indices)
+        else:
+            X, y = _raw_image_tensors(dataset, indices), None
+            if X is not None:
+                y = get_targets(dataset)[indices]
+            else:
+                # generic path: one pass over the data with the default pipeline
+                feats, labels = [], []
+                for f, l in DataLoader(data, batch_size, num_workers=2):
+                    feats.append(f)
+                    labels.append(l)
+                X, y = torch.cat(feats), torch.cat(labels)
+    if device is not None:
+        X, y = X.to(device), y.to(device)
+    return TensorData(X.contiguous(), y.contiguous())
+
+def get_data_loader(data, batch_size, sampler=None, in_memory=False, device=None, num_workers=2):
+    """
+    Returns a loader over data. If in_memory is set, data is materialized once into contiguous tensors
+    on device (no-op if it already is) and served by TensorLoader, otherwise a regular DataLoader is used.
+    """
+    if in_memory or isinstance(data, TensorData):
+        return TensorLoader(materialize(data, device), batch_size, sampler=sampler)
+    if supports_batches(data):
+        return TensorLoader(as_batch_data(data), batch_size, sampler=sampler)
+    return DataLoader(data, batch_size, sampler=sampler, pin_memory=True, num_workers=num_workers)
+
+class SharedLoader(Loader):
+    """
+    Loader of a dataset exported to shared memory by the launcher (see shared_data.py)
+    """
+
+    def __init__(self, dataset, n_clients, indspath, skew=0) -> None:
+        super().__init__(n_clients, indspath, skew)
+        self.train_data = SharedArrayDataset.attach(dataset, 'train')
+        self.val_data = SharedArrayDataset.attach(dataset, 'val')
+
+    @staticmethod
+    def export(loader, dataset):
+        """
+        Exports train- and val-data of loader to shared memory, returns the exported datasets (to be unlinked by the caller)
+        """
+        train = SharedArrayDataset.export(loader.train_data, dataset, 'train')
+        try:
+            return [train, SharedArrayDataset.export(loader.val_data, dataset, 'val')]
+        except BaseException:
+            train.unlink()
+            raise
+
+def get_dataset_loder(dataset, num_clients, indspath, skew=0, use_cache=True, shared=False):
+    if shared:
+        return SharedLoader(dataset, num_clients, indspath, skew=skew)
     if dataset == 'fmnist':
         return FashionMNISTLoader(num_clients, indspath, skew=skew)
     elif dataset == 'cifar10':
-        return CIFAR10Loader(num_clients, indspath, skew=skew)
+        return CIFAR10Loader(num_clients, indspath, skew=skew, use_cache=use_cache)
     elif dataset == 'imagenet':
-        return ImageNet(num_clients, indspath, skew=skew)
+        return ImageNet(num_clients, indspath, skew=skew, use_cache=use_cache)
     elif dataset == 'fraud':
         return FraudDetection(num_clients, indspath, skew=skew)
     else:
@@ -122,94 +379,6 @@ def partition_data(train_set, val_set, n_clients):
 
     return train_partitions, val_partitions, test
 
-def label_distribution_skew(x, y, partitions, skew=1):
-    def runner_split(N_labels, N_runners):
-        """number of labels to assign to n clients"""
-        runner_labels = round(max(1, N_labels / N_runners))
-        runner_split = round(max(1, N_runners / N_labels))
-        return runner_labels, runner_split
-
-    runn_inds = []
-    if not isinstance(y, torch.Tensor):
-        y = torch.tensor(y)
-    N_labels = torch.unique(y).shape[0]
-    n_labels, n_runners = runner_split(N_labels, partitions)
-    np.random.seed(42)
-    
-    selected_inds = []
-    for label_idx in range(0, N_labels, n_labels):
-        # get a range of labels (e.g. in case of MNIST labels between 0 and 3)
-        mask = torch.isin(y, torch.Tensor(np.arange(label_idx, label_idx+n_labels))).cpu().detach().numpy()
-        # get index of these labels
-        subset_idx = np.argwhere(mask)[:, 0]
-        n_samples = subset_idx.shape[0]
-        # randomly sample indices of size sample_size
-        sample_size = math.floor(skew*n_samples)
-        subset_idx = np.random.choice(subset_idx, sample_size, replace=False)
-        selected_inds += list(subset_idx)
-    
-        for partition in np.array_split(subset_idx, n_runners):
-            # add a data-partition for a runner
-            runn_inds.append(partition)
-    
-    selected = np.array(selected_inds)
-    mask = np.zeros(len(x))
-    mask[selected] = 1
-    not_selected = np.argwhere(mask == 0)
-    return runn_inds, not_selected
-
-def uniform_distribution(inds, partitions, randomise=True):
-    runner_data = []
-    if randomise:
-        # shuffle indices
-        np.random.shuffle(inds)
-    # split randomly chosen data-points and labels into partitions
-    for partition in np.array_split(inds, partitions):
-        runner_data.append(partition)
-    return runner_data
-
-def partition_skewed(train_set, val_set, partitions, randomise=True, skew=0):
-    # randomly select half of the data of the validation set to be the test-set
-    ind_in_val = np.random.choice([0, 1], p=[0.5, 0.5], size=len(val_set))
-    val_inds = np.argwhere(ind_in_val == 1).reshape(1, -1)[0]
-    test_inds = np.argwhere(ind_in_val == 0).reshape(1, -1)[0]
-    train_partitions, val_partitions, test_set = [], [], Subset(val_set, test_inds)
-    train_inds = np.arange(len(train_set))
-    train_subs_inds, val_subs_inds, test_subs_inds = [], [], test_inds
-    if skew == 0:
-        train_unfiorm = uniform_distribution(train_inds, partitions, randomise)
-        val_uniform = uniform_distribution(val_inds, partitions, randomise)
-        for t, v in zip(train_unfiorm, val_uniform):
-            train_subset = Subset(train_set, t)
-            val_subset = Subset(val_set, v)
-            train_partitions.append(train_subset)
-            val_partitions.append(val_subset)
-            train_subs_inds.append(t)
-            val_subs_inds.append(v)
-    else:
-        # build skewed data-sets
-        train_selected, train_inds_remain = label_distribution_skew(train_set.data, train_set.targets, partitions, skew)
-        val_selected, val_inds_remain = label_distribution_skew(val_set.data, val_set.targets, partitions, skew)
-        # if skew < 1 this will contain a list of all data-points that are not already assigned to some runner
-        train_uniform = uniform_distribution(train_inds_remain, partitions, randomise)
-        val_uniform = uniform_distribution(val_inds_remain, partitions, randomise)
-        # concatenate train and val set-indices obtained above
-        for s, p in zip(train_selected, train_uniform):
-            s = s.reshape(1, -1)[0]
-            p = p.reshape(1, -1)[0]
-            indices = np.concatenate((s, p))
-            subset = Subset(train_set, indices)
-            train_partitions.append(subset)
-            train_subs_inds.append(indices)
-        for s, p in zip(val_selected, val_uniform):
-            s = s.reshape(1, -1)[0]
-            p = p.reshape(1, -1)[0]
-            indices = np.concatenate((s, p))
-            subset = Subset(val_set, indices)
-            val_partitions.append(subset)
-            val_subs_inds.append(indices)
-    return train_partitions, val_partitions, test_set, train_subs_inds, val_subs_inds, test_subs_inds
-
 def discounted_mean(series, gamma=1.0):
     weight = gamma ** np.flip(np.arange(len(series)), axis=0)
     return np.inner(series, weight) / weight.sum()
@@ -28,7 +28,19 @@ GPUS = [5, 6] # GPUs to use
 SERVER_GPU = 6
 
 DATA_SKEW = 0 # skew of labels. 0 = no skew, 1 only some clients hold some labels
+PARTITION_MODE = 'label' # iid, label (runner split with DATA_SKEW), dirichlet (label skew) or quantity (skewed partition sizes)
+DIRICHLET_ALPHA = 0.5 # concentration of the dirichlet distribution used by the dirichlet and quantity partition mode
+PARTITION_SEED = 42
 USE_WEIGHTED_SAMPLER = True
+UPLOAD_COMPRESSION = None # None uploads the full weights. fp32, fp16, bf16 or int8 upload the (quantized) difference to the received weights, with error feedback
+DOWNLINK_VERSIONS = 0 # number of versions of the global weights the server keeps to send clients only the steps from the version they hold (0 = always send the full weights)
+DOWNLINK_COMPRESSION = None # None sends the steps exactly, fp16, bf16 or int8 quantize them (the server continues from the weights the clients reconstruct, the quantization error is carried into the next step)
+SHM_TRANSPORT = False # clients run on the host of the server (clients.py): weights are exchanged through shared memory, the gRPC messages only carry references
+GRPC_MAX_MESSAGE_LENGTH = 536870912 # maximum size of a gRPC message (server and clients), flwr's default (512 MB). The weights and hyperparameters are sent as one message, raise it by hand (gRPC allows up to 2 GB) for larger supernets or use SHM_TRANSPORT on a single host
+ASYNC_EVAL = False # the server evaluates (and checkpoints) the global model in a background process, results are logged against their round once finished
+EVAL_SHARDS = 0 # number of cpu worker processes evaluating shards of the server's test-set in parallel, 0 evaluates on the server's device
+EVAL_CACHE_SIZE = 8 # number of evaluation results (server and clients) memoized by the digest of the weights, 0 disables the memoization
+SPARSE_UPLOAD_THRESHOLD = None # search stage: omit the weights of MixedOp-branches whose softmax-weight is below this threshold from uploads, the server keeps their global values (None = upload all)
 
 # Differential Privacy
 MAX_GRAD_NORM = 1.
@@ -38,4 +50,4 @@ DP_SIGMA_REWARD = 1e-3
 DROP_PATH_PROB = 0.2 # probability of dropping a path in cell, similar to dropout
 
 HYPERPARAM_FILE = f'./hyperparam-logs/search_DARTS_{DATASET}_{CLIENT_NR}_{DATA_SKEW}.csv'
-DATASET_INDS_FILE = './hyperparam-logs/indices.json'
\ No newline at end of file
+DATASET_INDS_FILE = './hyperparam-logs/partitions/' # directory of the binary partition store
\ No newline at end of file
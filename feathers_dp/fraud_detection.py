@@ -1,34 +1,122 @@
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 from torch.utils.data import DataLoader, Dataset
 import torch
 import pandas as pd
 import numpy as np
+import shutil
+import json
+import os
+
+
+def _merge_moments(n_a, mean_a, m2_a, x):
+    """
+    Merges the moments (count, mean, sum of squared deviations) of a chunk x into the running ones (Chan et al.)
+    """
+    n_b = x.shape[0]
+    if n_b == 0:
+        return n_a, mean_a, m2_a
+    mean_b = x.mean(axis=0)
+    m2_b = ((x - mean_b) ** 2).sum(axis=0)
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+def build_fraud_cache(file, cache_dir, test_size=0.3, seed=42, chunksize=500000):
+    """
+    Converts the ccFraud csv in chunks into a binary cache, s.t. the csv never has to be held in memory.
+    The cache consists of a float32 feature matrix and int64 labels (raw binary, memory-mappable), the rows
+    of the train- and test-split and the statistics of a standard-scaler per split computed in the same pass.
+
+    Args:
+        file (str): Path of ccFraud.csv
+        cache_dir (str): Directory the cache is written to
+        test_size (float, optional): Fraction of rows assigned to the test split. Defaults to 0.3.
+        seed (int, optional): Seed of the train/test split. Defaults to 42.
+        chunksize (int, optional): Number of csv-rows processed at once. Defaults to 500000.
+    """
+    # write into a temporary directory first, concurrent builds (e.g. server and clients) must not see partial caches
+    tmp_dir = cache_dir.rstrip('/') + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_rows, n_features, columns = 0, None, None
+    moments = {}
+    with open(os.path.join(tmp_dir, 'features.bin'), 'wb') as f_x, open(os.path.join(tmp_dir, 'labels.bin'), 'wb') as f_y, \
+            open(os.path.join(tmp_dir, 'split.bin'), 'wb') as f_s:
+        for chunk in pd.read_csv(file, chunksize=chunksize):
+            chunk = chunk.drop(columns=['custID'])
+            y = chunk['fraudRisk'].to_numpy(dtype=np.int64)
+            X = chunk.drop(columns=['fraudRisk']).to_numpy(dtype=np.float32)
+            if columns is None:
+                columns = list(chunk.drop(columns=['fraudRisk']).columns)
+                n_features = X.shape[1]
+                moments = {split: (0, np.zeros(n_features), np.zeros(n_features)) for split in ('train', 'test')}
+            is_test = rng.random(len(y)) < test_size
+            moments['train'] = _merge_moments(*moments['train'], X[~is_test].astype(np.float64))
+            moments['test'] = _merge_moments(*moments['test'], X[is_test].astype(np.float64))
+            f_x.write(np.ascontiguousarray(X).tobytes())
+            f_y.write(y.tobytes())
+            f_s.write(is_test.astype(np.uint8).tobytes())
+            n_rows += len(y)
+    is_test = np.fromfile(os.path.join(tmp_dir, 'split.bin'), dtype=np.uint8).astype(bool)
+    np.save(os.path.join(tmp_dir, 'train_rows.npy'), np.flatnonzero(~is_test))
+    np.save(os.path.join(tmp_dir, 'test_rows.npy'), np.flatnonzero(is_test))
+    for split, (n, mean, m2) in moments.items():
+        std = np.sqrt(m2 / max(n, 1))
+        std[std == 0] = 1.0 # same as sklearn's StandardScaler
+        np.savez(os.path.join(tmp_dir, f'scaler_{split}.npz'), mean=mean.astype(np.float32), std=std.astype(np.float32))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w+') as f:
+        json.dump({'n_rows': n_rows, 'n_features': n_features, 'columns': columns}, f)
+    if os.path.isdir(cache_dir) and not os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        # left incomplete by an interrupted build, complete caches are renamed into place with their meta.json
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another process finished the cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
 
 class FraudDetectionData(Dataset):
 
-    def __init__(self, file, train) -> None:
+    def __init__(self, file, train, sample_fraction=1.0) -> None:
+        """
+        ccFraud dataset served from a memory-mapped binary cache (built from the csv on first use).
+
+        Args:
+            file (str): Directory containing ccFraud.csv
+            train (bool): Whether to use the train- or test-split
+            sample_fraction (float, optional): Fraction of rows of the split to use. Defaults to 1.0.
+        """
         super().__init__()
-        data = pd.read_csv(file + 'ccFraud.csv')
-        data = data.drop(columns=['custID'])
-        np.random.seed(0) # ensure deterministic behavior
-        subsamples = np.random.randint(0, len(data), size=int(0.005*len(data)))
-        data = data.iloc[subsamples, :]
-        y = data['fraudRisk'].to_numpy()
-        X = data.drop(columns=['fraudRisk']).to_numpy()
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-        if train:
-            X, y = X_train, y_train
-        else:
-            X, y = X_test, y_test
-        scaler = StandardScaler()
-        X = scaler.fit_transform(X)
-        self.y = torch.from_numpy(y).long()
-        self.X = torch.from_numpy(X).float()
+        cache_dir = os.path.join(file, 'ccFraud_cache')
+        if not os.path.isfile(os.path.join(cache_dir, 'meta.json')):
+            build_fraud_cache(file + 'ccFraud.csv', cache_dir)
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        split = 'train' if train else 'test'
+        self.features = np.memmap(os.path.join(cache_dir, 'features.bin'), dtype=np.float32, mode='r', shape=(meta['n_rows'], meta['n_features']))
+        labels = np.memmap(os.path.join(cache_dir, 'labels.bin'), dtype=np.int64, mode='r', shape=(meta['n_rows'],))
+        rows = np.load(os.path.join(cache_dir, f'{split}_rows.npy'))
+        if sample_fraction < 1.0:
+            rng = np.random.default_rng(0) # ensure deterministic behavior
+            rows = np.sort(rng.choice(rows, int(sample_fraction * len(rows)), replace=False))
+        self.rows = rows
+        scaler = np.load(os.path.join(cache_dir, f'scaler_{split}.npz'))
+        self.mean, self.std = torch.from_numpy(scaler['mean']), torch.from_numpy(scaler['std'])
+        self.y = torch.from_numpy(np.asarray(labels[rows]))
 
     def __len__(self):
-        return self.X.shape[0]
+        return len(self.rows)
 
     def __getitem__(self, index):
-        x, y = self.X[index], self.y[index]
-        return x, y
\ No newline at end of file
+        x, y = self.get_batch(torch.as_tensor([index]))
+        return x[0], y[0]
+
+    def get_batch(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long).cpu()
+        rows = self.rows[indices.numpy()]
+        # read the rows in ascending order and restore the order of the batch afterwards
+        order = np.argsort(rows)
+        X = torch.from_numpy(self.features[rows[order]])[torch.from_numpy(np.argsort(order))]
+        return (X - self.mean) / self.std, self.y[indices]
@@ -9,14 +9,18 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, WeightedRandomSampler
 from torch.autograd import Variable
 import numpy as np
-from utils import get_dataset_loder, get_params
+from utils import get_dataset_loder, get_params, SearchBatchStream
 from rtpt import RTPT
+from codec import CodecClient, to_torch
+from eval_cache import EvalCache, weights_digest
+from downlink import DownlinkDecoder
+from shm_transport import ShmTransport
 import config
 from hyperparameters import Hyperparameters
 from tensorboardX import SummaryWriter
 from datetime import datetime as dt
 import argparse
-from model_search import Network, TabularNetwork
+from model_search import Network, TabularNetwork, branch_mask
 from architect import Architect
 from opacus import PrivacyEngine
 from opacus.validators import ModuleValidator
@@ -52,6 +56,8 @@ def train(train_queue, valid_queue, model, architect, criterion, optimizer, lr,
        
        with BatchMemoryManager(data_loader=valid_queue,
                max_physical_batch_size=config.BATCH_SIZE, optimizer=architect.optimizer) as valid_bmm:
+            # keep one iterator over the (poisson-sampled) search queue alive for the whole round
+            search_queue = SearchBatchStream(valid_bmm)
             for step, (input, target) in enumerate(train_bmm):
                 if step % 10 == 0:
                     print(f'Step {step:03d}')
@@ -62,7 +68,7 @@ def train(train_queue, valid_queue, model, architect, criterion, optimizer, lr,
                 input = input.to(device, non_blocking=True)
                 target = target.to(device, non_blocking=True)
                 # get a random minibatch from the search queue with replacement
-                input_search, target_search = next(iter(valid_bmm))
+                input_search, target_search = next(search_queue)
                 input_search = input_search.to(device, non_blocking=True)
                 target_search = target_search.to(device, non_blocking=True)
                 # set parameter-lr zero during arch. step
@@ -126,13 +132,15 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             else:
                 model = Network(out_channels, classes, cell_nr, self.criterion, device, in_channels=input_channels, steps=config.NODE_NR)
             model = model.to(device)
+            self.eval_cache = EvalCache(config.EVAL_CACHE_SIZE) if config.EVAL_CACHE_SIZE > 0 else None
+            self.supernet = model # the model wrapped by opacus
             model_params = get_params(model, 'model')
             arch_params = get_params(model, 'arch')
             self.num_model_param_groups = len(model_params)
             optim = torch.optim.SGD([
                 {'params': model_params, 'lr': 0.01, 'weight_decay': 3e-4, 'momentum': 0.9},
                 {'params': arch_params, 'lr': 3e-4, 'weight_decay': 1e-3, 'momentum': 0.9}], lr=0.01, momentum=0.9, weight_decay=3e-4)
-            sampler = self._get_sampler(train_data) if config.USE_WEIGHTED_SAMPLER else None
+            sampler = self._get_sampler(data_loader.load_client_labels(client_id)) if config.USE_WEIGHTED_SAMPLER else None
             self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, sampler=sampler, num_workers=2)
             self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2)
             #self.model = ModuleValidator.fix(self.model) # required to replace modules not supported by opacus (e.g. BatchNorm)
@@ -159,18 +167,27 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             parameters = parameters[:-1]
             
             params_dict = zip(self.model.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
+            state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
             self.model.load_state_dict(state_dict, strict=True)
             self.architect.model.load_state_dict(state_dict, strict=True)
 
         def set_parameters_evaluate(self, parameters):
             params_dict = zip(self.model.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
+            state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
             self.model.load_state_dict(state_dict, strict=True)
 
+        def _test_received(self, parameters):
+            """
+            Loss and accuracy of the weights received from the server (loaded into the model), memoized by their digest.
+            """
+            if self.eval_cache is None:
+                return _test(self.model, self.val_loader, device)
+            key = weights_digest(parameters[:len(self.model.state_dict())])
+            return self.eval_cache.memoize(key, lambda: _test(self.model, self.val_loader, device))
+
         def fit(self, parameters, flwr_config):
             self.set_parameters_train(parameters, flwr_config)
-            before_loss, _ = _test(self.model, self.val_loader, device)
+            before_loss, _ = self._test_received(parameters)
             for e in range(EPOCHS):
                 rtpt.step()
                 self.epoch += 1
@@ -179,13 +196,17 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
                                                  self.hyperparam_config['learning_rate'], device, self.num_model_param_groups)
             after_loss, _ = _test(self.model, self.val_loader, device)
             model_params = self.get_parameters()
+            if config.SPARSE_UPLOAD_THRESHOLD is not None:
+                # omit branches with negligible architecture weight, the server keeps their global values
+                mask = branch_mask(self.supernet, config.SPARSE_UPLOAD_THRESHOLD)
+                model_params = [p if keep else None for p, keep in zip(model_params, mask)]
             before_loss += self.dp_sigma_reward * np.random.normal(0, 1)
             after_loss += self.dp_sigma_reward * np.random.normal(0, 1)
             return model_params, len(train_data), {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss)}
 
         def evaluate(self, parameters, config):
             self.set_parameters_evaluate(parameters)
-            loss, accuracy = _test(self.model, self.val_loader, device)
+            loss, accuracy = self._test_received(parameters)
             return float(loss), len(test_data), {"accuracy": float(accuracy)}
 
         def set_current_hyperparameter_config(self, hyperparam, idx):
@@ -203,17 +224,18 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             # update architect's hyperparameters
             self.architect.update_hyperparameters(hyperparam)
 
-        def _get_sampler(self, training_data):
-            targets = training_data.dataset.y[training_data.indices]
-            class_count = torch.tensor([len(targets[targets == t]) for t in torch.unique(targets)])
+        def _get_sampler(self, targets):
+            class_count = torch.from_numpy(data_loader.label_histogram(client_id))
             weight = 1 / class_count
-            samples_weight = torch.tensor([weight[t] for t in targets]).double()
+            samples_weight = weight[targets].double()
             sampler = WeightedRandomSampler(samples_weight, len(samples_weight))
             return sampler
 
             
     # Start client
-    fl.client.start_numpy_client("127.0.0.1:{}".format(config.PORT), client=HANFClient())
+    transport = ShmTransport('feathers_up', reuse=True) if config.SHM_TRANSPORT else None
+    fl.client.start_client("127.0.0.1:{}".format(config.PORT), client=CodecClient(HANFClient(), upload_mode=config.UPLOAD_COMPRESSION, downlink=DownlinkDecoder(), transport=transport),
+        grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH)
 
 
 if __name__ == "__main__":
@@ -10,6 +10,10 @@ from torch.autograd import Variable
 import numpy as np
 from utils import get_dataset_loder
 from rtpt import RTPT
+from codec import CodecClient, to_torch
+from eval_cache import EvalCache, weights_digest
+from downlink import DownlinkDecoder
+from shm_transport import ShmTransport
 import config
 from hyperparameters import Hyperparameters
 from tensorboardX import SummaryWriter
@@ -94,6 +98,7 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             elif config.DATASET == 'fraud':
                 self.model = NetworkTabular(config.FRAUD_DETECTION_IN_DIM, config.CLASSES, config.CELL_NR, GENOTYPE, device=device)
             self.model = self.model.to(device)
+            self.eval_cache = EvalCache(config.EVAL_CACHE_SIZE) if config.EVAL_CACHE_SIZE > 0 else None
             self.optimizer = torch.optim.SGD(self.model.parameters(), 0.01, momentum=0.99, weight_decay=1e-3)
             self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2)
             self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2)
@@ -115,17 +120,26 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             parameters = parameters[:-1]
             
             params_dict = zip(self.model.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
+            state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
             self.model.load_state_dict(state_dict, strict=True)
 
         def set_parameters_evaluate(self, parameters):
             params_dict = zip(self.model.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
+            state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
             self.model.load_state_dict(state_dict, strict=True)
 
+        def _test_received(self, parameters):
+            """
+            Loss and accuracy of the weights received from the server (loaded into the model), memoized by their digest.
+            """
+            if self.eval_cache is None:
+                return _test(self.model, self.val_loader, device)
+            key = weights_digest(parameters[:len(self.model.state_dict())])
+            return self.eval_cache.memoize(key, lambda: _test(self.model, self.val_loader, device))
+
         def fit(self, parameters, cfg):
             self.set_parameters_train(parameters, cfg)
-            before_loss, _ = _test(self.model, self.val_loader, device)
+            before_loss, _ = self._test_received(parameters)
             for e in range(EPOCHS):
                 rtpt.step()
                 self.epoch += 1
@@ -141,7 +155,7 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             else:
                 self.model.drop_path_prob = 0.2 # just to ensure that in initial evaluation there's a value set
             self.set_parameters_evaluate(parameters)
-            loss, accuracy = _test(self.model, self.val_loader, device)
+            loss, accuracy = self._test_received(parameters)
             return float(loss), len(test_data), {"accuracy": float(accuracy)}
 
         def set_current_hyperparameter_config(self, hyperparam, idx):
@@ -153,7 +167,9 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
                 g['weight_decay'] = self.hyperparam_config['weight_decay']
             
     # Start client
-    fl.client.start_numpy_client("[::]:{}".format(config.PORT), client=HANFClient())
+    transport = ShmTransport('feathers_up', reuse=True) if config.SHM_TRANSPORT else None
+    fl.client.start_client("[::]:{}".format(config.PORT), client=CodecClient(HANFClient(), upload_mode=config.UPLOAD_COMPRESSION, downlink=DownlinkDecoder(), transport=transport),
+        grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,21 @@
-from copy import deepcopy
 from typing import Dict, List, Optional, Tuple
 import flwr as fl
 import numpy as np
 import pandas as pd
-from numproto import proto_to_ndarray, ndarray_to_proto
+from codec import encode, parameters_to_weights, weights_to_parameters, to_torch
 from scipy.special import softmax
 from scipy.stats import entropy
-from helpers import ProtobufNumpyArray, log_model_weights, log_hyper_config, log_hyper_params
+from aggregation import aggregate_fit_results, FoldingRound
+from downlink import DownlinkVersions
+from shm_transport import ShmTransport
+from weight_store import WeightStore
+from eval_worker import EvalWorker
+from sharded_eval import ShardedEvaluator
+from eval_cache import EvalCache, weights_digest
+from helpers import log_model_weights, log_hyper_config, log_hyper_params
 from utils import discounted_mean, get_dataset_loder
 from collections import OrderedDict
+from copy import deepcopy
 import torch
 from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
@@ -79,9 +86,17 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.use_gain_avg = use_gain_avg
         self.net = initial_net.to(DEVICE)
         initial_params = [param.cpu().detach().numpy() for _, param in self.net.state_dict().items()]
-        self.initial_parameters = self.last_weights = fl.common.weights_to_parameters(initial_params)
+        # immutable versions of the global weights, current is the latest aggregate (restored after exploration)
+        self.weight_store = WeightStore()
+        self.weight_store.add(weights_to_parameters(initial_params).tensors, 'current')
+        self.fit_base = None
+        self.folding = None
+        self.downlink = None
+        self.transport = ShmTransport('feathers_bcast') if config.SHM_TRANSPORT else None
+        if config.DOWNLINK_VERSIONS > 0 and self.transport is None:
+            self.downlink = DownlinkVersions(len(initial_params), config.DOWNLINK_VERSIONS, config.DOWNLINK_COMPRESSION)
         dataset_iterator = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW)
-        dataset_iterator.partition() # distribute data
+        dataset_iterator.partition(config.PARTITION_MODE, config.DIRICHLET_ALPHA, config.PARTITION_SEED) # distribute data
         self.test_data = dataset_iterator.load_server_data()
         self.test_loader = DataLoader(self.test_data, batch_size=config.BATCH_SIZE, pin_memory=True, num_workers=2)
         self.current_round = 0
@@ -95,7 +110,7 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.discount_factor = baseline_discount
         self.gain_history = []
         self.current_config_idx = None
-        self.old_weights = self.initial_parameters
+        self.checkpoint = None # version and path of the last persisted model
         self.log_round = 0
         self.current_exploration = None
         self.gamma = gamma
@@ -103,6 +118,14 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.exploration_steps = 0
         self.reward_history = []
         self.stage = stage
+        # evaluation of the global model in a background process, s.t. the next round starts right away
+        self.eval_worker = EvalWorker(deepcopy(self.net).cpu(), stage, self.writer.logdir) if config.ASYNC_EVAL else None
+        self.eval_results = {} # round -> (loss, metrics) of the evaluations finished by the worker
+        # evaluation on shards of the test-set by cpu worker processes (done by the background worker with ASYNC_EVAL)
+        self.sharded_eval = None
+        if config.EVAL_SHARDS > 0 and self.eval_worker is None:
+            self.sharded_eval = ShardedEvaluator(deepcopy(self.net).cpu(), stage, config.EVAL_SHARDS)
+        self.eval_cache = EvalCache(config.EVAL_CACHE_SIZE) if config.EVAL_CACHE_SIZE > 0 else None
 
         # logging (also logs genotypes)
         self.log_format = '%(asctime)s %(message)s'
@@ -116,6 +139,36 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         logging.getLogger().addHandler(fh)
         logging.getLogger().setLevel(logging.INFO)
 
+    def configure_fit(self, rnd, parameters, client_manager):
+        instructions = super().configure_fit(rnd, parameters, client_manager)
+        if self.downlink is not None:
+            instructions, parameters = self.downlink.rewrite(parameters, instructions)
+        # remember the parameters the clients hold, compressed uploads are deltas to them
+        self.fit_base = parameters
+        if self.transport is not None:
+            instructions = self.transport.broadcast(parameters, instructions)
+        if self._exploring():
+            # the weights of an exploration round are discarded, only the metrics of the clients are used
+            self.folding = None
+            return instructions
+        # fold the weights of each client as soon as they arrive
+        self.folding = FoldingRound(self.transport)
+        return self.folding.wrap(instructions)
+
+    def _exploring(self):
+        """
+        Whether the current round explores hyperparameters (the global weights are kept).
+        """
+        return self.current_round % 10 == 0
+
+    def configure_evaluate(self, rnd, parameters, client_manager):
+        instructions = super().configure_evaluate(rnd, parameters, client_manager)
+        if self.downlink is not None:
+            instructions, _ = self.downlink.rewrite(parameters, instructions)
+        if self.transport is not None:
+            instructions = self.transport.broadcast(parameters, instructions)
+        return instructions
+
     def aggregate_fit(
         self,
         rnd: int,
@@ -134,15 +187,20 @@ class HANFStrategy(fl.server.strategy.FedAvg):
             Optional[fl.common.Weights]: Aggregated weights, the updated distribution and the possible hyperparameter-configurations.
         """
 
+        if self.downlink is not None:
+            self.downlink.acknowledge(results)
+        if self.transport is not None:
+            self.transport.receive([res.parameters for _, res in results])
+
         # obtain client weights
         samples = np.array([fit_res[1].num_examples for fit_res in results])
         weights = samples / np.sum(samples)
 
         self.log_round += 1
 
-        if self.current_round % 10 == 0:
+        if self._exploring():
             print("======================= EXPLORING PHASE ======================")
-            aggregated_weights = deepcopy(self.old_weights)
+            aggregated_weights = self.weight_store.get('current').parameters()
             if self.current_exploration is None:
                 self._sample_hyperparams()
             if len(self.current_exploration) > 0:
@@ -159,13 +217,16 @@ class HANFStrategy(fl.server.strategy.FedAvg):
                 self.gain_history = []
         else:
             self.current_round += 1
-            aggregated_weights, _ = super().aggregate_fit(rnd, results, failures)
-            self.old_weights = aggregated_weights
+            aggregated_weights = aggregate_fit_results(results, self.fit_base, self.folding)
+            if self.downlink is not None:
+                # continue from the weights the clients reconstruct from the (quantized) step
+                aggregated_weights = self.downlink.reconstruct(aggregated_weights)
+            self.weight_store.add(aggregated_weights.tensors, 'current')
         
         # sample hyperparameters and append them to the parameters
         logging.info('hyperparam_configuration = %s', self.hyperparams[self.current_config_idx])
-        serialized_idx = ndarray_to_proto(np.array([self.current_config_idx]))
-        aggregated_weights.tensors.append(serialized_idx.ndarray)
+        serialized_idx = encode(np.array([self.current_config_idx]))
+        aggregated_weights.tensors.append(serialized_idx)
 
         log_hyper_config(self.hyperparams[self.current_config_idx], rnd, self.writer)
 
@@ -200,6 +261,8 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         Returns:
             _type_: Aggregated loss and metrics
         """
+        if self.downlink is not None:
+            self.downlink.acknowledge(results)
         loss, _ = super().aggregate_evaluate(rnd, results, failures)
         accuracies = np.array([res.metrics['accuracy'] for _, res in results])
         # assign weight to each client
@@ -222,15 +285,24 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         Returns:
             _type_: Initial model weights, distribution and hyperparameter configurations.
         """
-        serialized_idx = ndarray_to_proto(np.array([0]))
-        self.initial_parameters.tensors.append(serialized_idx.ndarray)
-        return self.initial_parameters
+        serialized_idx = encode(np.array([0]))
+        return self.weight_store.get('current').parameters(serialized_idx)
 
     def set_parameters(self, parameters):
         params_dict = zip(self.net.state_dict().keys(), parameters)
-        state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
+        state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
         self.net.load_state_dict(state_dict, strict=True)
 
+    def load_parameters(self, parameters):
+        """
+        Loads parameters into the net unless it holds their version already. Returns the version or None if unknown.
+        """
+        version = self.weight_store.find(parameters.tensors)
+        if version is None or version is not self.weight_store.get('loaded'):
+            self.set_parameters(version.weights() if version is not None else parameters_to_weights(parameters))
+            self.weight_store.set('loaded', version)
+        return version
+
     def update_rewards(self):
         # log rewards
         self.reward_history.append(self.reward_estimates)
@@ -275,16 +347,44 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.gain_history.append([config_idx, avg_gains])
 
 
+    def _log_evaluation(self, future):
+        # called by the worker's result thread once the evaluation of a round has finished
+        try:
+            rnd, loss, metrics, genotype = future.result()
+        except Exception as e:
+            logging.error('evaluation failed: %s', e)
+            return
+        self.eval_results[rnd] = (loss, metrics)
+        logging.info('round %d: test loss %f, test accuracy %f', rnd, loss, metrics['accuracy'])
+        if genotype is not None:
+            logging.info('genotype = %s', genotype)
+
     def evaluate(self, parameters: fl.common.typing.Parameters):
-        params = []
-        for param in parameters.tensors:
-            pnpa = ProtobufNumpyArray(param)
-            weight = proto_to_ndarray(pnpa)
-            params.append(weight)
-        self.set_parameters(params)
-        if self.stage == 'valid':
-            self.net.drop_path_prob = config.DROP_PATH_PROB * self.current_round / config.ROUNDS
-        loss, accuracy, f1_micro, f1_macro = _test(self.net, self.test_loader, self.writer, self.current_round, self.stage)
+        drop_path_prob = config.DROP_PATH_PROB * self.current_round / config.ROUNDS if self.stage == 'valid' else None
+        if self.eval_worker is not None:
+            version = self.weight_store.find(parameters.tensors)
+            tensors = version.tensors if version is not None else parameters.tensors
+            self.eval_worker.submit(self.current_round, version.version if version is not None else None, tensors,
+                                    drop_path_prob, self._log_evaluation)
+            # since evaluate is the last method being called in one round, step rtpt here
+            self.rtpt.step()
+            return None
+        version = self.load_parameters(parameters)
+        if drop_path_prob is not None:
+            self.net.drop_path_prob = drop_path_prob
+        tensors = version.tensors if version is not None else parameters.tensors
+
+        def test():
+            if self.sharded_eval is not None:
+                return self.sharded_eval.test(version.version if version is not None else None, tensors,
+                                              self.writer, self.current_round, drop_path_prob)
+            return _test(self.net, self.test_loader, self.writer, self.current_round, self.stage)
+
+        # the weights restored after an exploration phase have been evaluated already
+        if self.eval_cache is not None:
+            loss, accuracy, f1_micro, f1_macro = self.eval_cache.memoize(weights_digest(tensors), test)
+        else:
+            loss, accuracy, f1_micro, f1_macro = test()
 
         # log metrics to tensorboard
         self.writer.add_scalar('Test_Loss', loss, self.current_round)
@@ -293,8 +393,11 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.writer.add_scalar('Test_F1_Macro', f1_macro)
         log_model_weights(self.net, self.current_round, self.writer)
 
-        # persist model
-        torch.save(self.net, './models/net_round_{}'.format(self.current_round))
+        # persist model, unless this round's checkpoint holds the version already (exploration)
+        path = './models/net_round_{}'.format(self.current_round)
+        if version is None or self.checkpoint != (version.version, path):
+            torch.save(self.net, path)
+            self.checkpoint = (version.version, path) if version is not None else None
 
         # log current genotype if we are in architecture search phase
         if self.stage == 'search':
@@ -347,4 +347,18 @@ def grad_sampler_mixed_op(layer: MixedOp, activations: torch.Tensor, backprops:
   ret = {
       layer.alphas: final_grad.t()
   }
-  return ret
\ No newline at end of file
+  return ret
+
+
+def branch_mask(net, threshold):
+  """
+  Returns for each entry of the state_dict of the supernet net (Network or TabularNetwork) whether it is uploaded
+  in a sparse upload, i.e. it does not belong to a branch of a MixedOp whose softmax-weight is below threshold.
+  """
+  weights = {}
+  for i, cell in enumerate(net.cells):
+    for e, (parallel_op, mixed_op) in enumerate(cell._ops):
+      alphas = torch.softmax(mixed_op.alphas, 0).detach().cpu().numpy()
+      for k in range(len(parallel_op._ops)):
+        weights['cells.{}._ops.{}.0._ops.{}'.format(i, e, k)] = alphas[k]
+  return [weights.get('.'.join(key.split('.')[:7]), threshold) >= threshold for key in net.state_dict().keys()]
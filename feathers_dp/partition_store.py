@@ -0,0 +1,103 @@
+import os
+import json
+import numpy as np
+
+
+def pack_partitions(partitions):
+    """
+    Concatenates a list of index-arrays (one per client) into one flat array and an offset table,
+    s.t. the indices of client i are flat[offsets[i]:offsets[i+1]].
+    """
+    lengths = np.array([len(p) for p in partitions], dtype=np.int64)
+    offsets = np.zeros(len(partitions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.concatenate([np.asarray(p).reshape(-1) for p in partitions]) if len(partitions) > 0 else np.zeros(0, dtype=np.int64)
+    return flat, offsets
+
+def index_dtype(n):
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+
+class PartitionStore:
+    """
+    Binary on-disk store of the client partitions. For each split (train, val) the indices of all clients are
+    stored as one flat array together with an offset table, the labels of these samples (same layout) and
+    a label histogram per client. All arrays are .npy files which are memory-mapped when read, thus
+    a client only touches its own slice instead of parsing the partitions of all clients.
+    """
+
+    SPLITS = ('train', 'val')
+
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+
+    @staticmethod
+    def write(path, splits, test_inds, n_classes, meta=None):
+        """
+        Persists the partitions.
+
+        Args:
+            path (str): Directory of the store
+            splits (dict): Maps split-name to a tuple (flat indices, offsets, flat labels) as obtained by pack_partitions
+            test_inds (np.ndarray): Indices of the server's test-set
+            n_classes (int): Number of classes, used for the label histograms
+            meta (dict, optional): Additional information stored alongside (e.g. partitioning parameters). Defaults to None.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        n_clients = None
+        for split, (flat, offsets, labels) in splits.items():
+            n_clients = len(offsets) - 1
+            dtype = index_dtype(int(flat.max()) + 1 if len(flat) > 0 else 0)
+            clients = np.repeat(np.arange(n_clients), np.diff(offsets))
+            hist = np.bincount(clients * n_classes + labels, minlength=n_clients * n_classes).reshape(n_clients, n_classes)
+            np.save(os.path.join(path, f'{split}_indices.npy'), flat.astype(dtype, copy=False))
+            np.save(os.path.join(path, f'{split}_offsets.npy'), offsets.astype(np.int64, copy=False))
+            np.save(os.path.join(path, f'{split}_labels.npy'), labels.astype(index_dtype(n_classes), copy=False))
+            np.save(os.path.join(path, f'{split}_hist.npy'), hist)
+        test_inds = np.asarray(test_inds).reshape(-1)
+        np.save(os.path.join(path, 'test_indices.npy'), test_inds.astype(index_dtype(int(test_inds.max()) + 1 if len(test_inds) > 0 else 0), copy=False))
+        # meta-data is written last, a store without it is considered incomplete
+        meta_dict = dict(meta or {})
+        meta_dict.update({'n_clients': n_clients, 'n_classes': n_classes, 'splits': list(splits.keys())})
+        with open(os.path.join(path, 'meta.json'), 'w+') as f:
+            json.dump(meta_dict, f)
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def _slice(self, split, name, client_id):
+        offsets = self._array(f'{split}_offsets')
+        start, end = int(offsets[client_id]), int(offsets[client_id + 1])
+        return np.array(self._array(f'{split}_{name}')[start:end])
+
+    def client_indices(self, split, client_id):
+        return self._slice(split, 'indices', client_id)
+
+    def client_labels(self, split, client_id):
+        return self._slice(split, 'labels', client_id)
+
+    def label_histogram(self, split, client_id=None):
+        """
+        Returns the label histogram of one client or (if client_id is None) the matrix of all clients.
+        """
+        hist = self._array(f'{split}_hist')
+        if client_id is None:
+            return np.array(hist)
+        return np.array(hist[client_id])
+
+    def test_indices(self):
+        return np.array(self._array('test_indices'))
+
+    @property
+    def n_clients(self):
+        return self.meta['n_clients']
@@ -0,0 +1,125 @@
+"""
+Vectorized partitioning of datasets among clients. All partitioners work on the label-vector only,
+draw their randomness from an explicit np.random.Generator and return the partitions in the compact
+format of the PartitionStore, i.e. a flat index-array and an offset table (client i holds flat[offsets[i]:offsets[i+1]]).
+"""
+import numpy as np
+
+PARTITION_MODES = ('iid', 'label', 'dirichlet', 'quantity')
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def _group_by_client(inds, clients, n_clients):
+    # stable sort keeps the (random) order of the samples within each client
+    order = np.argsort(clients, kind='stable')
+    return inds[order], _offsets(np.bincount(clients, minlength=n_clients))
+
+def _even_counts(n, n_clients):
+    # same sizes as np.array_split
+    counts = np.full(n_clients, n // n_clients, dtype=np.int64)
+    counts[:n % n_clients] += 1
+    return counts
+
+def partition_iid(inds, n_clients, rng):
+    """
+    Shuffles inds and splits them into n_clients (almost) equally sized partitions.
+    """
+    inds = rng.permutation(np.asarray(inds))
+    return inds, _offsets(_even_counts(len(inds), n_clients))
+
+def partition_quantity_skew(inds, n_clients, alpha, rng, min_size=1):
+    """
+    Random partitions whose sizes follow a Dirichlet(alpha) distribution over the clients. Labels stay iid.
+    """
+    inds = rng.permutation(np.asarray(inds))
+    min_size = min(min_size, len(inds) // n_clients)
+    proportions = rng.dirichlet(np.full(n_clients, alpha))
+    counts = rng.multinomial(len(inds) - min_size * n_clients, proportions) + min_size
+    return inds, _offsets(counts)
+
+def partition_dirichlet(targets, n_clients, alpha, rng, inds=None):
+    """
+    Label skew where the share of each class assigned to the clients follows a Dirichlet(alpha) distribution.
+    Small alpha leads to clients holding only a few classes, large alpha approaches the iid case.
+    """
+    inds = np.arange(len(targets)) if inds is None else np.asarray(inds)
+    labels = np.asarray(targets)[inds]
+    classes, labels = np.unique(labels, return_inverse=True)
+    # shuffle, then sort by class s.t. the samples of each class form a contiguous, randomly ordered block
+    perm = rng.permutation(len(inds))
+    perm = perm[np.argsort(labels[perm], kind='stable')]
+    class_counts = np.bincount(labels, minlength=len(classes))
+    proportions = rng.dirichlet(np.full(n_clients, alpha), size=len(classes))
+    counts = rng.multinomial(class_counts, proportions) # (classes x clients)
+    clients = np.repeat(np.tile(np.arange(n_clients), len(classes)), counts.reshape(-1))
+    return _group_by_client(inds[perm], clients, n_clients)
+
+def partition_label_skew(targets, n_clients, skew, rng, inds=None):
+    """
+    The "runner split" label skew: labels are grouped into ranges of consecutive labels and a fraction skew of the samples
+    of each range is distributed among the clients of that range only. The remaining samples are distributed uniformly.
+    """
+    inds = np.arange(len(targets)) if inds is None else np.asarray(inds)
+    labels = np.asarray(targets)[inds]
+    n_labels = len(np.unique(labels))
+    labels_per_group = round(max(1, n_labels / n_clients))
+    clients_per_group = round(max(1, n_clients / n_labels))
+    groups = np.searchsorted(np.unique(labels), labels) // labels_per_group
+    # rank of each sample within its group (in random order)
+    perm = rng.permutation(len(inds))
+    perm = perm[np.argsort(groups[perm], kind='stable')]
+    group_sizes = np.bincount(groups)
+    starts = _offsets(group_sizes)[:-1]
+    sorted_groups = groups[perm]
+    rank = np.arange(len(perm)) - starts[sorted_groups]
+    n_selected = np.floor(skew * group_sizes).astype(np.int64)
+    selected = rank < n_selected[sorted_groups]
+    # selected samples are split among the clients of their group, groups exceeding n_clients wrap around
+    chunk = (rank[selected] * clients_per_group) // np.maximum(n_selected[sorted_groups[selected]], 1)
+    clients_selected = (sorted_groups[selected] * clients_per_group + chunk) % n_clients
+    # remaining samples are distributed uniformly
+    remaining = perm[~selected]
+    remaining = remaining[rng.permutation(len(remaining))]
+    clients_remaining = np.repeat(np.arange(n_clients), _even_counts(len(remaining), n_clients))
+    clients = np.concatenate((clients_selected, clients_remaining))
+    positions = np.concatenate((perm[selected], remaining))
+    return _group_by_client(inds[positions], clients, n_clients)
+
+def partition(targets, n_clients, mode='label', rng=None, skew=0, alpha=0.5, inds=None):
+    """
+    Partitions the samples inds (defaults to all) of a dataset with labels targets among n_clients.
+
+    Args:
+        targets (np.ndarray): Labels of the whole dataset
+        n_clients (int): Number of clients
+        mode (str, optional): One of iid, label (runner split, skew=0 is iid), dirichlet and quantity. Defaults to 'label'.
+        rng (np.random.Generator, optional): Source of randomness. Defaults to None (seed 42).
+        skew (float, optional): Fraction of samples distributed skewed in label-mode. Defaults to 0.
+        alpha (float, optional): Concentration of the Dirichlet distribution in dirichlet- and quantity-mode. Defaults to 0.5.
+        inds (np.ndarray, optional): Subset of samples to partition. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Flat indices and offsets
+    """
+    rng = np.random.default_rng(42) if rng is None else rng
+    inds = np.arange(len(targets)) if inds is None else np.asarray(inds)
+    if mode == 'iid' or (mode == 'label' and skew == 0):
+        return partition_iid(inds, n_clients, rng)
+    elif mode == 'label':
+        return partition_label_skew(targets, n_clients, skew, rng, inds)
+    elif mode == 'dirichlet':
+        return partition_dirichlet(targets, n_clients, alpha, rng, inds)
+    elif mode == 'quantity':
+        return partition_quantity_skew(inds, n_clients, alpha, rng)
+    raise ValueError('Unknown partition mode {}, must be one of {}'.format(mode, PARTITION_MODES))
+
+def split_val_test(n, rng):
+    """
+    Randomly assigns each of the n samples of the validation set either to the clients' validation set or the server's test set.
+    """
+    in_val = rng.random(n) < 0.5
+    return np.flatnonzero(in_val), np.flatnonzero(~in_val)
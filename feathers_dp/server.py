@@ -10,6 +10,17 @@ import argparse
 from genotypes import GENOTYPE
 from opacus import PrivacyEngine
 
+def shutdown_strategy(strategy):
+    """
+    Releases the worker processes and the shared memory of the strategy once the federation has ended.
+    """
+    if strategy.eval_worker is not None:
+        strategy.eval_worker.shutdown() # wait for the evaluation of the last rounds
+    if strategy.sharded_eval is not None:
+        strategy.sharded_eval.shutdown()
+    if strategy.transport is not None:
+        strategy.transport.close()
+
 def start_server_search(rounds):
     device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) 
     criterion = nn.CrossEntropyLoss()
@@ -38,11 +49,15 @@ def start_server_search(rounds):
     )
 
     # Start server
-    fl.server.start_server(
-        server_address="0.0.0.0:{}".format(config.PORT),
-        config={"num_rounds": rounds},
-        strategy=strategy,
-    )
+    try:
+        fl.server.start_server(
+            server_address="0.0.0.0:{}".format(config.PORT),
+            config={"num_rounds": rounds},
+            strategy=strategy,
+            grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH,
+        )
+    finally:
+        shutdown_strategy(strategy)
 
 def start_server_valid(rounds):
     device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) 
@@ -72,11 +87,15 @@ def start_server_valid(rounds):
     )
 
     # Start server
-    fl.server.start_server(
-        server_address="[::]:{}".format(config.PORT),
-        config={"num_rounds": rounds},
-        strategy=strategy,
-    )
+    try:
+        fl.server.start_server(
+            server_address="[::]:{}".format(config.PORT),
+            config={"num_rounds": rounds},
+            strategy=strategy,
+            grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH,
+        )
+    finally:
+        shutdown_strategy(strategy)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
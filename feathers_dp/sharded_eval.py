@@ -0,0 +1,125 @@
+"""
+Sharded evaluation of the server's test-set on the cpu. The test-set is split into one shard per worker process, each
+worker holds a replica of the net and the loader of its shard. The weights are published once into shared memory (see
+shm_transport.py) and evaluated by all workers in parallel, their loss, correct counts and confusion matrices are reduced
+by the server.
+"""
+import multiprocessing as mp
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import flwr as fl
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+import config
+from codec import decode, to_torch, TENSOR_TYPE
+from shm_transport import ShmTransport
+from utils import get_dataset_loder
+
+# state of a worker process
+_NET = None
+_LOADER = None
+_STAGE = None
+_TRANSPORT = None
+_LOADED = None # version of the weights held by _NET
+
+
+def _init_shard(net, stage, shard, n_shards):
+    global _NET, _LOADER, _STAGE, _TRANSPORT
+    # the workers share the cores of the host
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_shards))
+    _NET = net
+    _NET.eval()
+    _STAGE = stage
+    _TRANSPORT = ShmTransport('feathers_eval')
+    test_data = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW).load_server_data()
+    shard_data = Subset(test_data, range(shard, len(test_data), n_shards))
+    _LOADER = DataLoader(shard_data, batch_size=config.BATCH_SIZE, num_workers=0)
+
+def confusion_matrix(labels, predicted, n_classes):
+    return np.bincount(labels * n_classes + predicted, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+def _evaluate_shard(version, refs, drop_path_prob):
+    """
+    Evaluates the net on the shard of the worker, returns the sum of the batch losses, number of samples, the confusion
+    matrix and the logits of the first batch.
+    """
+    global _LOADED
+    if version is None or version != _LOADED:
+        parameters = fl.common.Parameters(tensors=list(refs), tensor_type=TENSOR_TYPE)
+        _TRANSPORT.receive([parameters])
+        params_dict = zip(_NET.state_dict().keys(), parameters.tensors)
+        _NET.load_state_dict(OrderedDict({k: to_torch(decode(v)) for k, v in params_dict}), strict=True)
+        _LOADED = version
+    if drop_path_prob is not None:
+        _NET.drop_path_prob = drop_path_prob
+    criterion = torch.nn.BCELoss() if config.CLASSES == 2 else torch.nn.CrossEntropyLoss()
+    n_classes = max(config.CLASSES, 2)
+    loss, total, logits = 0.0, 0, None
+    confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+    with torch.no_grad():
+        for feats, labels in _LOADER:
+            if _STAGE == 'search':
+                preds = _NET(feats)
+            else:
+                preds, preds_aux = _NET(feats)
+            if logits is None:
+                logits = preds.numpy()
+            if config.CLASSES > 2:
+                loss += criterion(preds, labels).item()
+                _, predicted = torch.max(preds.data, 1)
+            else:
+                loss += criterion(preds, labels.float()).item()
+                predicted = (preds.data >= 0.5).long()
+            confusion += confusion_matrix(labels.long().view(-1).numpy(), predicted.view(-1).numpy(), n_classes)
+            total += labels.size(0)
+    return loss, total, confusion, logits
+
+
+class ShardedEvaluator:
+
+    def __init__(self, net, stage, n_shards) -> None:
+        """
+        Pool of worker processes evaluating the net on shards of the server's test-set.
+
+        Args:
+            net (nn.Module): Replica of the server's net (on the cpu)
+            stage (str): search or valid
+            n_shards (int): Number of worker processes (shards)
+        """
+        # one single-process pool per shard, s.t. each worker keeps the data of its shard
+        context = mp.get_context('spawn')
+        self.executors = [ProcessPoolExecutor(1, mp_context=context, initializer=_init_shard, initargs=(net, stage, shard, n_shards))
+                          for shard in range(n_shards)]
+        self.transport = ShmTransport('feathers_eval')
+
+    def test(self, version, tensors, writer, round, drop_path_prob=None):
+        """
+        Counterpart of _test of the strategy, evaluates the encoded weight tensors (of version, None if unknown) on the
+        test-set. Returns loss, accuracy, f1-micro and f1-macro, the f1-scores are those of all samples instead of the
+        mean over the batches.
+        """
+        refs = self.transport.publish(tensors)
+        futures = [executor.submit(_evaluate_shard, version, refs, drop_path_prob) for executor in self.executors]
+        results = [future.result() for future in futures]
+        loss = sum(r[0] for r in results)
+        total = sum(r[1] for r in results)
+        confusion = sum(r[2] for r in results)
+        for _, _, _, logits in results:
+            if logits is not None:
+                writer.add_histogram('logits', logits, round)
+        loss /= total
+        accuracy = np.trace(confusion) / total
+        # f1-scores of all samples, classes neither present nor predicted are left out (like sklearn)
+        tp = np.diag(confusion).astype(np.float64)
+        support, predicted = confusion.sum(axis=1), confusion.sum(axis=0)
+        present = (support + predicted) > 0
+        f1_macro = (2 * tp[present] / (support[present] + predicted[present])).mean()
+        f1_micro = accuracy
+        return loss, accuracy, f1_micro, f1_macro
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        self.transport.close()
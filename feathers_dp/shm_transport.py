@@ -0,0 +1,122 @@
+"""
+Shared-memory transport for clients running on the same host as the server (e.g. started by clients.py). The server
+writes the weights it broadcasts into one shared-memory segment per round, which all clients map read-only, each client
+writes its uploads into a segment of its own (slot) reused in every round. The messages exchanged over gRPC only carry
+references (segment, offset, size) to the tensors, the receiver decodes them in place.
+"""
+import os
+import struct
+from multiprocessing import shared_memory, resource_tracker
+import flwr as fl
+
+REF_MAGIC = b'FTNR'
+_REF = struct.Struct('<4sQQ') # magic, offset, size, followed by the name of the segment
+_ALIGNMENT = 64
+
+
+def is_ref(buffer):
+    return bytes(buffer[:4]) == REF_MAGIC
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # attaching processes must not unlink the segment when they exit, this is up to its creator
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class ShmTransport:
+
+    def __init__(self, prefix, reuse=False) -> None:
+        """
+        Writes tensors into shared-memory segments and resolves references to segments written by other processes.
+
+        Args:
+            prefix (str): Prefix of the names of the segments created
+            reuse (bool, optional): Overwrite the segment of the last message if it is large enough (upload slot of a client),
+                                    otherwise every message gets a new segment and the previous one is unlinked. Defaults to False.
+        """
+        self.prefix = prefix
+        self.reuse = reuse
+        self.segment = None # segment written last
+        self.generation = 0
+        self.source = None # tensors written last
+        self.refs = None
+        self.attached = {} # name -> SharedMemory
+
+    def _allocate(self, size):
+        if self.segment is not None:
+            if self.reuse and self.segment.size >= size:
+                return self.segment
+            self.segment.close()
+            self.segment.unlink()
+        name = '{}_{}_{}'.format(self.prefix, os.getpid(), self.generation)
+        self.generation += 1
+        # headroom, s.t. a slot survives small changes of the upload size (e.g. sparse uploads)
+        self.segment = shared_memory.SharedMemory(name=name, create=True, size=max(1, (size + size // 8) if self.reuse else size))
+        return self.segment
+
+    def publish(self, tensors):
+        """
+        Writes the encoded tensors into a segment, returns the list of references to them.
+        """
+        if self.source is not None and len(tensors) == len(self.source) and all(a is b for a, b in zip(tensors, self.source)):
+            return self.refs
+        offsets, size = [], 0
+        for t in tensors:
+            offsets.append(size)
+            size += -(-len(t) // _ALIGNMENT) * _ALIGNMENT
+        segment = self._allocate(size)
+        refs = []
+        for t, offset in zip(tensors, offsets):
+            segment.buf[offset:offset + len(t)] = t
+            refs.append(_REF.pack(REF_MAGIC, offset, len(t)) + segment.name.encode())
+        self.source, self.refs = list(tensors), refs
+        return refs
+
+    def send(self, parameters):
+        """
+        Returns Parameters referencing the tensors of parameters written to the segment.
+        """
+        return fl.common.Parameters(tensors=self.publish(parameters.tensors), tensor_type=parameters.tensor_type)
+
+    def broadcast(self, parameters, instructions):
+        """
+        Replaces parameters in the instructions (list of (ClientProxy, FitIns/EvaluateIns)) by references to a single copy.
+        """
+        message = self.send(parameters)
+        return [(client, type(ins)(parameters=message, config=ins.config)) for client, ins in instructions]
+
+    def receive(self, messages, detach=True):
+        """
+        Replaces the references in the tensors of messages (list of Parameters) in place by read-only views into the
+        segments. With detach, segments referenced by none of the messages are detached.
+        """
+        names = set()
+        for parameters in messages:
+            tensors = parameters.tensors
+            for i in range(len(tensors)):
+                if not is_ref(tensors[i]):
+                    continue
+                _, offset, size = _REF.unpack_from(tensors[i])
+                name = bytes(tensors[i][_REF.size:]).decode()
+                if name not in self.attached:
+                    self.attached[name] = _attach(name)
+                names.add(name)
+                tensors[i] = self.attached[name].buf[offset:offset + size].toreadonly()
+        if not detach:
+            return
+        for name in [name for name in self.attached if name not in names]:
+            try:
+                self.attached[name].close()
+                del self.attached[name]
+            except BufferError:
+                pass # still referenced by arrays of a previous message, retried with the next one
+
+    def close(self):
+        for shm in self.attached.values():
+            shm.close()
+        self.attached = {}
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
@@ -4,11 +4,11 @@ import torch
 import shutil
 import torchvision.transforms as transforms
 from torch.autograd import Variable
-from torch.utils.data import random_split, Subset
+from torch.utils.data import random_split, Subset, DataLoader, RandomSampler
 import torchvision
-import math
-import json
 from fraud_detection import FraudDetectionData
+from partition_store import PartitionStore
+from partitioning import partition, split_val_test
 import torch.nn as nn
 
 class Loader:
@@ -19,47 +19,75 @@ class Loader:
         self.indspath = indspath
         self.train_data = None
         self.val_data = None
+        self.store = None
 
-    def partition(self):
+    def partition(self, mode='label', alpha=0.5, seed=42):
         """
-        Loads the Fashion-MNIST dataset
+        Partitions the dataset among the clients and persists the partitions in a PartitionStore.
+        If the store already holds partitions obtained with the same parameters, these are reused.
+
+        Args:
+            mode (str, optional): Partitioning mode, one of iid, label, dirichlet, quantity. Defaults to 'label'.
+            alpha (float, optional): Concentration parameter of dirichlet and quantity mode. Defaults to 0.5.
+            seed (int, optional): Seed of the partitioning. Defaults to 42.
         """
-        self.train_partitions, self.val_partitions, self.test_set, train_inds, val_inds, test_inds = partition_skewed(self.train_data, self.val_data, self.n_clients, skew=self.skew)
-        train_dict, val_dict = {}, {}
-        for i, inds in enumerate(train_inds):
-            train_dict[i] = inds.tolist()
-        for i, inds in enumerate(val_inds):
-            val_dict[i] = inds.tolist()
-        json_dict = {
-            'train': train_dict,
-            'val': val_dict,
-            'test': test_inds.tolist()
+        train_targets = get_targets(self.train_data).numpy()
+        val_targets = get_targets(self.val_data).numpy()
+        meta = {'mode': mode, 'skew': self.skew, 'alpha': alpha, 'seed': seed,
+                'n_train': len(train_targets), 'n_val': len(val_targets)}
+        if PartitionStore.exists(self.indspath):
+            store = PartitionStore(self.indspath)
+            if store.n_clients == self.n_clients and all(store.meta.get(k) == v for k, v in meta.items()):
+                self.store = store
+                return
+        rng = np.random.default_rng(seed)
+        n_classes = int(max(train_targets.max(), val_targets.max())) + 1
+        val_inds, test_inds = split_val_test(len(val_targets), rng)
+        train_flat, train_offsets = partition(train_targets, self.n_clients, mode, rng, self.skew, alpha)
+        val_flat, val_offsets = partition(val_targets, self.n_clients, mode, rng, self.skew, alpha, inds=val_inds)
+        splits = {
+            'train': (train_flat, train_offsets, train_targets[train_flat]),
+            'val': (val_flat, val_offsets, val_targets[val_flat])
         }
-        with open(self.indspath, 'w+') as f:
-            json.dump(json_dict, f)
+        PartitionStore.write(self.indspath, splits, test_inds, n_classes, meta)
+        self.store = None
+
+    def _store(self):
+        if self.store is None:
+            self.store = PartitionStore(self.indspath)
+        return self.store
 
     def load_client_data(self, client_id):
-        with open(self.indspath, 'r') as f:
-            inds_dict = json.load(f)
-        train_inds = np.array(inds_dict['train'][str(client_id)])
-        val_inds = np.array(inds_dict['val'][str(client_id)])
+        store = self._store()
+        train_inds = store.client_indices('train', client_id)
+        val_inds = store.client_indices('val', client_id)
         trainset = Subset(self.train_data, train_inds)
         valset = Subset(self.val_data, val_inds)
         return trainset, valset
 
+    def load_client_labels(self, client_id, split='train'):
+        """
+        Labels of the samples of a client (in the order of its indices), read from the store without touching the data
+        """
+        return torch.from_numpy(self._store().client_labels(split, client_id).astype(np.int64))
+
+    def label_histogram(self, client_id=None, split='train'):
+        """
+        Label histogram of a client, or of each client (n_clients x n_classes) if client_id is None
+        """
+        return self._store().label_histogram(split, client_id)
+
     def load_server_data(self):
-        with open(self.indspath, 'r') as f:
-            inds_dict = json.load(f)
-        test_inds = np.array(inds_dict['test'])
+        test_inds = self._store().test_indices()
         testset = Subset(self.val_data, test_inds)
         return testset
          
     def get_client_data(self):
-        for train, val in zip(self.train_partitions, self.val_partitions):
-            yield train, val
+        for client_id in range(self._store().n_clients):
+            yield self.load_client_data(client_id)
 
     def get_test(self):
-        return self.test_set
+        return self.load_server_data()
 
 class FashionMNISTLoader(Loader):
 
@@ -89,9 +117,52 @@ class FraudDetection(Loader):
 
     def __init__(self, n_clients, indspath, skew=0) -> None:
        super().__init__(n_clients, indspath, skew)
-       self.train_data = FraudDetectionData('../datasets/ccFraud/', train=True)
-       self.val_data = FraudDetectionData('../datasets/ccFraud/', train=False)
-
+       self.train_data = FraudDetectionData('../datasets/ccFraud/', train=True, sample_fraction=0.005)
+       self.val_data = FraudDetectionData('../datasets/ccFraud/', train=False, sample_fraction=0.005)
+
+
+class SearchBatchStream:
+    """
+    Endless stream of minibatches drawn from the search-split which is used for the architecture-step.
+    The iterator of the wrapped loader is created once and kept alive across steps (and fit-calls), whenever
+    it is exhausted a new pass over the data is started transparently.
+    """
+
+    def __init__(self, loader) -> None:
+        self.loader = loader
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.loader)
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            # current pass is exhausted, start a new one (reshuffles the sampler)
+            self._iterator = iter(self.loader)
+            return next(self._iterator)
+
+def get_search_loader(data, batch_size, num_workers=2, pin_memory=True):
+    """
+    Loader for the search-split sampling with replacement. Workers are persistent s.t. they are not
+    spawned again for every new pass and keep prefetching batches in the background.
+    """
+    sampler = RandomSampler(data, replacement=True, num_samples=len(data))
+    return DataLoader(data, batch_size, sampler=sampler, pin_memory=pin_memory, 
+                      num_workers=num_workers, persistent_workers=num_workers > 0)
+
+def get_targets(data):
+    """
+    Returns the labels of data (dataset or Subset) as LongTensor without loading the samples.
+    """
+    if isinstance(data, Subset):
+        return get_targets(data.dataset)[torch.as_tensor(data.indices, dtype=torch.long)]
+    if isinstance(data, FraudDetectionData):
+        return data.y
+    return torch.as_tensor(data.targets, dtype=torch.long)
 
 def get_dataset_loder(dataset, num_clients, indspath, skew=0):
     if dataset == 'fmnist':
@@ -123,94 +194,6 @@ def partition_data(train_set, val_set, n_clients):
 
     return train_partitions, val_partitions, test
 
-def label_distribution_skew(x, y, partitions, skew=1):
-    def runner_split(N_labels, N_runners):
-        """number of labels to assign to n clients"""
-        runner_labels = round(max(1, N_labels / N_runners))
-        runner_split = round(max(1, N_runners / N_labels))
-        return runner_labels, runner_split
-
-    runn_inds = []
-    if not isinstance(y, torch.Tensor):
-        y = torch.tensor(y)
-    N_labels = torch.unique(y).shape[0]
-    n_labels, n_runners = runner_split(N_labels, partitions)
-    np.random.seed(42)
-    
-    selected_inds = []
-    for label_idx in range(0, N_labels, n_labels):
-        # get a range of labels (e.g. in case of MNIST labels between 0 and 3)
-        mask = torch.isin(y, torch.Tensor(np.arange(label_idx, label_idx+n_labels))).cpu().detach().numpy()
-        # get index of these labels
-        subset_idx = np.argwhere(mask)[:, 0]
-        n_samples = subset_idx.shape[0]
-        # randomly sample indices of size sample_size
-        sample_size = math.floor(skew*n_samples)
-        subset_idx = np.random.choice(subset_idx, sample_size, replace=False)
-        selected_inds += list(subset_idx)
-    
-        for partition in np.array_split(subset_idx, n_runners):
-            # add a data-partition for a runner
-            runn_inds.append(partition)
-    
-    selected = np.array(selected_inds)
-    mask = np.zeros(len(x))
-    mask[selected] = 1
-    not_selected = np.argwhere(mask == 0)
-    return runn_inds, not_selected
-
-def uniform_distribution(inds, partitions, randomise=True):
-    runner_data = []
-    if randomise:
-        # shuffle indices
-        np.random.shuffle(inds)
-    # split randomly chosen data-points and labels into partitions
-    for partition in np.array_split(inds, partitions):
-        runner_data.append(partition)
-    return runner_data
-
-def partition_skewed(train_set, val_set, partitions, randomise=True, skew=0):
-    # randomly select half of the data of the validation set to be the test-set
-    ind_in_val = np.random.choice([0, 1], p=[0.5, 0.5], size=len(val_set))
-    val_inds = np.argwhere(ind_in_val == 1).reshape(1, -1)[0]
-    test_inds = np.argwhere(ind_in_val == 0).reshape(1, -1)[0]
-    train_partitions, val_partitions, test_set = [], [], Subset(val_set, test_inds)
-    train_inds = np.arange(len(train_set))
-    train_subs_inds, val_subs_inds, test_subs_inds = [], [], test_inds
-    if skew == 0:
-        train_unfiorm = uniform_distribution(train_inds, partitions, randomise)
-        val_uniform = uniform_distribution(val_inds, partitions, randomise)
-        for t, v in zip(train_unfiorm, val_uniform):
-            train_subset = Subset(train_set, t)
-            val_subset = Subset(val_set, v)
-            train_partitions.append(train_subset)
-            val_partitions.append(val_subset)
-            train_subs_inds.append(t)
-            val_subs_inds.append(v)
-    else:
-        # build skewed data-sets
-        train_selected, train_inds_remain = label_distribution_skew(train_set.data, train_set.targets, partitions, skew)
-        val_selected, val_inds_remain = label_distribution_skew(val_set.data, val_set.targets, partitions, skew)
-        # if skew < 1 this will contain a list of all data-points that are not already assigned to some runner
-        train_uniform = uniform_distribution(train_inds_remain, partitions, randomise)
-        val_uniform = uniform_distribution(val_inds_remain, partitions, randomise)
-        # concatenate train and val set-indices obtained above
-        for s, p in zip(train_selected, train_uniform):
-            s = s.reshape(1, -1)[0]
-            p = p.reshape(1, -1)[0]
-            indices = np.concatenate((s, p))
-            subset = Subset(train_set, indices)
-            train_partitions.append(subset)
-            train_subs_inds.append(indices)
-        for s, p in zip(val_selected, val_uniform):
-            s = s.reshape(1, -1)[0]
-            p = p.reshape(1, -1)[0]
-            indices = np.concatenate((s, p))
-            subset = Subset(val_set, indices)
-            val_partitions.append(subset)
-            val_subs_inds.append(indices)
-    return train_partitions, val_partitions, test_set, train_subs_inds, val_subs_inds, test_subs_inds
-
 def discounted_mean(series, gamma=1.0):
     weight = gamma ** np.flip(np.arange(len(series)), axis=0)
     return np.inner(series, weight) / weight.sum()
@@ -0,0 +1,92 @@
+"""
+Server-side store of the versions of the global weights. A version is immutable, its tensors (bytes encoded by codec.py)
+are never modified. Thus the weights restored after an exploration phase, the weights evaluated and checkpointed by the
+server and those encoded for the clients all reference the same buffers instead of being copies. Parameters built from a
+version hold a new list of references to its tensors, appending the hyperparameters to it leaves the version unchanged.
+Versions are reference-counted by named references (e.g. current, loaded) and dropped once no reference is left.
+"""
+import flwr as fl
+from codec import decode, TENSOR_TYPE
+
+
+class WeightVersion:
+
+    def __init__(self, version, tensors) -> None:
+        self.version = version
+        self.tensors = tuple(tensors)
+        self._weights = None
+
+    def weights(self):
+        """
+        Returns the weights as list of read-only np.ndarray sharing memory with the tensors (decoded once).
+        """
+        if self._weights is None:
+            self._weights = [decode(t) for t in self.tensors]
+        return self._weights
+
+    def parameters(self, *extra):
+        """
+        Returns Parameters referencing the tensors of this version followed by the encoded tensors extra.
+        """
+        return fl.common.Parameters(tensors=list(self.tensors) + list(extra), tensor_type=TENSOR_TYPE)
+
+    def held_by(self, tensors):
+        """
+        Whether tensors (e.g. of Parameters built by parameters) start with the buffers of this version.
+        """
+        return len(tensors) >= len(self.tensors) and all(a is b for a, b in zip(self.tensors, tensors))
+
+    @property
+    def nbytes(self):
+        return sum(len(t) for t in self.tensors)
+
+
+class WeightStore:
+
+    def __init__(self) -> None:
+        self.versions = {} # version -> WeightVersion
+        self.counts = {} # version -> number of references
+        self.refs = {} # name -> WeightVersion
+        self.next_version = 0
+
+    def add(self, tensors, name):
+        """
+        Stores the encoded tensors as new version and points the reference name to it.
+        """
+        version = WeightVersion(self.next_version, tensors)
+        self.next_version += 1
+        self.versions[version.version] = version
+        self.counts[version.version] = 0
+        self.set(name, version)
+        return version
+
+    def set(self, name, version):
+        """
+        Points the reference name to version (or removes it if version is None), drops versions no longer referenced.
+        """
+        if version is not None:
+            self.counts[version.version] += 1
+        old = self.refs.pop(name, None)
+        if version is not None:
+            self.refs[name] = version
+        if old is not None:
+            self.counts[old.version] -= 1
+            if self.counts[old.version] == 0:
+                del self.counts[old.version]
+                del self.versions[old.version]
+
+    def get(self, name):
+        return self.refs.get(name)
+
+    def find(self, tensors):
+        """
+        Returns the stored version whose buffers tensors reference or None.
+        """
+        for version in self.versions.values():
+            if version.held_by(tensors):
+                return version
+        return None
+
+    @property
+    def nbytes(self):
+        return sum(version.nbytes for version in self.versions.values())
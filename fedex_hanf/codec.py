@@ -0,0 +1,204 @@
+"""
+Binary codec of the tensors exchanged between server and clients. Each tensor is encoded as a fixed header
+(magic, dtype, number of dimensions, offset of the data) followed by the shape and the raw contiguous bytes of the array.
+Decoding does not copy, the array is a view (np.frombuffer) into the received bytes.
+Optionally, clients upload the difference to the received weights quantized per tensor (fp16, bf16 or int8 with a scale),
+such a delta carries an additional header and is dequantized by the server while aggregating.
+Tensors omitted from an upload (None in the list of weights) are sent as the placeholder SKIP.
+"""
+import struct
+import warnings
+import numpy as np
+import flwr as fl
+import torch
+
+MAGIC = b'FTNS'
+DELTA_MAGIC = b'FTND'
+SKIP = b'FTNX' # placeholder of a tensor omitted from an upload
+TENSOR_TYPE = 'feathers.raw'
+DELTA_TENSOR_TYPE = 'feathers.delta'
+UPLOAD_MODES = ('fp32', 'fp16', 'bf16', 'int8')
+_HEADER = struct.Struct('<4s8sII') # magic, dtype, ndim, data offset
+_DELTA_HEADER = struct.Struct('<4s4s8sd') # magic, mode, dtype of the weights, scale
+_ALIGNMENT = 64
+
+
+def encode(array):
+    """
+    Encodes an np.ndarray into bytes.
+    """
+    array = np.asarray(array)
+    if not array.flags.c_contiguous:
+        array = array.copy(order='C')
+    if array.dtype.hasobject:
+        raise ValueError('Arrays of dtype {} can not be encoded'.format(array.dtype))
+    shape = struct.pack('<{}q'.format(array.ndim), *array.shape)
+    offset = -(-(_HEADER.size + len(shape)) // _ALIGNMENT) * _ALIGNMENT
+    header = _HEADER.pack(MAGIC, array.dtype.str.encode(), array.ndim, offset)
+    padding = bytes(offset - len(header) - len(shape))
+    return b''.join((header, shape, padding, memoryview(array.reshape(-1)).cast('B')))
+
+def decode(buffer):
+    """
+    Decodes bytes obtained by encode into a read-only np.ndarray sharing memory with buffer.
+    """
+    magic, dtype, ndim, offset = _HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('Buffer does not contain an encoded tensor')
+    shape = struct.unpack_from('<{}q'.format(ndim), buffer, _HEADER.size)
+    dtype = np.dtype(dtype.rstrip(b'\x00').decode())
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+def quantize(x, mode):
+    """
+    Quantizes the float32-array x, returns the quantized array and its scale.
+    """
+    if mode == 'fp32':
+        return x.astype(np.float32, copy=False), 1.0
+    elif mode == 'fp16':
+        finfo = np.finfo(np.float16)
+        return np.clip(x, finfo.min, finfo.max).astype(np.float16), 1.0
+    elif mode == 'bf16':
+        # upper 16 bits of the float32 representation, rounded to nearest even
+        bits = x.astype(np.float32, copy=False).view(np.uint32)
+        return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16), 1.0
+    elif mode == 'int8':
+        scale = float(np.abs(x).max()) / 127 if x.size > 0 else 0.0
+        scale = scale if scale > 0 else 1.0
+        return np.clip(np.rint(x / scale), -127, 127).astype(np.int8), scale
+    raise ValueError('Unknown upload mode {}, must be one of {}'.format(mode, UPLOAD_MODES))
+
+def dequantize(q, mode, scale):
+    if mode == 'bf16':
+        return (q.astype(np.uint32) << 16).view(np.float32)
+    elif mode == 'int8':
+        return q.astype(np.float32) * np.float32(scale)
+    return q.astype(np.float32)
+
+def encode_delta(payload, mode, dtype, scale=1.0):
+    """
+    Encodes a quantized delta (or with mode raw the full value of a non-float tensor) of a tensor of dtype.
+    """
+    header = _DELTA_HEADER.pack(DELTA_MAGIC, mode.encode(), np.dtype(dtype).str.encode(), scale)
+    return header + encode(payload)
+
+def is_skipped(buffer):
+    return bytes(buffer[:4]) == SKIP
+
+def is_delta(buffer):
+    return bytes(buffer[:4]) == DELTA_MAGIC
+
+def decode_delta(buffer):
+    """
+    Decodes bytes obtained by encode_delta, returns the dequantized delta (or raw value) in the dtype of the weights
+    and whether it is a delta.
+    """
+    _, mode, dtype, scale = _DELTA_HEADER.unpack_from(buffer)
+    mode, dtype = mode.rstrip(b'\x00').decode(), np.dtype(dtype.rstrip(b'\x00').decode())
+    payload = decode(memoryview(buffer)[_DELTA_HEADER.size:])
+    if mode == 'raw':
+        return payload, False
+    return dequantize(payload, mode, scale).astype(dtype, copy=False), True
+
+
+class DeltaEncoder:
+    """
+    Client-side encoding of uploads as quantized deltas to the received weights. The quantization error of each tensor
+    is kept and added to the delta of the next upload (error feedback), thus it is not lost but only delayed.
+    """
+
+    def __init__(self, mode) -> None:
+        if mode not in UPLOAD_MODES:
+            raise ValueError('Unknown upload mode {}, must be one of {}'.format(mode, UPLOAD_MODES))
+        self.mode = mode
+        self.residuals = None
+
+    def encode(self, weights, base):
+        """
+        Encodes weights (list of np.ndarray) as deltas to base, returns the list of encoded tensors.
+        """
+        if self.residuals is None or len(self.residuals) != len(weights):
+            self.residuals = [None] * len(weights)
+        tensors = []
+        for i, (w, b) in enumerate(zip(weights, base)):
+            if w is None:
+                # the residual is kept until the tensor is uploaded again
+                tensors.append(SKIP)
+                continue
+            if not np.issubdtype(w.dtype, np.floating):
+                tensors.append(encode_delta(w, 'raw', w.dtype))
+                continue
+            delta = w.astype(np.float32) - b.astype(np.float32, copy=False)
+            if self.residuals[i] is not None:
+                delta += self.residuals[i]
+            q, scale = quantize(delta, self.mode)
+            self.residuals[i] = None if self.mode == 'fp32' else delta - dequantize(q, self.mode, scale)
+            tensors.append(encode_delta(q, self.mode, w.dtype, scale))
+        return tensors
+
+    def encode_parameters(self, weights, base):
+        return fl.common.Parameters(tensors=self.encode(weights, base), tensor_type=DELTA_TENSOR_TYPE)
+
+
+def to_torch(array):
+    """
+    Wraps a (possibly read-only) decoded array into a tensor without copying, the tensor must not be written to.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning) # torch warns about non-writable arrays
+        return torch.from_numpy(array)
+
+def weights_to_parameters(weights):
+    return fl.common.Parameters(tensors=[encode(w) if w is not None else SKIP for w in weights], tensor_type=TENSOR_TYPE)
+
+def parameters_to_weights(parameters):
+    return [decode(t) for t in parameters.tensors]
+
+
+class CodecClient(fl.client.Client):
+    """
+    Wraps a NumPyClient s.t. its parameters are exchanged in the format of this codec instead of np.save.
+    With upload_mode set, fit uploads quantized deltas to the received weights. With a downlink decoder
+    (downlink.DownlinkDecoder), the client accepts versioned messages and reports the version it holds (metric dl_version).
+    With a transport (shm_transport.ShmTransport), tensors are exchanged through shared memory.
+    """
+
+    def __init__(self, numpy_client, upload_mode=None, downlink=None, transport=None) -> None:
+        self.numpy_client = numpy_client
+        self.delta_encoder = DeltaEncoder(upload_mode) if upload_mode is not None else None
+        self.downlink = downlink
+        self.transport = transport
+
+    def _receive(self, ins):
+        if self.transport is not None:
+            self.transport.receive([ins.parameters])
+        if self.downlink is None:
+            return parameters_to_weights(ins.parameters)
+        return self.downlink.receive(ins.parameters, ins.config)
+
+    def _report(self, metrics):
+        if self.downlink is None or self.downlink.version is None:
+            return metrics
+        return dict(metrics, dl_version=self.downlink.version)
+
+    def get_properties(self, ins):
+        return fl.common.PropertiesRes(properties=self.numpy_client.get_properties(ins.config))
+
+    def get_parameters(self):
+        return fl.common.ParametersRes(parameters=weights_to_parameters(self.numpy_client.get_parameters()))
+
+    def fit(self, ins):
+        received = self._receive(ins)
+        weights, num_examples, metrics = self.numpy_client.fit(received, ins.config)
+        if self.delta_encoder is not None:
+            # the received weights carry the hyperparameters as additional last tensor
+            parameters = self.delta_encoder.encode_parameters(weights, received[:len(weights)])
+        else:
+            parameters = weights_to_parameters(weights)
+        if self.transport is not None:
+            parameters = self.transport.send(parameters)
+        return fl.common.FitRes(parameters=parameters, num_examples=num_examples, metrics=self._report(metrics))
+
+    def evaluate(self, ins):
+        loss, num_examples, metrics = self.numpy_client.evaluate(self._receive(ins), ins.config)
+        return fl.common.EvaluateRes(loss=loss, num_examples=num_examples, metrics=self._report(metrics))
@@ -24,6 +24,16 @@ GPUS = [10, 11] # GPUs to use
 SERVER_GPU = 10
 
 DATA_SKEW = 0.5 # skew of labels. 0 = no skew, 1 only some clients hold some labels
+IN_MEMORY_DATA = False # materialize client partitions and server test-set as tensors on the device and serve batches by slicing
+UPLOAD_COMPRESSION = None # None uploads the full weights. fp32, fp16, bf16 or int8 upload the (quantized) difference to the received weights, with error feedback
+DOWNLINK_VERSIONS = 0 # number of versions of the global weights the server keeps to send clients only the steps from the version they hold (0 = always send the full weights)
+DOWNLINK_COMPRESSION = None # None sends the steps exactly, fp16, bf16 or int8 quantize them (the server continues from the weights the clients reconstruct, the quantization error is carried into the next step)
+SHM_TRANSPORT = False # clients run on the host of the server (clients.py): weights are exchanged through shared memory, the gRPC messages only carry references
+GRPC_MAX_MESSAGE_LENGTH = 536870912 # maximum size of a gRPC message (server and clients), flwr's default (512 MB). The weights and hyperparameters are sent as one message, raise it by hand (gRPC allows up to 2 GB) for larger supernets or use SHM_TRANSPORT on a single host
+SIM_WORKERS = 4 # number of worker processes hosting the clients when running simulation.py
+CLIENT_STATE_RESIDENT = 16 # number of client states (optimizer) a simulation worker keeps in memory, the others are spilled to disk
+CLIENT_STATE_MAX_MB = None # memory budget of the resident client states per simulation worker (None = only limited by CLIENT_STATE_RESIDENT)
+CLIENT_STATE_DIR = './client-states/' # directory of the spilled client states
 
 # validation stage
 DROP_PATH_PROB = 0.2 # probability of dropping a path in cell, similar to dropout
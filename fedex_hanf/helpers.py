@@ -44,10 +44,3 @@ def prepare_log_dirs():
         os.mkdir('./hyperparam-logs')
     if not os.path.exists('./models/'):
         os.mkdir('./models')
-
-class ProtobufNumpyArray:
-    """
-        Class needed to deserialize numpy-arrays coming from flower
-    """
-    def __init__(self, bytes) -> None:
-        self.ndarray = bytes
\ No newline at end of file
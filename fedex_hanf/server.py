@@ -8,7 +8,7 @@ from helpers import prepare_log_dirs
 from genotype import GENOTYPE
 import torch
 
-def start_server(log_dir, rounds, dataset):
+def get_strategy(log_dir):
     #if config.DATASET == 'cifar10':
     #    net = CIFARCNN(config.IN_CHANNELS, config.OUT_CHANNELS, config.CLASSES)
     #elif config.DATASET == 'fmnist':
@@ -29,13 +29,22 @@ def start_server(log_dir, rounds, dataset):
         min_eval_clients=config.MIN_VAL_CLIENTS,
         min_available_clients=config.CLIENT_NR,
     )
+    return strategy
+
+def start_server(log_dir, rounds, dataset):
+    strategy = get_strategy(log_dir)
 
     # Start server
-    fl.server.start_server(
-        server_address="[::]:{}".format(config.PORT),
-        config={"num_rounds": rounds},
-        strategy=strategy,
-    )
+    try:
+        fl.server.start_server(
+            server_address="[::]:{}".format(config.PORT),
+            config={"num_rounds": rounds},
+            strategy=strategy,
+            grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH,
+        )
+    finally:
+        if strategy.transport is not None:
+            strategy.transport.close() # the last broadcast
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -2,12 +2,15 @@ from typing import Dict, List, Optional, Tuple
 import flwr as fl
 import numpy as np
 import pandas as pd
-from numproto import proto_to_ndarray, ndarray_to_proto
-from helpers import ProtobufNumpyArray, log_model_weights, log_hyper_config, log_hyper_params
-from utils import get_dataset_loder, discounted_mean
+from codec import encode, parameters_to_weights, weights_to_parameters, to_torch
+from aggregation import aggregate_fit_results, FoldingRound
+from downlink import DownlinkVersions
+from shm_transport import ShmTransport
+from weight_store import WeightStore
+from helpers import log_model_weights, log_hyper_config, log_hyper_params
+from utils import get_dataset_loder, discounted_mean, get_data_loader
 from collections import OrderedDict
 import torch
-from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
 from rtpt import RTPT
 from scipy.special import logsumexp
@@ -78,11 +81,19 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         self.net = initial_net
         self.net.to(DEVICE)
         initial_params = [param.cpu().detach().numpy() for _, param in self.net.state_dict().items()]
-        self.initial_parameters = self.last_weights = fl.common.weights_to_parameters(initial_params)
+        # immutable versions of the global weights, current is the latest aggregate
+        self.weight_store = WeightStore()
+        self.weight_store.add(weights_to_parameters(initial_params).tensors, 'current')
+        self.fit_base = None
+        self.folding = None
+        self.downlink = None
+        self.transport = ShmTransport('feathers_bcast') if config.SHM_TRANSPORT else None
+        if config.DOWNLINK_VERSIONS > 0 and self.transport is None:
+            self.downlink = DownlinkVersions(len(initial_params), config.DOWNLINK_VERSIONS, config.DOWNLINK_COMPRESSION)
         data_loader = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW)
         data_loader.partition()
         self.test_data = data_loader.load_server_data()
-        self.test_loader = DataLoader(self.test_data, batch_size=config.BATCH_SIZE, pin_memory=True, num_workers=2)
+        self.test_loader = get_data_loader(self.test_data, config.BATCH_SIZE, in_memory=config.IN_MEMORY_DATA, device=DEVICE)
         self.current_round = 1
         self.writer = SummaryWriter(log_dir)
         self.rtpt = RTPT('JS', 'Fedex_Server', config.ROUNDS)
@@ -103,6 +114,26 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         fh.setFormatter(logging.Formatter(self.log_format))
         logging.getLogger().addHandler(fh)
 
+    def configure_fit(self, rnd, parameters, client_manager):
+        instructions = super().configure_fit(rnd, parameters, client_manager)
+        if self.downlink is not None:
+            instructions, parameters = self.downlink.rewrite(parameters, instructions)
+        # remember the parameters the clients hold, compressed uploads are deltas to them
+        self.fit_base = parameters
+        if self.transport is not None:
+            instructions = self.transport.broadcast(parameters, instructions)
+        # fold the weights of each client as soon as they arrive
+        self.folding = FoldingRound(self.transport)
+        return self.folding.wrap(instructions)
+
+    def configure_evaluate(self, rnd, parameters, client_manager):
+        instructions = super().configure_evaluate(rnd, parameters, client_manager)
+        if self.downlink is not None:
+            instructions, _ = self.downlink.rewrite(parameters, instructions)
+        if self.transport is not None:
+            instructions = self.transport.broadcast(parameters, instructions)
+        return instructions
+
     def aggregate_fit(
         self,
         rnd: int,
@@ -121,10 +152,19 @@ class FedexStrategy(fl.server.strategy.FedAvg):
             Optional[fl.common.Weights]: Aggregated weights, the updated distribution and the possible hyperparameter-configurations.
         """
 
+        if self.downlink is not None:
+            self.downlink.acknowledge(results)
+        if self.transport is not None:
+            self.transport.receive([res.parameters for _, res in results])
+
         # obtain client weights
         samples = np.array([fit_res[1].num_examples for fit_res in results])
         weights = samples / np.sum(samples)
-        aggregated_weights, _ = super().aggregate_fit(rnd, results, failures)
+        aggregated_weights = aggregate_fit_results(results, self.fit_base, self.folding)
+        if self.downlink is not None:
+            # continue from the weights the clients reconstruct from the (quantized) step
+            aggregated_weights = self.downlink.reconstruct(aggregated_weights)
+        self.weight_store.add(aggregated_weights.tensors, 'current')
 
         # log current distribution
         self.distribution_history.append(self.distribution)
@@ -139,8 +179,8 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         self.update_distribution(gains, weights)
         
         # sample hyperparameters and append them to the parameters
-        serialized_dist = ndarray_to_proto(self.distribution)
-        aggregated_weights.tensors.append(serialized_dist.ndarray)
+        serialized_dist = encode(self.distribution)
+        aggregated_weights.tensors.append(serialized_dist)
 
         # log last hyperparam-configuration
         for _, res in results:
@@ -169,6 +209,8 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         Returns:
             _type_: Aggregated loss and metrics
         """
+        if self.downlink is not None:
+            self.downlink.acknowledge(results)
         loss, _ = super().aggregate_evaluate(rnd, results, failures)
         accuracies = np.array([res.metrics['accuracy'] for _, res in results])
         # assign weight to each client
@@ -191,15 +233,24 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         Returns:
             _type_: Initial model weights, distribution and hyperparameter configurations.
         """
-        serialized_dist = ndarray_to_proto(self.distribution)
-        self.initial_parameters.tensors.append(serialized_dist.ndarray)
-        return self.initial_parameters
+        serialized_dist = encode(self.distribution)
+        return self.weight_store.get('current').parameters(serialized_dist)
 
     def set_parameters(self, parameters):
         params_dict = zip(self.net.state_dict().keys(), parameters)
-        state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
+        state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
         self.net.load_state_dict(state_dict, strict=True)
 
+    def load_parameters(self, parameters):
+        """
+        Loads parameters into the net unless it holds their version already. Returns the version or None if unknown.
+        """
+        version = self.weight_store.find(parameters.tensors)
+        if version is None or version is not self.weight_store.get('loaded'):
+            self.set_parameters(version.weights() if version is not None else parameters_to_weights(parameters))
+            self.weight_store.set('loaded', version)
+        return version
+
     def compute_gains(self, weights, results):
         """
         Computes the average gains/progress the model made during the last fit-call.
@@ -255,12 +306,7 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         self.distribution = np.exp(self.log_distribution)
 
     def evaluate(self, parameters: fl.common.typing.Parameters):
-        params = []
-        for param in parameters.tensors:
-            pnpa = ProtobufNumpyArray(param)
-            weight = proto_to_ndarray(pnpa)
-            params.append(weight)
-        self.set_parameters(params)
+        self.load_parameters(parameters)
         loss, accuracy = _test(self.net, self.test_loader, self.writer, self.current_round)
 
         # log metrics to tensorboard
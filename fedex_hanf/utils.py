@@ -4,7 +4,7 @@ import torch
 import shutil
 import torchvision.transforms as transforms
 from torch.autograd import Variable
-from torch.utils.data import random_split, Subset
+from torch.utils.data import random_split, Subset, DataLoader, RandomSampler, SequentialSampler
 import torchvision
 import math
 import json
@@ -120,6 +120,113 @@ def get_dataset_loder(dataset, num_clients, indspath, skew=0):
     else:
         raise ValueError('{} is not supported'.format(dataset))
 
+class TensorData:
+    """
+    Dataset (partition) materialized into contiguous tensors. Batches are fetched by indexing
+    the tensors with a whole batch of indices at once instead of per sample.
+    """
+
+    def __init__(self, X, y) -> None:
+        self.X = X
+        self.y = y
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getitem__(self, index):
+        return self.X[index], self.y[index]
+
+    def get_batch(self, indices):
+        return self.X.index_select(0, indices), self.y.index_select(0, indices)
+
+class TensorLoader:
+    """
+    Drop-in replacement for DataLoader over TensorData. Sequential passes are served by slicing,
+    otherwise the order of the sampler is drawn once per pass and split into index-batches.
+    """
+
+    def __init__(self, dataset, batch_size, sampler=None, shuffle=False, drop_last=False) -> None:
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.drop_last = drop_last
+
+    def __len__(self):
+        n = len(self.sampler)
+        if self.drop_last:
+            return n // self.batch_size
+        return math.ceil(n / self.batch_size)
+
+    def __iter__(self):
+        n = len(self.sampler)
+        stop = n - n % self.batch_size if self.drop_last else n
+        if isinstance(self.sampler, SequentialSampler):
+            for start in range(0, stop, self.batch_size):
+                end = min(start + self.batch_size, stop)
+                yield self.dataset.X[start:end], self.dataset.y[start:end]
+        else:
+            order = torch.as_tensor(list(iter(self.sampler)), dtype=torch.long, device=self.dataset.X.device)
+            for start in range(0, stop, self.batch_size):
+                yield self.dataset.get_batch(order[start:start + self.batch_size])
+
+def get_targets(data):
+    """
+    Returns the labels of data (dataset or Subset) as LongTensor without loading the samples.
+    """
+    if isinstance(data, TensorData):
+        return data.y
+    if isinstance(data, Subset):
+        return get_targets(data.dataset)[torch.as_tensor(data.indices, dtype=torch.long)]
+    return torch.as_tensor(data.targets, dtype=torch.long)
+
+def _raw_image_tensors(data, indices):
+    # the datasets below are loaded with ToTensor() + Normalize((0,), (1,)), i.e. pixels are only scaled to [0, 1].
+    # Thus, we can skip the per-sample PIL-conversion and transform the raw uint8 buffer at once.
+    if isinstance(data, torchvision.datasets.FashionMNIST):
+        X = torch.as_tensor(data.data)[indices].unsqueeze(1)
+    elif isinstance(data, torchvision.datasets.CIFAR10):
+        X = torch.from_numpy(data.data[indices.numpy()]).permute(0, 3, 1, 2)
+    else:
+        return None
+    return X.float().div_(255.).contiguous()
+
+def materialize(data, device=None, batch_size=1024):
+    """
+    Materializes a dataset or Subset once into a TensorData (optionally resident on device).
+    """
+    if isinstance(data, TensorData):
+        X, y = data.X, data.y
+    else:
+        dataset, indices = (data.dataset, data.indices) if isinstance(data, Subset) else (data, np.arange(len(data)))
+        indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        if isinstance(dataset, TensorData):
+            X, y = dataset.X[indices], dataset.y[indices]
+        else:
+            X, y = _raw_image_tensors(dataset, indices), None
+            if X is not None:
+                y = get_targets(dataset)[indices]
+            else:
+                # generic path: one pass over the data with the default pipeline
+                feats, labels = [], []
+                for f, l in DataLoader(data, batch_size, num_workers=2):
+                    feats.append(f)
+                    labels.append(l)
+                X, y = torch.cat(feats), torch.cat(labels)
+    if device is not None:
+        X, y = X.to(device), y.to(device)
+    return TensorData(X.contiguous(), y.contiguous())
+
+def get_data_loader(data, batch_size, sampler=None, in_memory=False, device=None, num_workers=2):
+    """
+    Returns a loader over data. If in_memory is set, data is materialized once into contiguous tensors
+    on device (no-op if it already is) and served by TensorLoader, otherwise a regular DataLoader is used.
+    """
+    if in_memory or isinstance(data, TensorData):
+        return TensorLoader(materialize(data, device), batch_size, sampler=sampler)
+    return DataLoader(data, batch_size, sampler=sampler, pin_memory=True, num_workers=num_workers)
+
 def partition_data(train_set, val_set, n_clients):
     train_len = len(train_set)
     val_len = len(val_set) // 2
@@ -0,0 +1,158 @@
+"""
+Versioned downlink. The server keeps a ring of the most recent versions of the global weights and remembers which version
+each client holds. Instead of the full weights, a client receives nothing but the additional tensors (e.g. the
+hyperparameter index) if it already holds the current version, or the steps (optionally quantized deltas) from its version
+to the current one. Each step is encoded once when the version is published and shared by all clients. Since quantized
+steps are lossy, the current version is defined as the previous one plus the dequantized step, s.t. server and clients
+hold exactly the same weights. The server continues from this reconstruction (see reconstruct) instead of the exact
+aggregate, thus the quantization error of a step is carried into the next step (error feedback) rather than letting
+server and clients drift apart.
+"""
+from collections import OrderedDict
+import flwr as fl
+import numpy as np
+from codec import decode, decode_delta, encode, encode_delta, quantize, TENSOR_TYPE
+
+
+def _same(tensors, other):
+    return len(tensors) >= len(other) and all(a is b or a == b for a, b in zip(tensors, other))
+
+def apply_step(weight, step):
+    """
+    Applies an encoded step (see encode_delta) to the array weight, used by server and clients alike.
+    """
+    value, is_delta = decode_delta(step)
+    if not is_delta:
+        return value
+    return (weight + value).astype(weight.dtype, copy=False)
+
+
+class DownlinkVersions:
+
+    def __init__(self, n_weights, capacity=4, mode=None) -> None:
+        """
+        Server-side ring of versions of the global weights.
+
+        Args:
+            n_weights (int): Number of weight tensors, further tensors of the parameters (hyperparameters) are sent as they are
+            capacity (int, optional): Number of versions kept. Defaults to 4.
+            mode (str, optional): Quantization of the steps (fp16, bf16, int8), None sends them exactly. Defaults to None.
+        """
+        self.n_weights = n_weights
+        self.capacity = capacity
+        self.mode = mode if mode is not None else 'fp32'
+        self.versions = OrderedDict() # version -> (encoded weights, encoded step from the previous version)
+        self.latest = None
+        self.source = None # tensors the latest version was published from
+        self.client_versions = {}
+        self.pending = set() # clients which were sent a message, but did not acknowledge it yet
+
+    def publish(self, tensors):
+        """
+        Registers the weight tensors as new version unless they equal the latest one (or the tensors it was published
+        from). Returns the encoded weights of the latest version.
+        """
+        if self.latest is not None and (_same(tensors, self.source) or _same(tensors, self.versions[self.latest][0])):
+            return self.versions[self.latest][0]
+        if self.latest is None:
+            version, weights, step = 0, list(tensors), None
+        else:
+            version, weights, step = self.latest + 1, [], []
+            for prev, new in zip(self.versions[self.latest][0], tensors):
+                prev, new = decode(prev), decode(new)
+                if np.issubdtype(new.dtype, np.floating):
+                    q, scale = quantize(new.astype(np.float32) - prev.astype(np.float32), self.mode)
+                    step.append(encode_delta(q, self.mode, new.dtype, scale))
+                else:
+                    step.append(encode_delta(new, 'raw', new.dtype))
+                weights.append(encode(apply_step(prev, step[-1])))
+        self.versions[version] = (weights, step)
+        while len(self.versions) > self.capacity:
+            self.versions.popitem(last=False)
+        self.latest, self.source = version, list(tensors)
+        return weights
+
+    def reconstruct(self, parameters):
+        """
+        Publishes the weights of parameters (e.g. an aggregate) and returns the parameters the clients will reconstruct
+        from the (quantized) step, which the server should hold as global weights.
+        """
+        weights = self.publish(parameters.tensors[:self.n_weights])
+        return fl.common.Parameters(tensors=weights + parameters.tensors[self.n_weights:], tensor_type=TENSOR_TYPE)
+
+    def _message(self, cid):
+        weights = self.versions[self.latest][0]
+        base = self.client_versions.get(cid)
+        if cid in self.pending:
+            # the last message was not acknowledged, the version of the client is unknown
+            base = None
+        self.pending.add(cid)
+        config = {'dl_version': self.latest, 'dl_n': self.n_weights}
+        if base == self.latest:
+            return [], dict(config, dl_kind='same')
+        if base is not None and all(v in self.versions for v in range(base + 1, self.latest + 1)):
+            steps = [t for v in range(base + 1, self.latest + 1) for t in self.versions[v][1]]
+            if sum(len(t) for t in steps) < sum(len(t) for t in weights):
+                return steps, dict(config, dl_kind='steps', dl_base=base)
+        return weights, dict(config, dl_kind='full')
+
+    def rewrite(self, parameters, instructions):
+        """
+        Replaces parameters in the instructions (list of (ClientProxy, FitIns/EvaluateIns)) by the messages of the
+        versioned downlink. Returns the new instructions and the parameters the clients will reconstruct.
+        """
+        weights = self.publish(parameters.tensors[:self.n_weights])
+        extra = parameters.tensors[self.n_weights:]
+        rewritten = []
+        for client, ins in instructions:
+            tensors, config = self._message(client.cid)
+            message = fl.common.Parameters(tensors=tensors + extra, tensor_type=TENSOR_TYPE)
+            rewritten.append((client, type(ins)(parameters=message, config=dict(ins.config, **config))))
+        return rewritten, fl.common.Parameters(tensors=weights + extra, tensor_type=TENSOR_TYPE)
+
+    def acknowledge(self, results):
+        """
+        Records the versions reported by the clients (metric dl_version) in their results.
+        """
+        for client, res in results:
+            if 'dl_version' in res.metrics:
+                self.client_versions[client.cid] = res.metrics['dl_version']
+                self.pending.discard(client.cid)
+
+
+class DownlinkDecoder:
+    """
+    Client-side counterpart of DownlinkVersions, holds the version of the global weights received last.
+    """
+
+    def __init__(self) -> None:
+        self.version = None
+        self.weights = None
+
+    def receive(self, parameters, config):
+        """
+        Reconstructs the full list of weights (plus additional tensors) from a message of the downlink.
+        """
+        tensors = parameters.tensors
+        kind = config.get('dl_kind')
+        if kind is None:
+            return [decode(t) for t in tensors]
+        n, version = config['dl_n'], config['dl_version']
+        if kind == 'full':
+            self.weights, extra = [decode(t) for t in tensors[:n]], tensors[n:]
+        elif kind == 'same':
+            if self.version != version:
+                raise ValueError('Client holds version {} of the weights, server assumed {}'.format(self.version, version))
+            extra = tensors
+        elif kind == 'steps':
+            base = config['dl_base']
+            if self.version is None or not base <= self.version <= version:
+                raise ValueError('Client holds version {} of the weights, server sent steps from {}'.format(self.version, base))
+            for k, v in enumerate(range(base + 1, version + 1)):
+                if v > self.version:
+                    self.weights = [apply_step(w, s) for w, s in zip(self.weights, tensors[k*n:(k+1)*n])]
+            extra = tensors[(version - base)*n:]
+        else:
+            raise ValueError('Unknown downlink message {}'.format(kind))
+        self.version = version
+        return self.weights + [decode(t) for t in extra]
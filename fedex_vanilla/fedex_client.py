@@ -5,13 +5,15 @@ import warnings
 import flwr as fl
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-from utils import get_dataset_loder
+from utils import get_dataset_loder, get_data_loader, materialize
 from fedex_model import FMNISTCNN, CIFARCNN
 from rtpt import RTPT
 import numpy as np
 from tensorboardX import SummaryWriter
 from datetime import datetime as dt
+from codec import CodecClient, to_torch
+from downlink import DownlinkDecoder
+from shm_transport import ShmTransport
 import config
 import argparse
 from hyperparameters import Hyperparameters
@@ -58,90 +60,131 @@ def _test(net, testloader, device):
 # 2. Federation of the pipeline with Flower
 # #############################################################################
 
+class MyClient(fl.client.NumPyClient):
+
+    def __init__(self, client_id, dataset_loader, device, rtpt=None, num_workers=0) -> None:
+        """
+        Flower client running FedEx on the partition of client_id.
+
+        Args:
+            client_id (int): Id of the client, selects the data-partition
+            dataset_loader (Loader): Loader of the dataset
+            device (torch.device): Device the model is trained on
+            rtpt (RTPT, optional): Progress reporting, stepped once per fit. Defaults to None.
+            num_workers (int, optional): Number of DataLoader-workers. Defaults to 0.
+        """
+        super().__init__()
+        self.dataset_loader = dataset_loader
+        self.device = device
+        self.rtpt = rtpt
+        self.num_workers = num_workers
+        # Load model
+        if config.DATASET == 'cifar10':
+            self.net = CIFARCNN(config.IN_CHANNELS, config.OUT_CHANNELS, config.CLASSES)
+        elif config.DATASET == 'fmnist':
+            self.net = FMNISTCNN()
+        self.net.to(device)
+        self.date = dt.strftime(dt.now(), '%Y:%m:%d:%H:%M:%S')
+        #os.mkdir('./fedex_models/Client_{}'.format(self.date))
+        self.writer = SummaryWriter("./runs/Client_{}".format(self.date))
+        self.hyperparameters = Hyperparameters(config.HYPERPARAM_CONFIG_NR)
+        self.hyperparameters.read_from_csv(config.HYPERPARAM_FILE)
+        self.set_state(None)
+        self.bind(client_id)
+
+    def bind(self, client_id):
+        """
+        (Re-)binds the client to the data-partition of client_id.
+        """
+        self.client_id = client_id
+        train_data, test_data = self.dataset_loader.load_client_data(client_id)
+        if config.IN_MEMORY_DATA:
+            train_data, test_data = materialize(train_data, self.device), materialize(test_data, self.device)
+        self.train_data = get_data_loader(train_data, config.BATCH_SIZE, num_workers=self.num_workers)
+        self.test_data = get_data_loader(test_data, config.BATCH_SIZE, num_workers=self.num_workers)
+
+    def get_state(self):
+        """
+        Returns the client-specific training state (optimizer and epoch), the model-weights are sent by the server.
+        """
+        return {'optimizer': self.optim.state_dict(), 'epoch': self.epoch}
+
+    def set_state(self, state):
+        """
+        Restores a state obtained by get_state, None resets the client to a fresh one.
+        """
+        self.optim = torch.optim.SGD(self.net.parameters(), 0.01, momentum=0.9, weight_decay=1e-4)
+        self.epoch = 1
+        if state is not None:
+            self.optim.load_state_dict(state['optimizer'])
+            self.epoch = state['epoch']
+
+    def get_parameters(self):
+        return [val.cpu().numpy() for _, val in self.net.state_dict().items()]
+
+    def set_parameters_train(self, parameters, config):
+        # obtain hyperparams and distribution
+        self.distribution = parameters[-1]
+        self.hyperparam_config, self.hidx = self._sample_hyperparams()
+        
+        # remove hyperparameter distribution from parameter list
+        parameters = parameters[:-1]
+
+        for g in self.optim.param_groups:
+            g['lr'] = self.hyperparam_config['learning_rate']
+            g['momentum'] = self.hyperparam_config['momentum']
+            g['weight_decay'] = self.hyperparam_config['weight_decay']
+
+        self.net.dropout = self.hyperparam_config['dropout']
+        
+        params_dict = zip(self.net.state_dict().keys(), parameters)
+        state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
+        self.net.load_state_dict(state_dict, strict=True)
+
+    def set_parameters_evaluate(self, parameters):
+        params_dict = zip(self.net.state_dict().keys(), parameters)
+        state_dict = OrderedDict({k: to_torch(v) for k, v in params_dict})
+        self.net.load_state_dict(state_dict, strict=True)
+
+    def fit(self, parameters, config):
+        self.set_parameters_train(parameters, config)
+        before_loss, _ = _test(self.net, self.test_data, self.device)
+        #self.net.drop_path_prob = self.hyperparam_config['dropout']
+        train(self.net, self.train_data, self.writer, self.epoch, self.optim, self.device)
+        after_loss, _ = _test(self.net, self.test_data, self.device)
+        model_params = self.get_parameters()
+        if self.rtpt is not None:
+            self.rtpt.step()
+        self.epoch += 1
+        return model_params, len(self.train_data), {'hidx': self.hidx, 'before': before_loss, 'after': after_loss}
+
+    def evaluate(self, parameters, config):
+        self.set_parameters_evaluate(parameters)
+        #self.net.drop_path_prob = self.hyperparam_config['dropout']
+        loss, accuracy = _test(self.net, self.test_data, self.device)
+        return float(loss), len(self.test_data), {"accuracy": float(accuracy)}
+
+    def _sample_hyperparams(self):
+        # obtain new learning rate for this batch
+        distribution = torch.distributions.Categorical(torch.FloatTensor(self.distribution))
+        hyp_idx = distribution.sample().item()
+        print(hyp_idx)
+        hyp_config = self.hyperparameters[hyp_idx]
+        return hyp_config, hyp_idx
+
+
 def main(device, client_id):
     """Create model, load data, define Flower client, start Flower client."""
 
-    # Load model
-    if config.DATASET == 'cifar10':
-        net = CIFARCNN(config.IN_CHANNELS, config.OUT_CHANNELS, config.CLASSES)
-    elif config.DATASET == 'fmnist':
-        net = FMNISTCNN()
-    net.to(device)
-
     # Load data
     dataset_loader = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW)
-    train_data, test_data = dataset_loader.load_client_data(client_id)
-    train_data, test_data = DataLoader(train_data, config.BATCH_SIZE, False), DataLoader(test_data, config.BATCH_SIZE, False)
     rtpt = RTPT('JS', 'HANF_Client', config.ROUNDS)
     rtpt.start()
 
-    # Flower client
-    class MyClient(fl.client.NumPyClient):
-
-        def __init__(self, *args, **kwargs) -> None:
-            super().__init__(*args, **kwargs)
-            self.date = dt.strftime(dt.now(), '%Y:%m:%d:%H:%M:%S')
-            #os.mkdir('./fedex_models/Client_{}'.format(self.date))
-            self.writer = SummaryWriter("./runs/Client_{}".format(self.date))
-            self.hyperparameters = Hyperparameters(config.HYPERPARAM_CONFIG_NR)
-            self.hyperparameters.read_from_csv(config.HYPERPARAM_FILE)
-            self.optim = torch.optim.SGD(net.parameters(), 0.01, momentum=0.9, weight_decay=1e-4)
-            self.epoch = 1
-
-        def get_parameters(self):
-            return [val.cpu().numpy() for _, val in net.state_dict().items()]
-
-        def set_parameters_train(self, parameters, config):
-            # obtain hyperparams and distribution
-            self.distribution = parameters[-1]
-            self.hyperparam_config, self.hidx = self._sample_hyperparams()
-            
-            # remove hyperparameter distribution from parameter list
-            parameters = parameters[:-1]
-
-            for g in self.optim.param_groups:
-                g['lr'] = self.hyperparam_config['learning_rate']
-                g['momentum'] = self.hyperparam_config['momentum']
-                g['weight_decay'] = self.hyperparam_config['weight_decay']
-
-            net.dropout = self.hyperparam_config['dropout']
-            
-            params_dict = zip(net.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
-            net.load_state_dict(state_dict, strict=True)
-
-        def set_parameters_evaluate(self, parameters):
-            params_dict = zip(net.state_dict().keys(), parameters)
-            state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
-            net.load_state_dict(state_dict, strict=True)
-
-        def fit(self, parameters, config):
-            self.set_parameters_train(parameters, config)
-            before_loss, _ = _test(net, test_data, device)
-            #net.drop_path_prob = self.hyperparam_config['dropout']
-            train(net, train_data, self.writer, self.epoch, self.optim, device)
-            after_loss, _ = _test(net, test_data, device)
-            model_params = self.get_parameters()
-            rtpt.step()
-            self.epoch += 1
-            return model_params, len(train_data), {'hidx': self.hidx, 'before': before_loss, 'after': after_loss}
-
-        def evaluate(self, parameters, config):
-            self.set_parameters_evaluate(parameters)
-            #net.drop_path_prob = self.hyperparam_config['dropout']
-            loss, accuracy = _test(net, test_data, device)
-            return float(loss), len(test_data), {"accuracy": float(accuracy)}
-
-        def _sample_hyperparams(self):
-            # obtain new learning rate for this batch
-            distribution = torch.distributions.Categorical(torch.FloatTensor(self.distribution))
-            hyp_idx = distribution.sample().item()
-            print(hyp_idx)
-            hyp_config = self.hyperparameters[hyp_idx]
-            return hyp_config, hyp_idx
-
     # Start client
-    fl.client.start_numpy_client("[::]:{}".format(config.PORT), client=MyClient())
+    transport = ShmTransport('feathers_up', reuse=True) if config.SHM_TRANSPORT else None
+    fl.client.start_client("[::]:{}".format(config.PORT), client=CodecClient(MyClient(client_id, dataset_loader, device, rtpt=rtpt), upload_mode=config.UPLOAD_COMPRESSION, downlink=DownlinkDecoder(), transport=transport),
+        grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH)
 
 
 if __name__ == "__main__":
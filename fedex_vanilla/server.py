@@ -6,7 +6,7 @@ import argparse
 import config
 from helpers import prepare_log_dirs
 
-def start_server(log_dir, rounds, dataset):
+def get_strategy(log_dir):
     if config.DATASET == 'cifar10':
         net = CIFARCNN(config.IN_CHANNELS, config.OUT_CHANNELS, config.CLASSES)
     elif config.DATASET == 'fmnist':
@@ -21,13 +21,22 @@ def start_server(log_dir, rounds, dataset):
         initial_net=net,
         log_dir=log_dir
     )
+    return strategy
+
+def start_server(log_dir, rounds, dataset):
+    strategy = get_strategy(log_dir)
 
     # Start server
-    fl.server.start_server(
-        server_address="[::]:{}".format(config.PORT),
-        config={"num_rounds": rounds},
-        strategy=strategy,
-    )
+    try:
+        fl.server.start_server(
+            server_address="[::]:{}".format(config.PORT),
+            config={"num_rounds": rounds},
+            strategy=strategy,
+            grpc_max_message_length=config.GRPC_MAX_MESSAGE_LENGTH,
+        )
+    finally:
+        if strategy.transport is not None:
+            strategy.transport.close() # the last broadcast
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()